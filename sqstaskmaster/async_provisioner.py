@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncProvisioner:
+    """
+    Run the rules of a Provisioner on an asyncio event loop, each rule on its own interval and with its own timeout, so
+    a slow AWS call only delays its own rule. The blocking boto3 calls of each rule run on a thread of its own.
+
+    The interval and timeout default to the constructor arguments and can be set per rule with the INTERVAL and
+    TIMEOUT keys. A rule that times out is logged and retried on its next interval; the call itself cannot be
+    interrupted and finishes on the thread of the rule, so the later cycles of that rule wait for it and time out
+    until it returns while the other rules keep running.
+
+    When the provisioner has a history_directory the queue depth history is saved every history_save_interval seconds
+    and when the runner stops.
+
+    Usage:
+    runner = AsyncProvisioner(Provisioner(RULES), interval=10)
+    runner.run_forever()  # until SIGTERM or SIGINT
+
+    or from a running loop:
+    task = asyncio.ensure_future(runner.run())
+    ...
+    runner.stop()
+    await task
+
+    metrics() reports the event loop lag and the duration, timeouts and errors of the last cycle of each rule.
+    """
+
+    INTERVAL = "interval"
+    TIMEOUT = "timeout"
+
+    def __init__(self, provisioner, interval=10, timeout=60, lag_interval=1):
+        """
+        :param provisioner: the Provisioner with the rules
+        :param interval: seconds between the starts of the cycles of a rule
+        :param timeout: seconds to wait for a cycle of a rule
+        :param lag_interval: seconds between measurements of the event loop lag
+        """
+        if interval <= 0:
+            raise ValueError("Interval {} must be greater than zero".format(interval))
+
+        if timeout <= 0:
+            raise ValueError("Timeout {} must be greater than zero".format(timeout))
+
+        self.provisioner = provisioner
+        self.interval = interval
+        self.timeout = timeout
+        self.lag_interval = lag_interval
+
+        self._loop = None
+        self._stop_event = None
+        self._stopping = False
+        self._metrics = {"loop_lag": 0.0, "max_loop_lag": 0.0, "rules": {}}
+
+    def _key(self, rule):
+        return rule[self.provisioner.CLUSTER_NAME], rule[self.provisioner.SERVICE_NAME]
+
+    def metrics(self):
+        """
+        :return: dict of loop_lag and max_loop_lag in seconds and rules, a dict of (cluster, service) to the
+                 cycle_time in seconds and the counts of cycles, timeouts and errors
+        """
+        return {
+            "loop_lag": self._metrics["loop_lag"],
+            "max_loop_lag": self._metrics["max_loop_lag"],
+            "rules": {
+                key: dict(value) for key, value in self._metrics["rules"].items()
+            },
+        }
+
+    def stop(self):
+        """
+        Stop after the cycles in progress. Safe to call from a signal handler or another thread.
+        """
+        self._stopping = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    async def _sleep(self, seconds):
+        """
+        :return: True if stopped while sleeping
+        """
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), max(0, seconds))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _cycle(self, rule):
+        self.provisioner.reconcile_stale([rule])
+        self.provisioner.run_rule(rule)
+
+    async def _run_rule(self, rule):
+        key = self._key(rule)
+        interval = rule.get(self.INTERVAL, self.interval)
+        timeout = rule.get(self.TIMEOUT, self.timeout)
+        metrics = self._metrics["rules"].setdefault(
+            key, {"cycle_time": None, "cycles": 0, "timeouts": 0, "errors": 0}
+        )
+
+        # Not shared with the other rules, so a call that hangs only holds up this rule
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            await self._run_cycles(rule, key, interval, timeout, metrics, executor)
+        finally:
+            # Do not wait for calls that timed out
+            executor.shutdown(wait=False)
+
+    async def _run_cycles(self, rule, key, interval, timeout, metrics, executor):
+        while not self._stop_event.is_set():
+            started = self._loop.time()
+            try:
+                await asyncio.wait_for(
+                    self._loop.run_in_executor(executor, self._cycle, rule), timeout
+                )
+            except asyncio.TimeoutError:
+                metrics["timeouts"] += 1
+                logger.error("Rule %s timed out after %s seconds", key, timeout)
+            except Exception as e:
+                # Keep the other cycles of this rule running
+                metrics["errors"] += 1
+                logger.exception("Failed to run rule %s", key)
+                self.provisioner.notify(e, context=rule)
+
+            cycle_time = self._loop.time() - started
+            metrics["cycle_time"] = cycle_time
+            metrics["cycles"] += 1
+            logger.debug("Rule %s cycle took %.3f seconds", key, cycle_time)
+
+            if await self._sleep(interval - cycle_time):
+                return
+
+    async def _monitor_lag(self):
+        while True:
+            expected = self._loop.time() + self.lag_interval
+            if await self._sleep(self.lag_interval):
+                return
+            lag = max(0.0, self._loop.time() - expected)
+            self._metrics["loop_lag"] = lag
+            self._metrics["max_loop_lag"] = max(self._metrics["max_loop_lag"], lag)
+            if lag > self.lag_interval:
+                logger.warning("Event loop lag %.3f seconds", lag)
+
+    async def _save_history(self):
+        if not self.provisioner.history_directory:
+            return
+        try:
+            while not await self._sleep(self.provisioner.history_save_interval):
+                await self._loop.run_in_executor(None, self.provisioner.save_history)
+        finally:
+            await self._loop.run_in_executor(None, self.provisioner.save_history)
+
+    async def run(self):
+        """
+        Run the rules until stop is called
+        """
+        self._stop_event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self._stopping:
+            self._stop_event.set()
+
+        rules = list(self.provisioner.rules)
+        logger.info("Starting async provisioner for %d rules", len(rules))
+        try:
+            await asyncio.gather(
+                self._monitor_lag(),
+                self._save_history(),
+                *(self._run_rule(rule) for rule in rules)
+            )
+        finally:
+            self._loop = None
+            logger.info("Stopped async provisioner")
+
+    def run_forever(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        """
+        Run the rules on a new event loop until one of the signals is received
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            for signum in signals:
+                loop.add_signal_handler(signum, self.stop)
+            loop.run_until_complete(self.run())
+        finally:
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+            loop.close()
@@ -0,0 +1,477 @@
+import asyncio
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from functools import partial
+from json import JSONDecodeError
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.envelope import TASKS
+from sqstaskmaster.logs import Preview, message_context, message_fields, preview
+from sqstaskmaster.task_manager import MAX_BATCH_ENTRIES
+
+logger = logging.getLogger(__name__)
+"""
+Asyncio consumer for I/O bound tasks such as webhooks and API calls that spend most of their time waiting. Many tasks
+run concurrently in one process: messages are received in batches while there are free slots, visibility heartbeats
+are coroutines rather than SIGALRM, and acks and heartbeats are sent with the SQS batch calls.
+"""
+
+
+class _Batch:
+    """
+    Collects entries for an SQS batch call and sends them when MAX_BATCH_ENTRIES are waiting or after interval seconds.
+    """
+
+    def __init__(self, send, operation_name, interval, executor):
+        """
+        :param send: the batch method of the queue taking Entries
+        :param operation_name: the name of the SQS operation for failed entries
+        """
+        self._send = send
+        self._operation_name = operation_name
+        self.interval = interval
+        self._executor = executor
+        self._entries = []
+        self._timer = None
+        self._sending = set()
+
+    async def add(self, entry):
+        """
+        :raise ClientError: if the call or the entry failed
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._entries.append((entry, future))
+        if len(self._entries) >= MAX_BATCH_ENTRIES:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, self.flush)
+        await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._entries:
+            entries = self._entries[:MAX_BATCH_ENTRIES]
+            self._entries = self._entries[MAX_BATCH_ENTRIES:]
+            task = asyncio.ensure_future(self._send_entries(entries))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def close(self):
+        self.flush()
+        if self._sending:
+            await asyncio.gather(*self._sending)
+
+    async def _send_entries(self, entries):
+        batch = [
+            {"Id": str(index), **entry} for index, (entry, _) in enumerate(entries)
+        ]
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(
+                self._executor, partial(self._send, Entries=batch)
+            )
+        except Exception as e:
+            for _, future in entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        failed = {failure["Id"]: failure for failure in response.get("Failed", [])}
+        for index, (_, future) in enumerate(entries):
+            if future.done():
+                # The caller was cancelled
+                continue
+            failure = failed.get(str(index))
+            if failure is None:
+                future.set_result(None)
+            else:
+                future.set_exception(
+                    ClientError(
+                        {
+                            "Error": {
+                                "Code": failure.get("Code"),
+                                "Message": failure.get("Message", ""),
+                            }
+                        },
+                        self._operation_name,
+                    )
+                )
+
+
+class SqsBatcher:
+    """
+    Sends the acks and visibility changes of many concurrent handlers with delete_messages and
+    change_message_visibility_batch.
+    """
+
+    def __init__(self, queue, interval=0.5, executor=None):
+        """
+        :param queue: the boto3 SQS Queue or LocalQueue
+        :param interval: the maximum seconds an ack or visibility change waits for a batch to fill
+        :param executor: the executor for the blocking SQS calls, the default executor of the loop if None
+        """
+        self._deletes = _Batch(
+            queue.delete_messages, "DeleteMessageBatch", interval, executor
+        )
+        self._visibility = _Batch(
+            queue.change_message_visibility_batch,
+            "ChangeMessageVisibilityBatch",
+            interval,
+            executor,
+        )
+
+    async def delete(self, message):
+        await self._deletes.add({"ReceiptHandle": message.receipt_handle})
+
+    async def change_visibility(self, message, seconds):
+        await self._visibility.add(
+            {"ReceiptHandle": message.receipt_handle, "VisibilityTimeout": seconds}
+        )
+
+    async def close(self):
+        await asyncio.gather(self._deletes.close(), self._visibility.close())
+
+
+class AsyncMessageHandler(ABC):
+    """
+    AsyncMessageHandler is the asyncio counterpart of MessageHandler for I/O bound tasks.
+    The implementer must provide the run coroutine and the running and notify methods.
+
+    async with MyHandler(message, sqs_timeout=30, heartbeat_interval=20, hard_timeout=300, **kwargs) as handler:
+        await handler.run()
+
+    While the block runs a heartbeat coroutine extends the message visibility every heartbeat_interval seconds. The
+    block is cancelled when the hard timeout is hit or running returns False. As with MessageHandler, the message is
+    deleted if the block completes, and any Exception is notified, logged and suppressed leaving the message to be
+    retried by SQS.
+    """
+
+    def __init__(self, message, sqs_timeout, heartbeat_interval, hard_timeout):
+        """
+        :param message: the SQS message
+        :param sqs_timeout: the timeout to set when the process is still working on the message
+        :param heartbeat_interval: the interval to check if running and update SQS
+        :param hard_timeout: The hard limit for executing the message processing
+        """
+        self._message = message
+        self.sqs_timeout = sqs_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.hard_timeout = hard_timeout
+        # Set by the AsyncTaskManager to batch the SQS calls of its handlers
+        self.batcher = None
+
+        if heartbeat_interval <= 0:
+            raise ValueError("Heartbeat interval must be greater than zero")
+
+        if sqs_timeout <= 0:
+            raise ValueError("SQS timeout must be an integer greater than zero")
+
+        if hard_timeout <= 0:
+            raise ValueError("Hard timeout must be greater than zero")
+
+        if (heartbeat_interval + 1) >= sqs_timeout:
+            raise ValueError(
+                "Heartbeat interval {} is to long to reset the sqs timeout {:d}".format(
+                    heartbeat_interval, sqs_timeout
+                )
+            )
+
+        self._start_time = time.time()
+        self._task = None
+        self._heartbeat = None
+        self._error = None
+
+    async def __aenter__(self):
+        self._task = asyncio.current_task()
+        await self._extend_timeout(self.sqs_timeout)
+        self._heartbeat = asyncio.ensure_future(self._beat())
+        return self
+
+    def _run_time(self):
+        return time.time() - self._start_time
+
+    def _context(self):
+        return message_context(self._message)
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(
+                max(
+                    0,
+                    min(self.heartbeat_interval, self.hard_timeout - self._run_time()),
+                )
+            )
+            if self._run_time() >= self.hard_timeout:
+                self._abort(TimeoutError("Hit Hard Timeout for message handler"))
+                return
+            elif self.running():
+                logger.debug("Adjusting sqs timeout for %s", self)
+                try:
+                    await self._extend_timeout(self.sqs_timeout)
+                except ClientError as ce:
+                    # Don't fail here - report and continue - will result in running the task many times
+                    self.notify(ce, context=self._context())
+                    logger.exception("Failed to extend timeout for %s", self)
+            else:
+                self._abort(RuntimeError("Handler is stuck on {}".format(self)))
+                return
+
+    def _abort(self, error):
+        self._error = error
+        self._task.cancel()
+
+    async def _extend_timeout(self, seconds):
+        if self.batcher is not None:
+            await self.batcher.change_visibility(self._message, seconds)
+        else:
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                partial(self._message.change_visibility, VisibilityTimeout=seconds),
+            )
+
+    async def _ack(self):
+        if self.batcher is not None:
+            await self.batcher.delete(self._message)
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, self._message.delete)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+
+        if isinstance(exc_val, asyncio.CancelledError) and self._error is not None:
+            # Cancelled by the heartbeat rather than by the caller
+            exc_val = self._error
+            if hasattr(self._task, "uncancel"):
+                self._task.uncancel()
+
+        if exc_val is None:
+            try:
+                await self._ack()
+            except ClientError as ce:
+                self.notify(ce, context=self._context())
+                logger.exception("failed to delete message %s", self._message)
+        else:
+            self.notify(exc_val, context=self._context())
+            logger.error("Failed for message: %s", self._message, exc_info=exc_val)
+
+        # catch only Exception not BaseException such as a CancelledError from the caller
+        return isinstance(exc_val, Exception)
+
+    @abstractmethod
+    def notify(self, exception, context=None):
+        """
+        Provide a method for notification of errors outside the logger such as HoneyBadger
+        :param exception: the exception to notify about
+        :param context: the context in which it occurred
+        """
+
+    def __str__(self):
+        return "AsyncMessageHandler: sqs {}, heartbeat {}, run {}, hard {}, content {}, attrs {}".format(
+            self.sqs_timeout,
+            self.heartbeat_interval,
+            self._run_time(),
+            self.hard_timeout,
+            preview(self._message.body),
+            self._message.attributes,
+        )
+
+    @abstractmethod
+    def running(self):
+        """
+        Detect whether the handler is stuck
+        :return: True if the handler is still making progress. False if it is stuck
+        """
+        pass
+
+    @abstractmethod
+    async def run(self):
+        """
+        Coroutine executing the task
+        """
+        pass
+
+
+class AsyncTaskManager:
+    """
+    Consume a queue with up to concurrency AsyncMessageHandlers running at once in one process.
+
+    def dispatch(task, kwargs, message):
+        if task == 'Webhook':
+            return WebhookHandler(message, sqs_timeout=30, heartbeat_interval=20, hard_timeout=300, **kwargs)
+
+    consumer = AsyncTaskManager(TaskManager(sqs_url), concurrency=200)
+    loop.add_signal_handler(signal.SIGTERM, consumer.stop)
+    await consumer.run(dispatch)
+
+    Messages are received in batches of up to 10 while there are free slots. Delayed tasks are deferred as by the
+    TaskManager task_generator. Coalesced envelopes and FIFO queues are not supported: the tasks of an envelope or of a
+    message group would run out of order.
+    """
+
+    def __init__(
+        self,
+        task_manager,
+        concurrency=100,
+        wait_time=20,
+        sqs_timeout=30,
+        batch_interval=0.5,
+        executor=None,
+    ):
+        """
+        :param task_manager: the TaskManager of the queue
+        :param concurrency: the maximum number of handlers running at once
+        :param wait_time: time to wait for messages if none are immediately available (max is 20 seconds)
+        :param sqs_timeout: visibility timeout of received messages until their handler starts
+        :param batch_interval: the maximum seconds an ack or heartbeat waits for a batch to fill
+        :param executor: the executor for the blocking SQS calls, the default executor of the loop if None
+        """
+        if task_manager.fifo:
+            raise ValueError(
+                "FIFO queue {} is not supported by the AsyncTaskManager".format(
+                    task_manager.url
+                )
+            )
+
+        if concurrency < 1:
+            raise ValueError(
+                "Invalid concurrency {}; must be greater than zero".format(concurrency)
+            )
+
+        if 0 > wait_time or wait_time > 20:
+            raise ValueError(
+                "Invalid polling wait time {}; must be between 0 and 20".format(
+                    wait_time
+                )
+            )
+
+        self.task_manager = task_manager
+        self.concurrency = concurrency
+        self.wait_time = wait_time
+        self.sqs_timeout = sqs_timeout
+        self.batch_interval = batch_interval
+        self.executor = executor
+        self._stopped = False
+        self._tasks = set()
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    def stop(self):
+        """
+        Stop receiving messages; run returns once the handlers in flight have finished
+        """
+        self._stopped = True
+
+    async def run(self, dispatch):
+        """
+        :param dispatch: callable of task, kwargs and message returning the AsyncMessageHandler for the task, or None
+                         to leave the message for SQS to retry
+        """
+        loop = asyncio.get_running_loop()
+        batcher = SqsBatcher(
+            self.task_manager.queue,
+            interval=self.batch_interval,
+            executor=self.executor,
+        )
+        logger.info("Starting async consumer with concurrency %d", self.concurrency)
+        try:
+            while not self._stopped:
+                if len(self._tasks) >= self.concurrency:
+                    await asyncio.wait(
+                        set(self._tasks), return_when=asyncio.FIRST_COMPLETED
+                    )
+                    continue
+
+                messages = await loop.run_in_executor(
+                    self.executor,
+                    partial(
+                        self.task_manager.queue.receive_messages,
+                        AttributeNames=["All"],
+                        MessageAttributeNames=["All"],
+                        MaxNumberOfMessages=min(
+                            MAX_BATCH_ENTRIES, self.concurrency - len(self._tasks)
+                        ),
+                        WaitTimeSeconds=self.wait_time,
+                        VisibilityTimeout=self.sqs_timeout,
+                    ),
+                )  # Do not handle exceptions - bomb out and restart the container process
+
+                if not messages:
+                    logger.info("Waiting for work from SQS!")
+
+                for message in messages:
+                    handler = await self._dispatch(dispatch, message)
+                    if handler is not None:
+                        handler.batcher = batcher
+                        task = asyncio.ensure_future(self._process(handler))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._task_done)
+
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+        finally:
+            await batcher.close()
+        logger.info("Stopped async consumer")
+
+    async def _dispatch(self, dispatch, message):
+        try:
+            content = json.loads(message.body)
+            if TASKS in content:
+                raise ValueError("Coalesced envelopes are not supported")
+
+            if await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.task_manager._defer, message, content
+            ):
+                return None
+
+            task, kwargs = content["task"], content["kwargs"]
+        except (JSONDecodeError, KeyError, ValueError) as e:
+            self.task_manager.notify(e, context=partial(message_context, message))
+            logger.exception(
+                "failed to decode message %s with %s",
+                Preview(message.body),
+                message.attributes,
+                extra=message_fields(message),
+            )
+            return None
+
+        loop = asyncio.get_running_loop()
+        cache = self.task_manager.result_cache
+        if cache is not None and await loop.run_in_executor(
+            self.executor, cache.contains, task, kwargs
+        ):
+            await loop.run_in_executor(
+                self.executor, self.task_manager._ack_cached, task, message
+            )
+            return None
+
+        handler = dispatch(task, kwargs, message)
+        if handler is None:
+            logger.warning("No handler for task %s: %s", task, message)
+        return handler
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        # Retrieve the exception so that it is logged here rather than never
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Unhandled error processing a message", exc_info=task.exception()
+            )
+
+    @staticmethod
+    async def _process(handler):
+        try:
+            async with handler:
+                await handler.run()
+        except Exception as e:
+            # Raised by __aenter__, before the handler reports its own errors; SQS retries the message
+            handler.notify(e, context=handler._context())
+            logger.exception("failed to start handler %s", handler)
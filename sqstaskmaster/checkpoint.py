@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+from abc import ABC, abstractmethod
+from json import JSONDecodeError
+
+import boto3
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.dedupe import task_hash
+
+logger = logging.getLogger(__name__)
+"""
+Checkpoints let a long running handler resume after a hard timeout, a spot reclaim or a scale in instead of redoing
+the whole task. The run method saves its state periodically with MessageHandler.checkpoint, a redelivery of the same
+task restores the latest state with MessageHandler.restore, and the checkpoint is deleted when the message is acked.
+"""
+
+
+def checkpoint_key(message):
+    """
+    :return: the hash of the task and kwargs of the message, so that every delivery of the task has the same key
+    """
+    try:
+        content = json.loads(message.body)
+        return task_hash(content["task"], content["kwargs"])
+    except (JSONDecodeError, KeyError, TypeError):
+        return hashlib.sha256(message.body.encode("utf-8")).hexdigest()
+
+
+class CheckpointStore(ABC):
+    """
+    Storage for the latest checkpoint of each task. States must be json serializable.
+    """
+
+    @abstractmethod
+    def save(self, key, state):
+        """
+        Store the state, replacing the previous checkpoint of the key
+        """
+
+    @abstractmethod
+    def load(self, key):
+        """
+        :return: the latest state of the key or None
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """
+        Remove the checkpoint of the key if there is one
+        """
+
+
+class MemoryCheckpointStore(CheckpointStore):
+    """
+    Checkpoints in memory, a local stand in for tests
+    """
+
+    def __init__(self):
+        self.checkpoints = {}
+
+    def save(self, key, state):
+        # Encode to keep the behavior of the other stores
+        self.checkpoints[key] = json.dumps(state)
+
+    def load(self, key):
+        data = self.checkpoints.get(key)
+        return None if data is None else json.loads(data)
+
+    def delete(self, key):
+        self.checkpoints.pop(key, None)
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    One json file per task in a directory, for instance on a volume that outlives the container.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, "{}.json".format(key))
+
+    def save(self, key, state):
+        path = self._path(key)
+        # Write then rename so an interrupted save leaves the previous checkpoint
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "w") as fh:
+            json.dump(state, fh)
+        os.replace(tmp_path, path)
+
+    def load(self, key):
+        try:
+            with open(self._path(key)) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3CheckpointStore(CheckpointStore):
+    """
+    One json object per task in an S3 bucket, so that any worker can resume the task.
+    """
+
+    def __init__(self, bucket, prefix="sqstaskmaster/checkpoints/", client=None):
+        """
+        :param bucket: the bucket name
+        :param prefix: the key prefix of the checkpoint objects
+        :param client: the boto3 S3 client, a new client by default
+        """
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client or boto3.client("s3")
+
+    def _key(self, key):
+        return "{}{}.json".format(self.prefix, key)
+
+    def save(self, key, state):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._key(key),
+            Body=json.dumps(state).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def load(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as ce:
+            if ce.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(response["Body"].read().decode("utf-8"))
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
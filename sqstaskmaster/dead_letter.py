@@ -0,0 +1,336 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from json import JSONDecodeError
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.fifo import MESSAGE_DEDUPLICATION_ID, MESSAGE_GROUP_ID
+from sqstaskmaster.rate_limit import MemoryBucketStore
+from sqstaskmaster.sqlite import transaction
+from sqstaskmaster.task_manager import MAX_BATCH_ENTRIES, MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+"""
+Redrive of the messages in a dead letter queue. Messages are received ten at a time, filtered by task name, age or any
+property of the message, re-sent to the source queue with send_messages and deleted with delete_messages. A dry run
+writes the matching messages to a local file instead. Progress is checkpointed to a SQLite file, so a redrive that is
+interrupted between the send and the delete does not send the message again when it is resumed.
+"""
+
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ReceiveMessage.html
+SENT_TIMESTAMP = "SentTimestamp"
+
+
+class RedriveCheckpoint:
+    """
+    The ids of the messages already re-sent or written, stored in a SQLite database file.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS redriven (message_id TEXT PRIMARY KEY)"
+            )
+
+    def done(self, message_ids):
+        """
+        :return: the set of message_ids already redriven
+        """
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+        with transaction(self.path, self.timeout) as connection:
+            rows = connection.execute(
+                "SELECT message_id FROM redriven WHERE message_id IN ({})".format(
+                    ",".join("?" * len(message_ids))
+                ),
+                message_ids,
+            )
+            return {row[0] for row in rows}
+
+    def add(self, message_ids):
+        with transaction(self.path, self.timeout) as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO redriven VALUES (?)",
+                [(message_id,) for message_id in message_ids],
+            )
+
+
+class RedriveStats:
+    def __init__(self):
+        self.received = 0
+        self.matched = 0
+        self.sent = 0
+        self.failed = 0
+
+    def __str__(self):
+        return "RedriveStats(received: {}; matched: {}; sent: {}; failed: {})".format(
+            self.received, self.matched, self.sent, self.failed
+        )
+
+
+class Redrive:
+    """
+    Re-send the messages of a dead letter queue. Usually run with TaskManager.redrive:
+
+    stats = TaskManager(sqs_url).redrive(dlq_url, tasks={'Export'}, max_age=24 * 60 * 60, rate=50,
+                                         checkpoint='/tmp/redrive.db')
+
+    Messages that do not match are left in the dead letter queue; they are not received again until the visibility
+    timeout expires, which should cover the whole run. The redrive stops once empty_receives receives in a row return
+    no new message.
+    """
+
+    def __init__(
+        self,
+        dead_letter,
+        target,
+        tasks=None,
+        predicate=None,
+        min_age=None,
+        max_age=None,
+        rate=None,
+        dry_run=None,
+        checkpoint=None,
+        limit=None,
+        visibility_timeout=60 * 60,
+        wait_time=1,
+        empty_receives=3,
+    ):
+        """
+        :param dead_letter: the TaskManager of the dead letter queue
+        :param target: the TaskManager of the queue the messages are sent to
+        :param tasks: optional names of the tasks to redrive
+        :param predicate: optional callable of the message and its decoded body, None if it is not json, returning
+                          whether to redrive the message, for instance by its ApproximateReceiveCount attribute or
+                          the error_type and error_message message attributes set by a RetryPolicy
+        :param min_age: optional seconds since the message was first sent before it is redriven
+        :param max_age: optional seconds since the message was first sent after which it is not redriven
+        :param rate: optional messages per second sent to the target queue
+        :param dry_run: optional path of a file the matching messages are appended to as json lines instead of being
+                        sent and deleted; a dry run reads but does not update the checkpoint
+        :param checkpoint: optional path of the SQLite checkpoint file
+        :param limit: optional number of matching messages after which the redrive stops
+        :param visibility_timeout: seconds received messages stay hidden from the next receives
+        :param wait_time: long polling wait time of each receive
+        :param empty_receives: receives in a row without a new message before the redrive stops
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError("Rate {} must be greater than zero".format(rate))
+
+        if empty_receives < 1:
+            raise ValueError(
+                "Empty receives {} must be greater than zero".format(empty_receives)
+            )
+
+        if target.fifo and not dead_letter.fifo:
+            raise ValueError(
+                "Cannot redrive standard queue {} to FIFO queue {}".format(
+                    dead_letter.url, target.url
+                )
+            )
+
+        self.dead_letter = dead_letter
+        self.target = target
+        self.tasks = frozenset(tasks) if tasks is not None else None
+        self.predicate = predicate
+        self.min_age = min_age
+        self.max_age = max_age
+        self.rate = rate
+        self.dry_run = dry_run
+        self.checkpoint = RedriveCheckpoint(checkpoint) if checkpoint else None
+        self.limit = limit
+        self.visibility_timeout = visibility_timeout
+        self.wait_time = wait_time
+        self.empty_receives = empty_receives
+        self.stats = RedriveStats()
+        self._buckets = MemoryBucketStore()
+
+    def matches(self, message):
+        try:
+            content = json.loads(message.body)
+        except JSONDecodeError:
+            content = None
+
+        if self.tasks is not None and (
+            not isinstance(content, dict) or content.get("task") not in self.tasks
+        ):
+            return False
+
+        sent = message.attributes.get(SENT_TIMESTAMP)
+        if sent is not None and (self.min_age is not None or self.max_age is not None):
+            age = time.time() - int(sent) / 1000
+            if self.min_age is not None and age < self.min_age:
+                return False
+            if self.max_age is not None and age > self.max_age:
+                return False
+
+        return self.predicate is None or self.predicate(message, content)
+
+    def _receive(self):
+        return self.dead_letter.queue.receive_messages(
+            AttributeNames=["All"],
+            MessageAttributeNames=["All"],
+            MaxNumberOfMessages=MAX_BATCH_ENTRIES,
+            WaitTimeSeconds=self.wait_time,
+            VisibilityTimeout=self.visibility_timeout,
+        )
+
+    def run(self):
+        """
+        :return: RedriveStats
+        """
+        seen = set()
+        empty = 0
+        with self._open_sink() as sink:
+            while self.limit is None or self.stats.matched < self.limit:
+                messages = [m for m in self._receive() if m.message_id not in seen]
+                if not messages:
+                    empty += 1
+                    if empty >= self.empty_receives:
+                        break
+                    continue
+
+                empty = 0
+                seen.update(m.message_id for m in messages)
+                self.stats.received += len(messages)
+
+                matched = [m for m in messages if self.matches(m)]
+                if self.limit is not None:
+                    matched = matched[: self.limit - self.stats.matched]
+                self.stats.matched += len(matched)
+                self._redrive(matched, sink)
+
+                if self.stats.received % 1000 < len(messages):
+                    logger.info("Redrive progress %s", self.stats)
+
+        logger.info("Finished redrive from %s: %s", self.dead_letter.url, self.stats)
+        return self.stats
+
+    @contextmanager
+    def _open_sink(self):
+        if self.dry_run is None:
+            yield None
+            return
+        with open(self.dry_run, "a") as fh:
+            yield fh
+
+    def _redrive(self, messages, sink):
+        if self.checkpoint is not None and messages:
+            done = self.checkpoint.done(m.message_id for m in messages)
+            if done:
+                # Sent before an interruption; only the delete is missing
+                resent = [m for m in messages if m.message_id in done]
+                messages = [m for m in messages if m.message_id not in done]
+                if sink is None:
+                    self._delete(resent)
+
+        if not messages:
+            return
+
+        if sink is not None:
+            for message in messages:
+                sink.write(
+                    json.dumps(
+                        {
+                            "message_id": message.message_id,
+                            "body": message.body,
+                            "attributes": message.attributes,
+                            "message_attributes": message.message_attributes,
+                        }
+                    )
+                    + "\n"
+                )
+            sink.flush()
+            # Not checkpointed, the messages are still in the dead letter queue for the real redrive
+            self.stats.sent += len(messages)
+            return
+
+        for batch in self._batches(messages):
+            self._throttle(len(batch))
+            sent = self._send(batch)
+            self._record(sent)
+            self._delete(sent)
+
+    def _batches(self, messages):
+        batch, size = [], 0
+        for message in messages:
+            message_size = len(message.body.encode("utf-8")) + len(
+                json.dumps(message.message_attributes or {})
+            )
+            if batch and size + message_size > MAX_BATCH_SIZE:
+                yield batch
+                batch, size = [], 0
+            batch.append(message)
+            size += message_size
+        if batch:
+            yield batch
+
+    def _throttle(self, count):
+        if self.rate is None:
+            return
+        burst = max(self.rate, MAX_BATCH_ENTRIES)
+        wait = self._buckets.take("redrive", self.rate, burst, count)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._buckets.take("redrive", self.rate, burst, count)
+
+    def _entry(self, index, message):
+        entry = {
+            "Id": str(index),
+            "MessageBody": message.body,
+            "MessageAttributes": message.message_attributes or {},
+        }
+        if self.target.fifo:
+            entry[MESSAGE_GROUP_ID] = message.attributes[MESSAGE_GROUP_ID]
+            # A retried redrive of the message is dropped by the target queue
+            entry[MESSAGE_DEDUPLICATION_ID] = message.message_id
+        return entry
+
+    def _send(self, messages):
+        """
+        :return: the messages that were sent
+        """
+        try:
+            response = self.target.queue.send_messages(
+                Entries=[self._entry(i, m) for i, m in enumerate(messages)]
+            )
+        except ClientError as ce:
+            self.stats.failed += len(messages)
+            self.target.notify(ce, context={"queue": self.target.url})
+            logger.exception("failed to redrive %d messages", len(messages))
+            return []
+
+        failed = {failure["Id"] for failure in response.get("Failed", [])}
+        if failed:
+            self.stats.failed += len(failed)
+            logger.warning("Failed to redrive entries: %s", response["Failed"])
+        sent = [m for i, m in enumerate(messages) if str(i) not in failed]
+        self.stats.sent += len(sent)
+        return sent
+
+    def _record(self, messages):
+        if self.checkpoint is not None and messages:
+            self.checkpoint.add(m.message_id for m in messages)
+
+    def _delete(self, messages):
+        if not messages:
+            return
+        try:
+            response = self.dead_letter.queue.delete_messages(
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": m.receipt_handle}
+                    for i, m in enumerate(messages)
+                ]
+            )
+        except ClientError as ce:
+            self.dead_letter.notify(ce, context={"queue": self.dead_letter.url})
+            logger.exception("failed to delete %d redriven messages", len(messages))
+            return
+
+        if response.get("Failed"):
+            logger.warning("Failed to delete redriven entries: %s", response["Failed"])
@@ -0,0 +1,311 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.sqlite import transaction
+
+logger = logging.getLogger(__name__)
+"""
+Duplicate suppression for at least once delivery. A task is claimed with a lease before it is yielded to the
+consumer; the lease is renewed with the message visibility and marked completed when the message is deleted.
+Another delivery of the same task is acked without running while it is completed, or skipped while it is in progress
+elsewhere.
+"""
+
+ACQUIRED = "acquired"
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+
+def task_hash(task, kwargs):
+    """
+    :return: a canonical hash of the task name and kwargs
+    """
+    content = json.dumps(
+        {"task": task, "kwargs": kwargs},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=lambda o: o.__str__(),
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def content_key(task, kwargs, message):
+    return task_hash(task, kwargs)
+
+
+def message_key(task, kwargs, message):
+    return message.message_id
+
+
+class DedupeStore(ABC):
+    """
+    Storage for task leases and completion markers.
+    """
+
+    @abstractmethod
+    def acquire(self, key, lease):
+        """
+        Take a lease on the key if it is neither completed nor leased
+        :param key: the task key
+        :param lease: seconds until the lease expires
+        :return: ACQUIRED, IN_PROGRESS or COMPLETED
+        """
+
+    @abstractmethod
+    def renew(self, key, lease):
+        """
+        Extend the lease on the key
+        """
+
+    @abstractmethod
+    def release(self, key):
+        """
+        Drop the lease so that the task can be run again
+        """
+
+    @abstractmethod
+    def complete(self, key):
+        """
+        Mark the task completed for the ttl of the store
+        """
+
+
+class MemoryDedupeStore(DedupeStore):
+    """
+    In process LRU of at most max_size keys. Protects against redelivery to the same worker only.
+    """
+
+    def __init__(self, max_size=10000, ttl=24 * 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        state, expires = entry
+        if expires <= now:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return state
+
+    def _set(self, key, state, expires):
+        self._entries[key] = (state, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def acquire(self, key, lease):
+        now = time.time()
+        with self._lock:
+            state = self._get(key, now)
+            if state is not None:
+                return state
+            self._set(key, IN_PROGRESS, now + lease)
+            return ACQUIRED
+
+    def renew(self, key, lease):
+        with self._lock:
+            if self._get(key, time.time()) != COMPLETED:
+                self._set(key, IN_PROGRESS, time.time() + lease)
+
+    def release(self, key):
+        with self._lock:
+            if self._get(key, time.time()) == IN_PROGRESS:
+                del self._entries[key]
+
+    def complete(self, key):
+        with self._lock:
+            self._set(key, COMPLETED, time.time() + self.ttl)
+
+
+class SQLiteDedupeStore(DedupeStore):
+    """
+    Leases stored in a SQLite database file.
+    """
+
+    def __init__(self, path, ttl=24 * 60 * 60, timeout=30):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS dedupe (key TEXT PRIMARY KEY, state TEXT, expires REAL)"
+            )
+
+    def acquire(self, key, lease):
+        now = time.time()
+        with transaction(self.path, self.timeout) as connection:
+            row = connection.execute(
+                "SELECT state FROM dedupe WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                return row[0]
+
+            connection.execute(
+                "INSERT OR REPLACE INTO dedupe VALUES (?, ?, ?)",
+                (key, IN_PROGRESS, now + lease),
+            )
+            return ACQUIRED
+
+    def renew(self, key, lease):
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO dedupe SELECT ?, ?, ? WHERE NOT EXISTS "
+                "(SELECT 1 FROM dedupe WHERE key = ? AND state = ?)",
+                (key, IN_PROGRESS, time.time() + lease, key, COMPLETED),
+            )
+
+    def release(self, key):
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "DELETE FROM dedupe WHERE key = ? AND state = ?", (key, IN_PROGRESS)
+            )
+
+    def complete(self, key):
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO dedupe VALUES (?, ?, ?)",
+                (key, COMPLETED, time.time() + self.ttl),
+            )
+
+    def purge_expired(self):
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute("DELETE FROM dedupe WHERE expires <= ?", (time.time(),))
+
+
+class KeyValueDedupeStore(DedupeStore):
+    """
+    Leases stored in a remote key value store shared by all workers. The client must implement the redis-py methods
+    set(name, value, nx=False, ex=None), get(name) and delete(name), for instance redis.Redis(decode_responses=True).
+    """
+
+    def __init__(self, client, ttl=24 * 60 * 60, prefix="sqstaskmaster:dedupe:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def acquire(self, key, lease):
+        name = self.prefix + key
+        if self.client.set(name, IN_PROGRESS, nx=True, ex=int(lease)):
+            return ACQUIRED
+        # The key may have expired since the set
+        return self.client.get(name) or IN_PROGRESS
+
+    def renew(self, key, lease):
+        name = self.prefix + key
+        if self.client.get(name) != COMPLETED:
+            self.client.set(name, IN_PROGRESS, ex=int(lease))
+
+    def release(self, key):
+        name = self.prefix + key
+        if self.client.get(name) == IN_PROGRESS:
+            self.client.delete(name)
+
+    def complete(self, key):
+        self.client.set(self.prefix + key, COMPLETED, ex=int(self.ttl))
+
+
+class LeasedMessage:
+    """
+    Wraps the SQS message of a claimed task. The lease follows the message visibility and the task is marked
+    completed when the message is deleted.
+    """
+
+    def __init__(self, message, store, key):
+        self._message = message
+        self._store = store
+        self.key = key
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    def change_visibility(self, VisibilityTimeout, **kwargs):
+        self._message.change_visibility(VisibilityTimeout=VisibilityTimeout, **kwargs)
+        if VisibilityTimeout > 0:
+            self._store.renew(self.key, VisibilityTimeout)
+        else:
+            self._store.release(self.key)
+
+    def delete(self):
+        self._message.delete()
+        self._store.complete(self.key)
+
+    def release(self):
+        """
+        Drop the lease of a failed task so that the next delivery runs it
+        """
+        self._store.release(self.key)
+
+    def __str__(self):
+        return "LeasedMessage(key: {}; message: {})".format(self.key, self._message)
+
+
+class Deduplicator:
+    """
+    Opt in duplicate suppression for TaskManager.task_generator.
+
+    dedupe = Deduplicator(SQLiteDedupeStore('/tmp/dedupe.db'), key=content_key)
+    for task, kwargs, message in tm.task_generator(sqs_timeout=30, dedupe=dedupe):
+        ...
+    """
+
+    def __init__(self, store, key=content_key, in_progress_visibility=60):
+        """
+        :param store: the DedupeStore
+        :param key: callable of task, kwargs and message returning the key; content_key or message_key
+        :param in_progress_visibility: seconds before a skipped duplicate of a task in progress elsewhere is received
+                                       again, instead of the sqs timeout of the receive
+        """
+        if in_progress_visibility < 0:
+            raise ValueError(
+                "In progress visibility {} must be greater than or equal to zero".format(
+                    in_progress_visibility
+                )
+            )
+
+        self.store = store
+        self.key = key
+        self.in_progress_visibility = in_progress_visibility
+
+    def claim(self, task, kwargs, message, lease):
+        """
+        :param lease: seconds until the lease expires unless the message visibility is extended
+        :return: the LeasedMessage to process or None if the task must be skipped
+        """
+        key = self.key(task, kwargs, message)
+        state = self.store.acquire(key, lease)
+        if state == ACQUIRED:
+            return LeasedMessage(message, self.store, key)
+
+        if state == COMPLETED:
+            logger.info("Acking duplicate of completed task %s: %s", task, message)
+            try:
+                message.delete()
+            except ClientError:
+                # The message is received again and acked once the delete succeeds
+                logger.exception(
+                    "Failed to ack duplicate of task %s: %s", task, message
+                )
+        else:
+            logger.info("Skipping task %s in progress elsewhere: %s", task, message)
+            try:
+                # Check again soon in case the lease is about to be released
+                message.change_visibility(VisibilityTimeout=self.in_progress_visibility)
+            except ClientError:
+                logger.exception(
+                    "Failed to defer duplicate of task %s: %s", task, message
+                )
+        return None
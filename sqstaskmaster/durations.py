@@ -0,0 +1,243 @@
+import json
+import logging
+import math
+import os
+import threading
+
+from sqstaskmaster.retry import MAX_VISIBILITY_TIMEOUT
+
+logger = logging.getLogger(__name__)
+"""
+Timeouts chosen from observed task durations. Short timeouts cost alarms and change_visibility calls, long timeouts
+hold the message of a crashed worker until they expire. The duration quantile of each task name is tracked with a
+streaming P² estimate and the sqs timeout is set to cover it, bounded by the retry latency that is acceptable after a
+crash, so most tasks finish without a single extension.
+"""
+
+
+class P2Quantile:
+    """
+    Streaming estimate of a quantile with five markers and constant memory, the P² algorithm of Jain and Chlamtac,
+    https://www.cse.wustl.edu/~jain/papers/ftp/psqr.pdf
+    """
+
+    def __init__(self, q):
+        """
+        :param q: the quantile in (0, 1)
+        """
+        if not 0 < q < 1:
+            raise ValueError("Quantile {} must be between 0 and 1".format(q))
+
+        self.q = q
+        self.count = 0
+        # Marker heights, positions and desired positions once there are five values
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+        self.increments = [0, q / 2, q, (1 + q) / 2, 1]
+
+    def add(self, x):
+        self.count += 1
+        heights = self.heights
+        if self.count <= 5:
+            heights.append(x)
+            heights.sort()
+            return
+
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if heights[i] <= x < heights[i + 1])
+
+        positions = self.positions
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (
+                d <= -1 and positions[i - 1] - positions[i] < -1
+            ):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + d * (heights[i + d] - heights[i]) / (
+                        positions[i + d] - positions[i]
+                    )
+                heights[i] = height
+                positions[i] += d
+
+    def _parabolic(self, i, d):
+        n, h = self.positions, self.heights
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self):
+        """
+        :return: the estimate, exact for the first five values, or None without values
+        """
+        if not self.heights:
+            return None
+        if self.count <= 5:
+            # Nearest rank
+            return self.heights[
+                min(self.count - 1, max(0, math.ceil(self.q * self.count) - 1))
+            ]
+        return self.heights[2]
+
+    def to_dict(self):
+        return {
+            "q": self.q,
+            "count": self.count,
+            "heights": self.heights,
+            "positions": self.positions,
+            "desired": self.desired,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        estimate = cls(data["q"])
+        estimate.count = data["count"]
+        estimate.heights = list(data["heights"])
+        estimate.positions = list(data["positions"])
+        estimate.desired = list(data["desired"])
+        return estimate
+
+
+class AdaptiveTimeouts:
+    """
+    Per task name sqs and alarm timeouts from the observed durations of successful runs.
+
+    adaptive = AdaptiveTimeouts(quantile=0.95, max_retry_latency=600)
+    for task, kwargs, message in tm.task_generator(sqs_timeout=30):
+        with MyHandler(message, hard_timeout=3600, **adaptive.handler_kwargs(task), **kwargs) as handler:
+            handler.run()
+
+    The sqs timeout covers the duration quantile with a margin, so that most runs need no extension, but no more than
+    max_retry_latency, which bounds the time until a message held by a crashed worker is retried. Longer runs are
+    extended every alarm_timeout seconds. Until min_samples runs of a task are recorded the default timeouts are used.
+    """
+
+    def __init__(
+        self,
+        quantile=0.9,
+        margin=1.25,
+        min_timeout=30,
+        max_retry_latency=15 * 60,
+        min_samples=10,
+        default=(30, 25),
+    ):
+        """
+        :param quantile: the duration quantile covered by the sqs timeout
+        :param margin: factor applied to the duration quantile
+        :param min_timeout: the shortest sqs timeout
+        :param max_retry_latency: the longest sqs timeout
+        :param min_samples: the runs recorded before the durations are used
+        :param default: the sqs and alarm timeouts until then
+        """
+        if not min_timeout < max_retry_latency <= MAX_VISIBILITY_TIMEOUT:
+            raise ValueError(
+                "Invalid timeouts {} and {}; must be increasing up to {}".format(
+                    min_timeout, max_retry_latency, MAX_VISIBILITY_TIMEOUT
+                )
+            )
+
+        if min_timeout < 3:
+            raise ValueError(
+                "Min timeout {} must be at least 3 seconds".format(min_timeout)
+            )
+
+        if not 0 < quantile < 1:
+            raise ValueError("Quantile {} must be between 0 and 1".format(quantile))
+
+        self.quantile = quantile
+        self.margin = margin
+        self.min_timeout = min_timeout
+        self.max_retry_latency = max_retry_latency
+        self.min_samples = min_samples
+        self.default = default
+        self._estimates = {}
+        self._lock = threading.Lock()
+
+    def record(self, task, seconds):
+        """
+        Record the duration of a successful run of the task
+        """
+        with self._lock:
+            estimate = self._estimates.get(task)
+            if estimate is None:
+                estimate = self._estimates[task] = P2Quantile(self.quantile)
+            estimate.add(seconds)
+
+    def recorder(self, task):
+        """
+        :return: callable of the duration recording runs of the task, for the duration_recorder of a MessageHandler
+        """
+        return lambda seconds: self.record(task, seconds)
+
+    def duration(self, task):
+        """
+        :return: the estimated duration quantile of the task, or None
+        """
+        with self._lock:
+            estimate = self._estimates.get(task)
+            return None if estimate is None else estimate.value()
+
+    def count(self, task):
+        with self._lock:
+            estimate = self._estimates.get(task)
+            return 0 if estimate is None else estimate.count
+
+    def timeouts(self, task):
+        """
+        :return: tuple of the sqs timeout and the alarm timeout for the task
+        """
+        if self.count(task) < self.min_samples:
+            return self.default
+
+        sqs_timeout = min(
+            self.max_retry_latency,
+            max(self.min_timeout, math.ceil(self.duration(task) * self.margin)),
+        )
+        # Extend with a tenth of the timeout to spare for the change_visibility call
+        alarm_timeout = min(sqs_timeout - 2, math.floor(sqs_timeout * 0.9))
+        return sqs_timeout, alarm_timeout
+
+    def handler_kwargs(self, task):
+        """
+        :return: dict of the sqs_timeout, alarm_timeout and duration_recorder arguments of a MessageHandler
+        """
+        sqs_timeout, alarm_timeout = self.timeouts(task)
+        return {
+            "sqs_timeout": sqs_timeout,
+            "alarm_timeout": alarm_timeout,
+            "duration_recorder": self.recorder(task),
+        }
+
+    def save(self, path):
+        """
+        Write the estimates as json, replacing the file atomically, so that a restarted worker keeps them
+        """
+        with self._lock:
+            data = {task: e.to_dict() for task, e in self._estimates.items()}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path) as fh:
+            data = json.load(fh)
+        with self._lock:
+            self._estimates = {
+                task: P2Quantile.from_dict(estimate) for task, estimate in data.items()
+            }
+        return self
@@ -0,0 +1,210 @@
+import json
+import logging
+import math
+from functools import partial
+
+logger = logging.getLogger(__name__)
+"""
+Coalescing of many small tasks into a single SQS message (an envelope) to amortize the send, receive, delete and
+visibility calls. The envelope body is a json object with a list of task objects:
+
+    {"tasks": [{"task": "MyTask", "kwargs": {...}}, {"task": "MyTask", "kwargs": {...}, "receives": 1}]}
+
+The optional receives field counts the deliveries of a sub task in earlier envelopes.
+"""
+
+TASKS = "tasks"
+RECEIVES = "receives"
+
+# The SQS limit is 256 KiB including message attributes
+MAX_ENVELOPE_SIZE = 250 * 1024
+
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-message-timers.html
+MAX_DELAY_SECONDS = 15 * 60
+
+
+def pack(bodies):
+    """
+    :param bodies: json encoded task objects
+    :return: the json encoded envelope
+    """
+    return '{"' + TASKS + '": [' + ", ".join(bodies) + "]}"
+
+
+class Coalescer:
+    """
+    Buffer json encoded tasks and send them as envelopes no larger than max_size bytes.
+    Tasks that do not fit in an envelope on their own are sent as plain messages.
+    """
+
+    def __init__(self, send, max_size=MAX_ENVELOPE_SIZE):
+        """
+        :param send: method taking a message body and returning the send_message response
+        :param max_size: maximum size of the envelope body in bytes
+        """
+        self._send = send
+        self.max_size = max_size
+        self._bodies = []
+        self._size = len(pack([]))
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def add(self, body):
+        """
+        :param body: json encoded task object
+        :return: the send_message response if the buffer was sent, otherwise None
+        """
+        size = len(body.encode("utf-8"))
+        if len(pack([])) + size > self.max_size:
+            self.flush()
+            return self._send(body)
+
+        # Separator between tasks
+        separator = 2 if self._bodies else 0
+        response = None
+        if self._size + separator + size > self.max_size:
+            response = self.flush()
+            separator = 0
+
+        self._bodies.append(body)
+        self._size += separator + size
+        return response
+
+    def flush(self):
+        """
+        Send the buffered tasks
+        :return: the send_message response or None if the buffer was empty
+        """
+        if not self._bodies:
+            return None
+
+        body = pack(self._bodies)
+        logger.debug("Sending envelope with %d tasks", len(self._bodies))
+        self._bodies = []
+        self._size = len(pack([]))
+        return self._send(body)
+
+
+class SubMessage:
+    """
+    A task unpacked from an envelope. Implements the parts of the SQS Message interface used by the MessageHandler.
+
+    Deleting the sub message marks the task as done; the envelope is deleted once every task is resolved. Visibility
+    changes extend the envelope, but a visibility of 0 is ignored since it would release the other tasks in the
+    envelope while they are still being processed. The last visibility is kept as the delay of the task when it is
+    re-enqueued, so a task is retried when SQS would retry it as a message of its own, for instance after the backoff
+    of a RetryPolicy.
+    """
+
+    def __init__(self, envelope, index, content):
+        self._envelope = envelope
+        self._index = index
+        self._content = content
+        self.done = False
+        self.visibility = None
+
+    @property
+    def task(self):
+        return self._content["task"]
+
+    @property
+    def kwargs(self):
+        return self._content["kwargs"]
+
+    @property
+    def content(self):
+        return self._content
+
+    @property
+    def body(self):
+        return json.dumps(
+            {"task": self._content["task"], "kwargs": self._content["kwargs"]}
+        )
+
+    @property
+    def attributes(self):
+        attributes = dict(self._envelope.message.attributes or {})
+        receives = int(attributes.get("ApproximateReceiveCount", 1))
+        attributes["ApproximateReceiveCount"] = str(
+            receives + self._content.get(RECEIVES, 0)
+        )
+        return attributes
+
+    @property
+    def message_attributes(self):
+        return self._envelope.message.message_attributes
+
+    @property
+    def message_id(self):
+        return "{}:{}".format(self._envelope.message.message_id, self._index)
+
+    def change_visibility(self, VisibilityTimeout, **kwargs):
+        self.visibility = VisibilityTimeout
+        if VisibilityTimeout > 0:
+            self._envelope.message.change_visibility(
+                VisibilityTimeout=VisibilityTimeout, **kwargs
+            )
+        else:
+            logger.info("Not releasing envelope for sub message %s", self)
+
+    def delete(self):
+        self.done = True
+
+    def __str__(self):
+        return "SubMessage(index: {}; envelope: {})".format(
+            self._index, self._envelope.message
+        )
+
+
+class Envelope:
+    """
+    Tracks the tasks of a received envelope message.
+    """
+
+    def __init__(self, message, tasks):
+        """
+        :param message: the SQS message
+        :param tasks: the decoded list of task objects
+        """
+        self.message = message
+        self.sub_messages = [
+            SubMessage(self, index, content) for index, content in enumerate(tasks)
+        ]
+
+    def __iter__(self):
+        return iter(self.sub_messages)
+
+    def pending(self):
+        return [sub for sub in self.sub_messages if not sub.done]
+
+    def resolve(self, send):
+        """
+        Re-enqueue the tasks which are not done and delete the envelope. Tasks with a visibility are sent with it as
+        their delay, capped at the SQS maximum of 15 minutes.
+        Raises ClientError if the SQS calls fail, in which case the whole envelope is retried by SQS.
+        :param send: method taking a message body and optional DelaySeconds and sending it to the queue
+        """
+        pending = self.pending()
+        if pending:
+            logger.info(
+                "Re-enqueuing %d of %d tasks from envelope %s",
+                len(pending),
+                len(self.sub_messages),
+                self.message,
+            )
+            # One envelope per delay
+            coalescers = {}
+            for sub in pending:
+                delay = min(MAX_DELAY_SECONDS, math.ceil(sub.visibility or 0))
+                if delay not in coalescers:
+                    coalescers[delay] = Coalescer(
+                        partial(send, DelaySeconds=delay) if delay else send
+                    )
+                content = dict(sub.content)
+                content[RECEIVES] = int(sub.attributes["ApproximateReceiveCount"])
+                coalescers[delay].add(json.dumps(content))
+            for coalescer in coalescers.values():
+                coalescer.flush()
+
+        self.message.delete()
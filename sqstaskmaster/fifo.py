@@ -0,0 +1,79 @@
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+"""
+Helpers for FIFO queues. Messages in the same group are delivered in order and a group is locked while one of its
+messages is in flight, so different groups are processed in parallel while each entity is processed in order.
+"""
+
+FIFO_SUFFIX = ".fifo"
+MESSAGE_GROUP_ID = "MessageGroupId"
+MESSAGE_DEDUPLICATION_ID = "MessageDeduplicationId"
+
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_SendMessage.html
+MAX_ID_LENGTH = 128
+
+
+def is_fifo(url):
+    return url.endswith(FIFO_SUFFIX)
+
+
+def group_by_kwarg(name):
+    """
+    :return: a group id callable using the value of the kwarg name, for instance the entity id
+    """
+
+    def group_id(task, kwargs):
+        return str(kwargs[name])
+
+    return group_id
+
+
+def content_deduplication_id(task, kwargs, body):
+    """
+    A deduplication id from the hash of the message body, for queues without ContentBasedDeduplication
+    """
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def message_group(message):
+    return message.attributes.get(MESSAGE_GROUP_ID)
+
+
+def interleave_groups(messages):
+    """
+    Order messages round robin across their groups, keeping the order within each group
+    :return: list of messages
+    """
+    groups = OrderedDict()
+    for message in messages:
+        groups.setdefault(message_group(message), []).append(message)
+
+    result = []
+    depth = max((len(group) for group in groups.values()), default=0)
+    for index in range(depth):
+        result.extend(group[index] for group in groups.values() if index < len(group))
+    return result
+
+
+class TrackedMessage:
+    """
+    Wraps a message received in a batch from a FIFO queue and records whether it was deleted, so that the later
+    messages of the group can be released when it fails.
+    """
+
+    def __init__(self, message):
+        self._message = message
+        self.deleted = False
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    def delete(self):
+        self._message.delete()
+        self.deleted = True
+
+    def __str__(self):
+        return "TrackedMessage({})".format(self._message)
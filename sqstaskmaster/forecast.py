@@ -0,0 +1,229 @@
+import logging
+import os
+from array import array
+
+from sqstaskmaster.scaling import ScalingPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class DepthHistory:
+    """
+    Fixed size ring buffer of queue depth and arrival rate samples in compact arrays of doubles.
+
+    Samples closer than min_interval seconds to the previous sample are dropped, so the default of 10080 samples at one
+    minute intervals keeps a week of history in about 240KB. The arrival rate of a sample is the increase of the depth
+    per second since the previous sample; messages processed in the interval are not observed, so it is a lower bound.
+
+    EWMA estimates of the depth and arrival rate are updated with each sample.
+    """
+
+    def __init__(self, capacity=10080, min_interval=60, alpha=0.3):
+        """
+        :param capacity: maximum number of samples
+        :param min_interval: minimum seconds between samples
+        :param alpha: weight of the newest sample in the EWMA estimates
+        """
+        if capacity < 2:
+            raise ValueError("Capacity {} must be at least 2".format(capacity))
+
+        if not 0 < alpha <= 1:
+            raise ValueError("Alpha {} must be in (0, 1]".format(alpha))
+
+        self.capacity = capacity
+        self.min_interval = min_interval
+        self.alpha = alpha
+
+        self._times = array("d", bytes(8 * capacity))
+        self._depths = array("d", bytes(8 * capacity))
+        self._rates = array("d", bytes(8 * capacity))
+        self._start = 0
+        self._size = 0
+
+        self.ewma_depth = None
+        self.ewma_rate = None
+
+    def __len__(self):
+        return self._size
+
+    def _index(self, i):
+        return (self._start + i) % self.capacity
+
+    def _time(self, i):
+        return self._times[self._index(i)]
+
+    def append(self, time, depth):
+        """
+        :return: True if the sample was recorded
+        """
+        if self._size and time - self._time(self._size - 1) < self.min_interval:
+            return False
+
+        rate = 0.0
+        if self._size:
+            last = self._index(self._size - 1)
+            rate = max(0.0, depth - self._depths[last]) / (time - self._times[last])
+
+        if self._size < self.capacity:
+            index = self._index(self._size)
+            self._size += 1
+        else:
+            index = self._start
+            self._start = (self._start + 1) % self.capacity
+
+        self._times[index] = time
+        self._depths[index] = depth
+        self._rates[index] = rate
+
+        if self.ewma_depth is None:
+            self.ewma_depth, self.ewma_rate = float(depth), rate
+        else:
+            self.ewma_depth += self.alpha * (depth - self.ewma_depth)
+            self.ewma_rate += self.alpha * (rate - self.ewma_rate)
+        return True
+
+    def samples(self):
+        """
+        :return: list of (time, depth, arrival rate) from oldest to newest
+        """
+        return [
+            (self._times[j], self._depths[j], self._rates[j])
+            for j in map(self._index, range(self._size))
+        ]
+
+    def _bisect(self, time):
+        """
+        :return: the index of the first sample at or after time
+        """
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._time(middle) < time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def max_depth_between(self, start, end):
+        """
+        :return: the maximum depth sampled in [start, end] or None if there are no samples
+        """
+        result = None
+        i = self._bisect(start)
+        while i < self._size and self._time(i) <= end:
+            depth = self._depths[self._index(i)]
+            result = depth if result is None else max(result, depth)
+            i += 1
+        return result
+
+    def ewma_forecast(self, horizon):
+        """
+        :return: the expected depth in horizon seconds extrapolating the EWMA arrival rate, or None without samples
+        """
+        if self.ewma_depth is None:
+            return None
+        return self.ewma_depth + self.ewma_rate * horizon
+
+    def seasonal_forecast(self, now, horizon, season=24 * 60 * 60):
+        """
+        The maximum depth in the same window one season ago, for queues fed on a schedule such as nightly batch jobs
+        :return: the expected maximum depth in the next horizon seconds, or None if the history is too short
+        """
+        return self.max_depth_between(now - season, now - season + horizon)
+
+    def save(self, path):
+        """
+        Write the samples oldest first as raw doubles, replacing the file atomically
+        """
+        data = array("d")
+        for sample in self.samples():
+            data.extend(sample)
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            data.tofile(fh)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        Replace the samples with those saved at path; the EWMA estimates are rebuilt from the samples
+        """
+        data = array("d")
+        with open(path, "rb") as fh:
+            data.frombytes(fh.read())
+
+        self._start = self._size = 0
+        self.ewma_depth = self.ewma_rate = None
+        for i in range(0, len(data) - 2, 3):
+            self.append(data[i], data[i + 1])
+        return self
+
+
+class PredictivePolicy(ScalingPolicy):
+    """
+    Pre-scale before an expected backlog arrives by passing the forecast backlog to another policy. Workers take
+    minutes to start, so the forecast looks lead_time seconds ahead:
+
+        forecast = max(backlog + EWMA arrival rate * lead_time, max depth in the same window one season ago)
+
+    The forecast only raises the backlog; scaling down is left to the wrapped policy. Without a history the backlog is
+    passed through unchanged.
+    """
+
+    def __init__(self, policy, lead_time=600, season=24 * 60 * 60, trend=True):
+        """
+        :param policy: the ScalingPolicy deciding the count for the forecast backlog
+        :param lead_time: seconds to look ahead, about the time for a new worker to start
+        :param season: seconds between repeats of the load pattern or None to ignore seasonality
+        :param trend: extrapolate the EWMA arrival rate
+        """
+        if lead_time < 0:
+            raise ValueError(
+                "Lead time {} must be greater than or equal to zero".format(lead_time)
+            )
+
+        self.policy = policy
+        self.lead_time = lead_time
+        self.season = season
+        self.trend = trend
+
+    def forecast(self, backlog, now, history):
+        """
+        :return: the expected backlog within lead_time seconds
+        """
+        expected = backlog
+        if history is None or not len(history):
+            return expected
+
+        if self.trend:
+            expected = max(expected, backlog + history.ewma_rate * self.lead_time)
+
+        if self.season:
+            seasonal = history.seasonal_forecast(now, self.lead_time, self.season)
+            if seasonal is not None:
+                expected = max(expected, seasonal)
+        return expected
+
+    def desired_count(
+        self,
+        key,
+        backlog,
+        current_count,
+        active_size,
+        now,
+        history=None,
+        observed_backlog=None,
+    ):
+        expected = self.forecast(backlog, now, history)
+        if expected > backlog:
+            logger.debug("Forecast backlog for %s is %s", key, expected)
+        return self.policy.desired_count(
+            key,
+            expected,
+            current_count,
+            active_size,
+            now,
+            history=history,
+            # The wrapped policy measures the drain on the queue rather than the forecast
+            observed_backlog=backlog if observed_backlog is None else observed_backlog,
+        )
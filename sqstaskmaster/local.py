@@ -1,8 +1,14 @@
+import heapq
+import itertools
 import logging
+import math
 import time
-from collections import defaultdict
+import uuid
+from collections import Counter, defaultdict
 import queue
 
+from sqstaskmaster.logs import preview
+
 logger = logging.getLogger(__name__)
 """
 Simple in memory unbounded SimpleQueue based implementation of AWS SQS for local development and integration testing.
@@ -33,6 +39,9 @@ class LocalMessage:
         self._body = body
         self._attributes = attributes
         self._message_attributes = message_attributes
+        self._message_id = str(uuid.uuid4())
+        # Called with the message when it is deleted or released
+        self._on_release = None
 
     @property
     def attributes(self):
@@ -46,15 +55,27 @@ class LocalMessage:
     def message_attributes(self):
         return self._message_attributes
 
+    @property
+    def message_id(self):
+        return self._message_id
+
+    @property
+    def receipt_handle(self):
+        return self._message_id
+
     def change_visibility(self, *args, **kwargs):
         logger.info("noop called with %s, %s", args, kwargs)
+        if kwargs.get("VisibilityTimeout") == 0 and self._on_release is not None:
+            self._on_release(self)
 
     def delete(self):
         logger.info("noop delete")
+        if self._on_release is not None:
+            self._on_release(self)
 
     def __str__(self):
         return "LocalMessage(body: {}; attributes: {}; message_attributes: {})".format(
-            self.body, self.attributes, self.message_attributes
+            preview(self.body), self.attributes, self.message_attributes
         )
 
 
@@ -64,14 +85,35 @@ class LocalQueue:
     This does not implement behavior beyond the ability to put and get messages in FIFO order to a queue named by a url.
 
     Some of the SQS features that are missing: Retries, visibility & timeout, thread/process safety.
+
+    A url ending in .fifo emulates a FIFO queue: sends require a MessageGroupId, duplicates by MessageDeduplicationId
+    or content are dropped for 5 minutes, and a group is locked while one of its messages is in flight, until it is
+    deleted or its visibility is set to 0. Released messages are not redelivered.
+
+    Messages sent with DelaySeconds are received once the delay has passed.
     https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#queue
     """
 
     local_queues = defaultdict(queue.SimpleQueue)
+    # FIFO queue url -> message group -> number of messages in flight
+    local_in_flight = defaultdict(Counter)
+    # FIFO queue url -> deduplication id -> time sent
+    local_deduplication = defaultdict(dict)
+    # Queue url -> heap of (time visible, sequence, message) of delayed messages
+    local_delayed = defaultdict(list)
+    # FIFO queue url -> receipt handle -> message in flight
+    local_receipts = defaultdict(dict)
+    _sequence = itertools.count()
+
+    # https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/using-messagededuplicationid-property.html
+    DEDUPLICATION_INTERVAL = 5 * 60
+    # Seconds between checks of an empty FIFO queue while waiting for messages
+    FIFO_POLL_INTERVAL = 0.1
 
     def __init__(self, url):
         self.url = url
         self._queue = self.local_queues[url]
+        self.fifo = url.endswith(".fifo")
 
     def load(self):
         logger.info("Noop load!")
@@ -88,12 +130,16 @@ class LocalQueue:
             "QueueArn": "LocalQueue replacing: " + self.url,
             "ApproximateNumberOfMessages": self.queue.qsize(),
             "ApproximateNumberOfMessagesNotVisible": 0,
-            "ApproximateNumberOfMessagesDelayed": 0,
+            "ApproximateNumberOfMessagesDelayed": len(self.local_delayed[self.url]),
             "FifoQueue": True,
             "ContentBasedDeduplication": False,
         }
 
     def purge(self):
+        self.local_in_flight.pop(self.url, None)
+        self.local_deduplication.pop(self.url, None)
+        self.local_delayed.pop(self.url, None)
+        self.local_receipts.pop(self.url, None)
         while True:
             try:
                 self.queue.get_nowait()
@@ -107,32 +153,177 @@ class LocalQueue:
         :return: partial metadata of actual API
         """
         attributes = {}
+        if self.fifo:
+            if "MessageGroupId" not in kwargs:
+                raise ValueError(
+                    "MessageGroupId is required for FIFO queue " + self.url
+                )
+            attributes["MessageGroupId"] = kwargs["MessageGroupId"]
+
+            # Content based deduplication is assumed when no id is given
+            deduplication_id = kwargs.get(
+                "MessageDeduplicationId", kwargs["MessageBody"]
+            )
+            now = time.time()
+            sent = self.local_deduplication[self.url]
+            if (
+                now - sent.get(deduplication_id, -math.inf)
+                < self.DEDUPLICATION_INTERVAL
+            ):
+                logger.info("Dropping duplicate message %s", deduplication_id)
+                return {"MD5OfMessageBody": "Fake LocalMessage MD5 Body"}
+            sent[deduplication_id] = now
+
         # Ignore attribute behavior which is not relevant
         message = LocalMessage(
             kwargs["MessageBody"], attributes, kwargs.get("MessageAttributes", {})
         )
 
-        logger.debug("Sending message: %s", message)
-        self.queue.put_nowait(message)
+        delay = kwargs.get("DelaySeconds", 0)
+        if delay > 0:
+            logger.debug("Delaying message %d seconds: %s", delay, message)
+            heapq.heappush(
+                self.local_delayed[self.url],
+                (time.time() + delay, next(self._sequence), message),
+            )
+        else:
+            logger.debug("Sending message: %s", message)
+            self.queue.put_nowait(message)
         return {"MD5OfMessageBody": "Fake LocalMessage MD5 Body"}
 
+    def send_messages(self, **kwargs):
+        """
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.send_messages
+        :param kwargs: expects Entries (List) of dicts with Id, MessageBody and optional MessageAttributes
+        :return: partial metadata of actual API
+        """
+        successful = []
+        for entry in kwargs["Entries"]:
+            self.send_message(**entry)
+            successful.append(
+                {"Id": entry["Id"], "MD5OfMessageBody": "Fake LocalMessage MD5 Body"}
+            )
+        return {"Successful": successful, "Failed": []}
+
+    def delete_messages(self, **kwargs):
+        """
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.delete_messages
+        :param kwargs: expects Entries (List) of dicts with Id and ReceiptHandle
+        :return: partial metadata of actual API
+        """
+        for entry in kwargs["Entries"]:
+            message = self.local_receipts[self.url].get(entry["ReceiptHandle"])
+            if message is not None:
+                message.delete()
+        return {"Successful": [{"Id": entry["Id"]} for entry in kwargs["Entries"]]}
+
+    def change_message_visibility_batch(self, **kwargs):
+        """
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.change_message_visibility_batch
+        :param kwargs: expects Entries (List) of dicts with Id, ReceiptHandle and VisibilityTimeout
+        :return: partial metadata of actual API
+        """
+        for entry in kwargs["Entries"]:
+            message = self.local_receipts[self.url].get(entry["ReceiptHandle"])
+            if message is not None:
+                message.change_visibility(VisibilityTimeout=entry["VisibilityTimeout"])
+        return {"Successful": [{"Id": entry["Id"]} for entry in kwargs["Entries"]]}
+
     def receive_messages(self, **kwargs):
         """
         https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.receive_messages
         :param kwargs: simulates behavior of WaitTimeSeconds and MaxNumberOfMessages
         :return:
         """
-        time_remaining = kwargs.get("WaitTimeSeconds", 20)
+        wait_time = kwargs.get("WaitTimeSeconds", 20)
+        if self.fifo:
+            return self._receive_fifo(kwargs.get("MaxNumberOfMessages", 1), wait_time)
 
         result = []
 
         tic = time.perf_counter()
-        for i in range(kwargs.get("MaxNumberOfMessages", 1)):
-            time_remaining = max(0, time_remaining - time.perf_counter() + tic)
+        while len(result) < kwargs.get("MaxNumberOfMessages", 1):
+            time_remaining = max(0, wait_time - time.perf_counter() + tic)
+            next_visible = self._promote_delayed()
 
             try:
-                result.append(self.queue.get(block=True, timeout=time_remaining))
+                # Wake up when the next delayed message becomes visible
+                result.append(
+                    self.queue.get(
+                        block=True,
+                        timeout=min(time_remaining, max(0, next_visible - time.time())),
+                    )
+                )
+            except queue.Empty:
+                if time_remaining <= 0 or next_visible > time.time() + time_remaining:
+                    break
+
+        return result
+
+    def _promote_delayed(self):
+        """
+        Move the delayed messages that are visible to the queue
+        :return: the time the next delayed message becomes visible
+        """
+        delayed = self.local_delayed[self.url]
+        now = time.time()
+        while delayed and delayed[0][0] <= now:
+            self.queue.put_nowait(heapq.heappop(delayed)[2])
+        return delayed[0][0] if delayed else math.inf
+
+    def _receive_fifo(self, max_messages, wait_time):
+        """
+        Wait up to wait_time seconds for a message of a group without a message in flight. Polled, since released
+        messages do not wake up a blocking get.
+        """
+        deadline = time.perf_counter() + wait_time
+        while True:
+            next_visible = self._promote_delayed()
+            result = self._receive_groups(max_messages)
+            time_remaining = deadline - time.perf_counter()
+            if result or time_remaining <= 0:
+                return result
+            time.sleep(
+                min(
+                    time_remaining,
+                    self.FIFO_POLL_INTERVAL,
+                    max(0, next_visible - time.time()),
+                )
+            )
+
+    def _receive_groups(self, max_messages):
+        """
+        Emulate message group locking: messages of a group with a message in flight are not received until it is
+        deleted or released with a visibility timeout of 0.
+        """
+        in_flight = self.local_in_flight[self.url]
+        pending = []
+        while True:
+            try:
+                pending.append(self.queue.get_nowait())
             except queue.Empty:
                 break
 
+        result = []
+        blocked = set(in_flight)
+        for message in pending:
+            group = message.attributes["MessageGroupId"]
+            if group in blocked or len(result) >= max_messages:
+                # Later messages of the group must wait too to keep the order
+                blocked.add(group)
+                self.queue.put_nowait(message)
+            else:
+                in_flight[group] += 1
+                message._on_release = self._release
+                self.local_receipts[self.url][message.receipt_handle] = message
+                result.append(message)
         return result
+
+    def _release(self, message):
+        message._on_release = None
+        self.local_receipts[self.url].pop(message.receipt_handle, None)
+        in_flight = self.local_in_flight[self.url]
+        group = message.attributes["MessageGroupId"]
+        in_flight[group] -= 1
+        if in_flight[group] <= 0:
+            del in_flight[group]
@@ -0,0 +1,60 @@
+import logging
+
+logger = logging.getLogger(__name__)
+"""
+Logging helpers for the receive and handle hot path. Message bodies can be many kilobytes, so log lines carry a short
+preview that is only built when the record is emitted, and notify contexts are only built when there is a notifier.
+"""
+
+PREVIEW_LENGTH = 200
+
+
+def preview(text, length=PREVIEW_LENGTH):
+    """
+    :return: the text truncated to length characters, with the size of the text when it is truncated
+    """
+    text = str(text)
+    if len(text) <= length:
+        return text
+    return "{}... ({} chars)".format(text[:length], len(text))
+
+
+class Preview:
+    """
+    Log argument formatted as the preview of the text, so that the text is only truncated and copied when the record
+    is emitted.
+
+    logger.info("failed to decode message %s", Preview(message.body))
+    """
+
+    __slots__ = ("text", "length")
+
+    def __init__(self, text, length=PREVIEW_LENGTH):
+        self.text = text
+        self.length = length
+
+    def __str__(self):
+        return preview(self.text, self.length)
+
+
+def message_context(message, body=None):
+    """
+    :param message: the SQS message
+    :param body: optional body to report instead of the message body, for instance of a task in an envelope
+    :return: the notify context of the message with its full body and attributes
+    """
+    return {
+        "body": message.body if body is None else body,
+        **(message.attributes or {}),
+    }
+
+
+def message_fields(message):
+    """
+    :return: dict of structured fields for the extra argument of a log call, read by json log formatters
+    """
+    return {
+        "sqs_message_id": message.message_id,
+        "sqs_body_size": len(message.body),
+        "sqs_receive_count": (message.attributes or {}).get("ApproximateReceiveCount"),
+    }
@@ -1,17 +1,25 @@
 import logging
+import math
+import multiprocessing
 import signal
 import time
 
 from abc import ABC, abstractmethod
 from botocore.exceptions import ClientError
 
+from sqstaskmaster.checkpoint import checkpoint_key
+from sqstaskmaster.dedupe import LeasedMessage
+from sqstaskmaster.logs import message_context, preview
+from sqstaskmaster.protection import protection_minutes
+from sqstaskmaster.retry import MAX_VISIBILITY_TIMEOUT
+
 logger = logging.getLogger(__name__)
 
 
 class MessageHandler(ABC):
     """
     MessageHandler is an abstract class used to implement safe message handling.
-    The implementer must provide run and running methods.
+    The implementer must provide run and notify methods, and either override running or report progress.
 
     The handler is then used as a context manager to manage the process execution and ack the result in SQS
     If the Run process does not raise it is assumed to have completed
@@ -22,7 +30,23 @@ class MessageHandler(ABC):
     Any BaseException (not Exception) will be reraised by __exit__ allowing the python process to exit
     """
 
-    def __init__(self, message, sqs_timeout, alarm_timeout, hard_timeout):
+    def __init__(
+        self,
+        message,
+        sqs_timeout,
+        alarm_timeout,
+        hard_timeout,
+        shutdown=None,
+        retry_policy=None,
+        protection=None,
+        progress_window=None,
+        total=None,
+        eta_visibility=False,
+        checkpoint_store=None,
+        checkpoint_interval=0,
+        resource_policy=None,
+        duration_recorder=None,
+    ):
         """
         Constructor for message processing context manager
 
@@ -30,11 +54,34 @@ class MessageHandler(ABC):
         :param sqs_timeout: the timeout to set when the process is still working on the message
         :param alarm_timeout: the timeout to use on the local system to check if running and update SQS
         :param hard_timeout: The hard limit for executing the message processing
+        :param shutdown: optional ShutdownCoordinator limiting execution to the grace period once shutdown is requested
+        :param retry_policy: optional RetryPolicy setting the visibility backoff when the handler fails
+        :param protection: optional TaskProtection marking the worker busy until the handler exits
+        :param progress_window: optional seconds; the default running method reports the handler stuck when progress
+                                has not advanced within the window
+        :param total: optional progress count when the task is complete, for the eta
+        :param eta_visibility: extend the sqs timeout to cover the eta rather than by sqs_timeout
+        :param checkpoint_store: optional CheckpointStore for checkpoint and restore, keyed by the task and kwargs
+        :param checkpoint_interval: minimum seconds between saved checkpoints
+        :param resource_policy: optional ResourcePolicy pinning the worker and limiting the resources of the task
+        :param duration_recorder: optional callable of the run time in seconds, called when the handler succeeds, such
+                                  as AdaptiveTimeouts.recorder(task)
         """
         self._message = message
         self.sqs_timeout = sqs_timeout
         self.alarm_timeout = alarm_timeout
         self.hard_timeout = hard_timeout
+        self._shutdown = shutdown
+        self._retry_policy = retry_policy
+        self._protection = protection
+        self.progress_window = progress_window
+        self.total = total
+        self.eta_visibility = eta_visibility
+        self._checkpoint_store = checkpoint_store
+        self.checkpoint_interval = checkpoint_interval
+        self._resource_policy = resource_policy
+        self._resource_limits = None
+        self._duration_recorder = duration_recorder
 
         if alarm_timeout <= 0:
             raise ValueError("Alarm timeout must be an integer greater than zero")
@@ -52,57 +99,212 @@ class MessageHandler(ABC):
                 )
             )
 
+        if progress_window is not None and progress_window < alarm_timeout:
+            raise ValueError(
+                "Progress window {} is shorter than the alarm timeout {:d}".format(
+                    progress_window, alarm_timeout
+                )
+            )
+
         self._start_time = time.time()
 
+        # Shared memory so that progress can be reported by a process forked to run the task
+        self._progress = multiprocessing.Value("q", 0, lock=False)
+        self._progress_seen = 0
+        self._progress_time = self._start_time
+
+        self._checkpoint_key = (
+            checkpoint_key(message) if checkpoint_store is not None else None
+        )
+        self._checkpoint_time = None
+
     def __enter__(self):
+        if self._protection is not None:
+            # The hard timeout bounds the protection if the worker dies without removing it
+            self._set_protection(True)
+        if self._resource_policy is not None:
+            self._resource_policy.apply()
+            self._resource_limits = self._resource_policy.limits()
+            self._resource_limits.__enter__()
         signal.signal(signal.SIGALRM, self._handle_alarm)
         signal.alarm(self.alarm_timeout)
         self._extend_timeout(self.sqs_timeout)
         return self
 
+    def _set_protection(self, protected):
+        try:
+            if protected:
+                self._protection.protect(protection_minutes(self.hard_timeout))
+            else:
+                self._protection.unprotect()
+        except (OSError, RuntimeError, ValueError) as e:
+            # Don't fail here - the task may be stopped by a scale in
+            self.notify(e, context=message_context(self._message))
+            logger.exception("Failed to set task protection %s for %s", protected, self)
+
     def _run_time(self):
         return time.time() - self._start_time
 
+    def _alarm_interval(self):
+        if self._shutdown is not None and self._shutdown.requested:
+            # Check again no later than the end of the shutdown grace period
+            return max(
+                1,
+                min(self.alarm_timeout, math.ceil(self._shutdown.time_remaining())),
+            )
+        return self.alarm_timeout
+
     def _handle_alarm(self, signum, frame):
-        logger.info("Handling %s for %s in frame %s", signum, self, frame)
+        # Formatted on every tick, so the handler is described with a body preview
+        logger.info("Handling %s for %s", signum, self)
         if self._run_time() > self.hard_timeout:
             raise TimeoutError("Hit Hard Timeout for message handler")
+        elif self._shutdown is not None and self._shutdown.expired():
+            raise TimeoutError("Hit shutdown grace period for message handler")
         elif self.running():
             logger.info("Adjusting sqs timeout")
             try:
-                self._extend_timeout(self.sqs_timeout)
-                signal.alarm(self.alarm_timeout)
+                self._extend_timeout(self._visibility_timeout())
+                signal.alarm(self._alarm_interval())
             except ClientError as ce:
                 # Don't fail here - report and continue - will result in running the task many times
-                self.notify(
-                    ce, context={"body": self._message.body, **self._message.attributes}
-                )
+                self.notify(ce, context=message_context(self._message))
                 logger.exception("Failed to extend timeout for %s", self)
         else:
             raise RuntimeError("Handler is stuck on %s", self)
 
+    def progress(self, n=1):
+        """
+        Report n units of work done. Cheap enough for the inner loop of run, and works from a child process forked
+        after the handler was created.
+        """
+        self._progress.value += n
+
+    @property
+    def progress_count(self):
+        return self._progress.value
+
+    def progress_age(self):
+        """
+        :return: seconds since the progress count was last seen to advance, sampled when called
+        """
+        count = self._progress.value
+        now = time.time()
+        if count != self._progress_seen:
+            self._progress_seen = count
+            self._progress_time = now
+        return now - self._progress_time
+
+    def eta(self):
+        """
+        :return: estimated seconds until the progress count reaches total at the average rate so far, or None
+        """
+        count = self._progress.value
+        if self.total is None or count <= 0:
+            return None
+        return max(0, (self.total - count) * self._run_time() / count)
+
+    def _visibility_timeout(self):
+        eta = self.eta() if self.eta_visibility else None
+        if eta is None:
+            return self.sqs_timeout
+        remaining = min(eta, max(0, self.hard_timeout - self._run_time()))
+        return min(
+            MAX_VISIBILITY_TIMEOUT,
+            max(self.sqs_timeout, math.ceil(remaining) + self.alarm_timeout),
+        )
+
     def _extend_timeout(self, seconds):
         self._message.change_visibility(VisibilityTimeout=seconds)
 
+    def checkpoint(self, state):
+        """
+        Save the json serializable state of run, unless a checkpoint was saved less than checkpoint_interval seconds
+        ago. A failed save is notified and logged, and run carries on.
+        :return: True if the checkpoint was saved
+        """
+        if self._checkpoint_store is None:
+            raise RuntimeError("No checkpoint store for {}".format(self))
+
+        now = time.time()
+        if (
+            self._checkpoint_time is not None
+            and now - self._checkpoint_time < self.checkpoint_interval
+        ):
+            return False
+
+        try:
+            self._checkpoint_store.save(self._checkpoint_key, state)
+        except (ClientError, OSError) as e:
+            self.notify(e, context=message_context(self._message))
+            logger.exception("Failed to save checkpoint for %s", self)
+            return False
+        self._checkpoint_time = now
+        return True
+
+    def restore(self):
+        """
+        :return: the state of the latest checkpoint of an earlier delivery of the task, or None to start from scratch
+        """
+        if self._checkpoint_store is None:
+            raise RuntimeError("No checkpoint store for {}".format(self))
+
+        state = self._checkpoint_store.load(self._checkpoint_key)
+        if state is not None:
+            logger.info("Restored checkpoint %s for %s", self._checkpoint_key, self)
+        return state
+
+    def _delete_checkpoint(self):
+        try:
+            self._checkpoint_store.delete(self._checkpoint_key)
+        except (ClientError, OSError) as e:
+            # Don't fail here - the task is done and the checkpoint is only stale
+            self.notify(e, context=message_context(self._message))
+            logger.exception("Failed to delete checkpoint for %s", self)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         signal.alarm(0)
+        if self._resource_limits is not None:
+            # Lift the limits of the task before handling the result
+            self._resource_limits.__exit__(None, None, None)
+            self._resource_limits = None
         if exc_type is None:
+            if self._duration_recorder is not None:
+                self._duration_recorder(self._run_time())
             try:
                 self._message.delete()
             except ClientError as ce:
-                self.notify(
-                    ce, context={"body": self._message.body, **self._message.attributes}
-                )
+                self.notify(ce, context=message_context(self._message))
                 logger.exception("failed to delete message %s", self._message)
+            else:
+                if self._checkpoint_store is not None:
+                    self._delete_checkpoint()
 
         else:
-            # Should the message visibility time be set to 0 here?
             self.notify(
                 exc_val,
-                context={"body": self._message.body, **self._message.attributes},
+                context=message_context(self._message),
             )
             logger.exception("Failed for message: %s", self._message)
 
+            if self._shutdown is not None and self._shutdown.requested:
+                # Unfinished work is picked up by another worker instead of waiting for the sqs timeout
+                self._shutdown.release(self._message)
+            elif self._retry_policy is not None:
+                try:
+                    self._retry_policy.handle_failure(self._message, exc_val)
+                except ClientError as ce:
+                    # The message will be retried when the sqs timeout expires
+                    self.notify(ce, context=message_context(self._message))
+                    logger.exception("failed to retry message %s", self._message)
+
+            if isinstance(self._message, LeasedMessage):
+                # Otherwise the lease outlives the visibility and the retry is skipped as a duplicate in progress
+                self._message.release()
+
+        if self._protection is not None:
+            self._set_protection(False)
+
         # catch only Exception not BaseException
         # https://docs.python.org/3/library/exceptions.html#exception-hierarchy
         return isinstance(exc_val, Exception)
@@ -121,17 +323,19 @@ class MessageHandler(ABC):
             self.alarm_timeout,
             self._run_time(),
             self.hard_timeout,
-            self._message.body,
+            preview(self._message.body),
             self._message.attributes,
         )
 
-    @abstractmethod
     def running(self):
         """
-        Detect whether the handler process is stuck
+        Detect whether the handler process is stuck. By default the handler is stuck when progress_window is set and
+        the progress count has not advanced within it; without a progress_window it is assumed to be running.
         :return: True if the process handler is still executing. False if the handler process is stopped or stuck
         """
-        pass
+        if self.progress_window is None:
+            return True
+        return self.progress_age() <= self.progress_window
 
     @abstractmethod
     def run(self):
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+# The attributes summed for the number of messages in a queue
+DEPTH_ATTRIBUTES = (
+    "ApproximateNumberOfMessages",
+    "ApproximateNumberOfMessagesNotVisible",
+    "ApproximateNumberOfMessagesDelayed",
+)
+
+
+class _Flight:
+    """
+    A get_queue_attributes call in progress that other callers can wait for
+    """
+
+    def __init__(self, names):
+        self.names = frozenset(names)
+        self.done = threading.Event()
+        self.error = None
+
+
+class QueueMetricsCache:
+    """
+    Queue attributes shared by the TaskManagers, Provisioners and other components of a process.
+
+    Only the requested attribute names are fetched with get_queue_attributes, rather than all attributes as
+    Queue.load does. Values younger than max_age seconds are served from the cache and concurrent requests for the same
+    url share one call. Hits, misses and shared calls are counted in stats.
+
+    metrics = QueueMetricsCache(max_age=5)
+    tm = TaskManager(sqs_url, metrics_cache=metrics)
+    provisioner = Provisioner(RULES, metrics_cache=metrics)
+    """
+
+    def __init__(self, client=None, max_age=5, attribute_names=DEPTH_ATTRIBUTES):
+        """
+        :param client: the boto3 SQS client, a new client by default
+        :param max_age: seconds a value is served from the cache
+        :param attribute_names: the attributes fetched by default
+        """
+        if max_age < 0:
+            raise ValueError(
+                "Max age {} must be greater than or equal to zero".format(max_age)
+            )
+
+        self.client = client or boto3.client("sqs")
+        self.max_age = max_age
+        self.attribute_names = tuple(attribute_names)
+
+        # url -> (time fetched, attributes)
+        self._entries = {}
+        # url -> _Flight
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "shared": 0}
+
+    def get(self, url, attribute_names=None, max_age=None):
+        """
+        :param url: the queue url
+        :param attribute_names: the attributes to get, defaults to attribute_names of the cache
+        :param max_age: seconds a cached value may be served, defaults to max_age of the cache
+        :return: dict of attribute name to the string value
+        """
+        names = frozenset(attribute_names or self.attribute_names)
+        max_age = self.max_age if max_age is None else max_age
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(url)
+                if (
+                    entry is not None
+                    and time.time() - entry[0] <= max_age
+                    and names <= entry[1].keys()
+                ):
+                    self.stats["hits"] += 1
+                    return {name: entry[1][name] for name in names}
+
+                flight = self._flights.get(url)
+                if flight is None:
+                    flight = self._flights[url] = _Flight(names)
+                    self.stats["misses"] += 1
+                    leader = True
+                else:
+                    leader = False
+
+            if leader:
+                return self._fetch(url, flight)
+
+            flight.done.wait()
+            if names <= flight.names:
+                if flight.error is not None:
+                    raise flight.error
+                with self._lock:
+                    self.stats["shared"] += 1
+                    entry = self._entries.get(url)
+                if entry is not None and names <= entry[1].keys():
+                    return {name: entry[1][name] for name in names}
+            # The call in progress did not include all the names - try again
+
+    def _fetch(self, url, flight):
+        try:
+            attributes = self.client.get_queue_attributes(
+                QueueUrl=url, AttributeNames=sorted(flight.names)
+            ).get("Attributes", {})
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                self._entries[url] = (time.time(), attributes)
+            return {
+                name: attributes[name] for name in flight.names if name in attributes
+            }
+        finally:
+            with self._lock:
+                del self._flights[url]
+            flight.done.set()
+
+    def depth(self, url, max_age=None):
+        """
+        :return: the number of visible, in flight and delayed messages in the queue
+        """
+        attributes = self.get(url, DEPTH_ATTRIBUTES, max_age=max_age)
+        return sum(int(attributes[name]) for name in DEPTH_ATTRIBUTES)
+
+    def invalidate(self, url=None):
+        """
+        Drop the cached attributes of the url, or of all urls
+        """
+        with self._lock:
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(url, None)
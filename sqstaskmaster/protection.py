@@ -0,0 +1,104 @@
+import json
+import logging
+import math
+import os
+import urllib.request
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+"""
+Scale in protection for busy workers. A worker protects its ECS task while a MessageHandler is running so that the
+service scheduler does not stop it in the middle of a long task when the Provisioner lowers the desired count, and
+removes the protection when it is idle again.
+"""
+
+# https://docs.aws.amazon.com/AmazonECS/latest/developerguide/task-scale-in-protection-endpoint.html
+MAX_EXPIRES_IN_MINUTES = 48 * 60
+
+
+def protection_minutes(seconds):
+    """
+    :return: the protection period in whole minutes covering seconds, within the limits of ECS
+    """
+    return max(1, min(MAX_EXPIRES_IN_MINUTES, math.ceil(seconds / 60)))
+
+
+class TaskProtection(ABC):
+    """
+    Advertises whether the worker is busy.
+    """
+
+    @abstractmethod
+    def protect(self, expires_in_minutes):
+        """
+        Mark the worker busy until unprotect is called or the protection expires
+        :param expires_in_minutes: minutes until the protection expires if the worker dies without calling unprotect
+        """
+
+    @abstractmethod
+    def unprotect(self):
+        """
+        Mark the worker idle
+        """
+
+
+class EcsTaskProtection(TaskProtection):
+    """
+    Sets the scale in protection of the ECS task with the ECS container agent endpoint, which is available to tasks
+    with the ECS_AGENT_URI environment variable. The task role needs no extra permissions.
+    """
+
+    PATH = "/task-protection/v1/state"
+
+    def __init__(self, agent_uri=None, timeout=5):
+        """
+        :param agent_uri: the ECS agent uri, defaults to the ECS_AGENT_URI environment variable
+        :param timeout: seconds to wait for the agent
+        """
+        self.agent_uri = agent_uri or os.environ.get("ECS_AGENT_URI")
+        if not self.agent_uri:
+            raise ValueError("ECS_AGENT_URI is not set; not running in an ECS task?")
+        self.timeout = timeout
+
+    def _put(self, state):
+        request = urllib.request.Request(
+            self.agent_uri + self.PATH,
+            data=json.dumps(state).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="PUT",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            result = json.loads(response.read().decode("utf-8"))
+
+        if "protection" not in result:
+            raise RuntimeError(
+                "Failed to set task protection {}: {}".format(state, result)
+            )
+        logger.debug("Task protection %s", result["protection"])
+        return result["protection"]
+
+    def protect(self, expires_in_minutes):
+        return self._put(
+            {"ProtectionEnabled": True, "ExpiresInMinutes": expires_in_minutes}
+        )
+
+    def unprotect(self):
+        return self._put({"ProtectionEnabled": False})
+
+
+class LocalTaskProtection(TaskProtection):
+    """
+    In memory stand in for local runs and tests
+    """
+
+    def __init__(self):
+        self.protected = False
+        self.expires_in_minutes = None
+
+    def protect(self, expires_in_minutes):
+        self.protected = True
+        self.expires_in_minutes = expires_in_minutes
+
+    def unprotect(self):
+        self.protected = False
+        self.expires_in_minutes = None
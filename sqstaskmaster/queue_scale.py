@@ -1,8 +1,17 @@
+import hashlib
 import logging
+import os
+import threading
+import time
 import boto3
 import enum
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
+from sqstaskmaster.forecast import DepthHistory
+from sqstaskmaster.scaling import AllOrNothingPolicy
+
 logger = logging.getLogger(__name__)
 
 
@@ -17,17 +26,21 @@ class Provisioner:
     """
     Runnable Task to monitor SQS queue depth and adjust the number of ECS service works.
     Based on declarative rules for queues, services and clusters.
-    Current implementation provides only an all on, or all off approach, setting the number of works to ACTIVE_SIZE or
-    zero. Tasks should be evenly distributed between workers assuming the number of workers is much smaller than the
+    The default AllOrNothingPolicy provides an all on, or all off approach, setting the number of works to ACTIVE_SIZE
+    or zero. Tasks should be evenly distributed between workers assuming the number of workers is much smaller than the
     number of tasks. The tail as workers run out of work tasks is ignored.
 
+    A ScalingPolicy such as the ProportionalPolicy can be set for all rules with the policy argument or per rule with the
+    POLICY key.
+
     Usage:
     RULES = [
         {
             QUEUE_NAME: "{SQS_URL}",
             SERVICE_NAME: "{ECS_SERVICE_NAME}",
             CLUSTER_NAME: "{ECS_CLUSTER_NAME}",
-            ACTIVE_SIZE: N
+            ACTIVE_SIZE: N,
+            POLICY: ProportionalPolicy(throughput=0.01, target_drain_time=3600)  # optional
         }
     ]
 
@@ -37,12 +50,32 @@ class Provisioner:
         time.sleep(10)
 
     Or use a more complete scheduler like https://pypi.org/project/schedule/
+
+    Rules are evaluated concurrently on a pool of max_workers threads so a pass takes roughly one round trip. When
+    service_state is overridden, the service descriptions for the pass are fetched up front in batches of 10 services per
+    cluster and get_description serves them from that batch.
+
+    The desired count of each service is cached and reconciled from describe_services once the cache entry is older than
+    service_cache_ttl seconds. update_service is only called when the target differs from the cached count, which saves
+    ECS API rate limit shared with deploy tooling. Issued and skipped updates are counted in stats.
+
+    Set metrics_cache to a QueueMetricsCache shared with other components to fetch only the depth attributes and
+    reuse values fetched within its max_age.
+
+    With scale_in_protection, workers that protect their ECS task while busy (see MessageHandler protection) are not
+    scaled in: the desired count is only lowered by the number of idle tasks and busy ones are left to finish. Override
+    busy_count to count busy workers some other way.
+
+    The queue depth of each rule is sampled into a DepthHistory per queue which is passed to the policy, so a
+    PredictivePolicy can pre-scale for a recurring or growing backlog. Set history_directory to keep the history across
+    restarts; it is loaded on the first sample and saved at most every history_save_interval seconds.
     """
 
     QUEUE_NAME = "queue_name"
     SERVICE_NAME = "service_name"
     CLUSTER_NAME = "cluster_name"
     ACTIVE_SIZE = "active_size"
+    POLICY = "policy"
 
     QUEUE_DEPTH_ATTRIBUTES = {
         "pending_jobs": "ApproximateNumberOfMessages",
@@ -50,7 +83,25 @@ class Provisioner:
         "scheduled_jobs": "ApproximateNumberOfMessagesDelayed",
     }
 
-    def __init__(self, rules, notify=None):
+    # https://docs.aws.amazon.com/AmazonECS/latest/APIReference/API_DescribeServices.html
+    DESCRIBE_SERVICES_BATCH_SIZE = 10
+    # https://docs.aws.amazon.com/AmazonECS/latest/APIReference/API_GetTaskProtection.html
+    GET_TASK_PROTECTION_BATCH_SIZE = 10
+
+    def __init__(
+        self,
+        rules,
+        notify=None,
+        max_workers=10,
+        service_cache_ttl=300,
+        policy=None,
+        history_capacity=10080,
+        history_interval=60,
+        history_directory=None,
+        history_save_interval=300,
+        metrics_cache=None,
+        scale_in_protection=False,
+    ):
         self._rules = rules
 
         if not hasattr(rules, "__iter__"):
@@ -71,61 +122,347 @@ class Provisioner:
             if self.ACTIVE_SIZE not in rule:
                 raise KeyError("Rules must specify the {}".format(self.ACTIVE_SIZE))
 
-        self._notify = notify
+        if max_workers < 1:
+            raise ValueError(
+                "Max workers {} must be greater than zero".format(max_workers)
+            )
 
+        self._notify = notify
+        self.max_workers = max_workers
+        self.service_cache_ttl = service_cache_ttl
+        self.policy = policy or AllOrNothingPolicy()
+        self._descriptions = {}
+
+        # (cluster, service) -> observed and requested desired count and time of the last reconcile
+        self._service_counts = {}
+        self._lock = threading.Lock()
+        self.stats = {"updates_issued": 0, "updates_skipped": 0}
+
+        # queue url -> DepthHistory
+        self.history = {}
+        self.history_capacity = history_capacity
+        self.history_interval = history_interval
+        self.history_directory = history_directory
+        self.history_save_interval = history_save_interval
+        self._history_saved = time.time()
+
+        self.metrics_cache = metrics_cache
+        self.scale_in_protection = scale_in_protection
         self.sqs = boto3.resource("sqs")
         self.ecs = boto3.client("ecs")
 
+    @property
+    def rules(self):
+        return self._rules
+
     def run(self):
         """
         For each rule, check the queue depth and adjust the service count
         """
         logger.info("Checking queue for work and scaling service resources")
 
-        for rule in self._rules:
-            logger.debug("running rule: %s", rule)
-            try:
-                queue_attributes = self.sqs.Queue(rule[self.QUEUE_NAME]).attributes
-                total_messages = sum(
-                    int(queue_attributes[val])
-                    for val in self.QUEUE_DEPTH_ATTRIBUTES.values()
+        if self._uses_descriptions():
+            self._descriptions = self.describe_services(self._rules)
+            self._reconcile(self._rules, self._descriptions)
+        else:
+            self.reconcile_stale(self._rules)
+
+        try:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, max(1, len(self._rules)))
+            ) as executor:
+                # Consume the results to raise any unexpected exception
+                list(executor.map(self.run_rule, self._rules))
+        finally:
+            self._descriptions = {}
+
+        if (
+            self.history_directory
+            and time.time() - self._history_saved >= self.history_save_interval
+        ):
+            self.save_history()
+
+    def run_rule(self, rule):
+        """
+        Check the queue depth and adjust the service count for one rule
+        """
+        logger.debug("running rule: %s", rule)
+        try:
+            queue_attributes = self.queue_attributes(rule)
+            total_messages = sum(
+                int(queue_attributes[val])
+                for val in self.QUEUE_DEPTH_ATTRIBUTES.values()
+            )
+
+            self.record_depth(rule, total_messages)
+
+            # This could result in thrashing the service count. For tasks that run quickly some historical filter
+            # might be required but that is not the intended use case.
+            # Beware of attempting to set the count based on the number of messages in the queue. It will be
+            # difficult to control which instances get shutdown and ensure a graceful exit.
+            # All or nothing is simple and only wasteful at the tail end of a large process queue
+
+            current_state = self.service_state(rule)
+            if current_state == ServiceState.ACTIVE:
+                count = self.target_count(rule, total_messages)
+                if self.scale_in_protection:
+                    count = self.protect_busy(rule, count)
+                self.set_desired_count(rule, count)
+            else:
+                logger.info(
+                    "Service: %s %s is in state: %s; Desired count will not be adjusted",
+                    rule[self.CLUSTER_NAME],
+                    rule[self.SERVICE_NAME],
+                    current_state,
                 )
 
-                # This could result in thrashing the service count. For tasks that run quickly some historical filter
-                # might be required but that is not the intended use case.
-                # Beware of attempting to set the count based on the number of messages in the queue. It will be
-                # difficult to control which instances get shutdown and ensure a graceful exit.
-                # All or nothing is simple and only wasteful at the tail end of a large process queue
-
-                current_state = self.service_state(rule)
-                if current_state == ServiceState.ACTIVE:
-                    self.ecs.update_service(
-                        cluster=rule[self.CLUSTER_NAME],
-                        service=rule[self.SERVICE_NAME],
-                        desiredCount=rule[self.ACTIVE_SIZE]
-                        if total_messages > 0
-                        else 0,
-                    )
+            self.log_queue_depth(queue_attributes, rule)
 
-                    logger.info(
-                        "Setting: %s %s to %s count",
-                        rule[self.CLUSTER_NAME],
-                        rule[self.SERVICE_NAME],
-                        rule[self.ACTIVE_SIZE] if total_messages > 0 else 0,
-                    )
+        except ClientError as ce:
+            logger.exception("Failed to update resources for rule %s", rule)
+            self.notify(ce, context=rule)
+
+    def queue_attributes(self, rule):
+        """
+        :return: the QUEUE_DEPTH_ATTRIBUTES of the queue of the rule, from the metrics cache if there is one
+        """
+        if self.metrics_cache is not None:
+            return self.metrics_cache.get(
+                rule[self.QUEUE_NAME], self.QUEUE_DEPTH_ATTRIBUTES.values()
+            )
+        # The client is thread safe, unlike the resource, and rules run on a thread pool
+        return self.sqs.meta.client.get_queue_attributes(
+            QueueUrl=rule[self.QUEUE_NAME],
+            AttributeNames=list(self.QUEUE_DEPTH_ATTRIBUTES.values()),
+        )["Attributes"]
+
+    def target_count(self, rule, backlog, now=None):
+        """
+        Ask the scaling policy of the rule for the desired count of the service
+        :param rule: the rule
+        :param backlog: the total number of messages in the queue
+        :param now: the time of the decision, defaults to the current time
+        """
+        key = (rule[self.CLUSTER_NAME], rule[self.SERVICE_NAME])
+        with self._lock:
+            current_count = self._cached_count(key)
+            history = self.history.get(rule[self.QUEUE_NAME])
+
+        policy = rule.get(self.POLICY, self.policy)
+        return policy.desired_count(
+            key,
+            backlog,
+            current_count,
+            rule[self.ACTIVE_SIZE],
+            time.time() if now is None else now,
+            history=history,
+        )
+
+    def record_depth(self, rule, backlog, now=None):
+        """
+        Sample the queue depth of the rule into the history of its queue
+        :return: the DepthHistory of the queue
+        """
+        url = rule[self.QUEUE_NAME]
+        with self._lock:
+            history = self.history.get(url)
+            if history is None:
+                history = self.history[url] = DepthHistory(
+                    self.history_capacity, self.history_interval
+                )
+                path = self._history_path(url)
+                if path and os.path.exists(path):
+                    try:
+                        history.load(path)
+                    except (OSError, ValueError):
+                        # A truncated or corrupt file, start over rather than fail every pass
+                        logger.exception("Failed to load queue depth history %s", path)
+                        history = self.history[url] = DepthHistory(
+                            self.history_capacity, self.history_interval
+                        )
+            history.append(time.time() if now is None else now, backlog)
+        return history
+
+    def save_history(self):
+        """
+        Write the queue depth history of each queue to history_directory
+        """
+        os.makedirs(self.history_directory, exist_ok=True)
+        with self._lock:
+            for url, history in self.history.items():
+                path = self._history_path(url)
+                try:
+                    history.save(path)
+                except OSError:
+                    logger.exception("Failed to save queue depth history %s", path)
+            self._history_saved = time.time()
+
+    def _history_path(self, url):
+        if not self.history_directory:
+            return None
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.history_directory, name + ".depth")
+
+    def protect_busy(self, rule, count):
+        """
+        Raise a scale in to keep the busy workers of the rule
+        :param count: the target count
+        :return: the count lowered only by the idle workers
+        """
+        key = (rule[self.CLUSTER_NAME], rule[self.SERVICE_NAME])
+        with self._lock:
+            current_count = self._cached_count(key)
+        if current_count is None or count >= current_count:
+            return count
+
+        busy = self.busy_count(rule)
+        protected = max(count, min(busy, current_count))
+        if protected != count:
+            logger.info(
+                "Service: %s %s has %s busy workers; scaling in to %s instead of %s",
+                key[0],
+                key[1],
+                busy,
+                protected,
+                count,
+            )
+        return protected
+
+    def busy_count(self, rule):
+        """
+        :return: the number of running tasks of the service with scale in protection enabled
+        """
+        cluster = rule[self.CLUSTER_NAME]
+        arns = []
+        kwargs = {
+            "cluster": cluster,
+            "serviceName": rule[self.SERVICE_NAME],
+            "desiredStatus": "RUNNING",
+        }
+        while True:
+            result = self.ecs.list_tasks(**kwargs)
+            arns.extend(result["taskArns"])
+            if not result.get("nextToken"):
+                break
+            kwargs["nextToken"] = result["nextToken"]
+
+        busy = 0
+        size = self.GET_TASK_PROTECTION_BATCH_SIZE
+        for batch in (arns[i : i + size] for i in range(0, len(arns), size)):
+            result = self.ecs.get_task_protection(cluster=cluster, tasks=batch)
+            if result.get("failures"):
+                logger.error("ECS Get Task Protection Failed: %s", result["failures"])
+            busy += sum(
+                1 for task in result["protectedTasks"] if task.get("protectionEnabled")
+            )
+        return busy
+
+    def set_desired_count(self, rule, count):
+        """
+        Update the desired count of the service unless the cached count already matches
+        :return: True if update_service was called
+        """
+        key = (rule[self.CLUSTER_NAME], rule[self.SERVICE_NAME])
+        with self._lock:
+            if not self._is_stale(rule) and self._cached_count(key) == count:
+                self.stats["updates_skipped"] += 1
+                logger.info("Service: %s %s already at %s count", key[0], key[1], count)
+                return False
+
+        self.ecs.update_service(cluster=key[0], service=key[1], desiredCount=count)
+        logger.info("Setting: %s %s to %s count", key[0], key[1], count)
+
+        with self._lock:
+            self.stats["updates_issued"] += 1
+            entry = self._service_counts.get(key)
+            if entry is None:
+                # Not reconciled yet - the entry is stale so the next update is issued
+                entry = self._service_counts[key] = {
+                    "observed": None,
+                    "requested": None,
+                    "reconciled": 0,
+                }
+            entry["requested"] = count
+        return True
+
+    def reconcile_stale(self, rules):
+        """
+        Refresh the cached desired counts of the rules older than service_cache_ttl with batched describe_services calls
+        """
+        stale = [rule for rule in rules if self._is_stale(rule)]
+        if stale:
+            self._reconcile(stale, self.describe_services(stale))
+
+    def _cached_count(self, key):
+        entry = self._service_counts.get(key)
+        if entry is None:
+            return None
+        return entry["observed"] if entry["requested"] is None else entry["requested"]
+
+    def _is_stale(self, rule):
+        entry = self._service_counts.get(
+            (rule[self.CLUSTER_NAME], rule[self.SERVICE_NAME])
+        )
+        return (
+            entry is None or time.time() - entry["reconciled"] > self.service_cache_ttl
+        )
+
+    def _reconcile(self, rules, descriptions):
+        """
+        Replace the cached counts with the desired counts observed in the service descriptions
+        """
+        now = time.time()
+        with self._lock:
+            for rule in rules:
+                key = (rule[self.CLUSTER_NAME], rule[self.SERVICE_NAME])
+                description = descriptions.get(key)
+                if description and "desiredCount" in description:
+                    self._service_counts[key] = {
+                        "observed": description["desiredCount"],
+                        "requested": None,
+                        "reconciled": now,
+                    }
                 else:
-                    logger.info(
-                        "Service: %s %s is in state: %s; Desired count will not be adjusted",
-                        rule[self.CLUSTER_NAME],
-                        rule[self.SERVICE_NAME],
-                        current_state,
-                    )
+                    self._service_counts.pop(key, None)
 
-                self.log_queue_depth(queue_attributes, rule)
+    def _uses_descriptions(self):
+        return type(self).service_state is not Provisioner.service_state
 
-            except ClientError as ce:
-                logger.exception("Failed to update resources for rule %s", rule)
-                self.notify(ce, context=rule)
+    def describe_services(self, rules):
+        """
+        Get the descriptions of the services for the rules with one describe_services call per 10 services per cluster
+        :return: dict of (cluster, service) to description. Unknown services are omitted.
+        """
+        services = defaultdict(list)
+        for rule in rules:
+            if rule[self.SERVICE_NAME] not in services[rule[self.CLUSTER_NAME]]:
+                services[rule[self.CLUSTER_NAME]].append(rule[self.SERVICE_NAME])
+
+        descriptions = {}
+        for cluster, names in services.items():
+            size = self.DESCRIBE_SERVICES_BATCH_SIZE
+            for batch in (names[i : i + size] for i in range(0, len(names), size)):
+                try:
+                    result = self.ecs.describe_services(
+                        cluster=cluster, services=batch, include=["TAGS"]
+                    )
+                except ClientError as ce:
+                    logger.exception("Failed to describe services %s", batch)
+                    self.notify(ce, context={"cluster": cluster, "services": batch})
+                    continue
+
+                if result["failures"]:
+                    logger.error("ECS Describe Services Failed: %s", result["failures"])
+
+                for description in result["services"]:
+                    # The service may be named by either its name or arn in the rule
+                    for name in batch:
+                        if name in (
+                            description.get("serviceName"),
+                            description.get("serviceArn"),
+                        ):
+                            descriptions[(cluster, name)] = description
+        return descriptions
 
     def get_description(self, rule):
         """
@@ -134,7 +471,13 @@ class Provisioner:
 
         The api specifies the ability to get the tags, but by observation they are not returned even when requested.
         Use get_tags.
+
+        During a run the description is served from the batch fetched at the start of the pass.
         """
+        key = (rule[self.CLUSTER_NAME], rule[self.SERVICE_NAME])
+        if self._descriptions:
+            return self._descriptions.get(key, {})
+
         result = self.ecs.describe_services(
             cluster=rule[self.CLUSTER_NAME],
             services=[rule[self.SERVICE_NAME]],
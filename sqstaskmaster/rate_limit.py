@@ -0,0 +1,160 @@
+import logging
+import math
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from sqstaskmaster.sqlite import transaction
+
+logger = logging.getLogger(__name__)
+"""
+Client side rate limiting of the consume loop with a token bucket per task name. A task is yielded only when its
+bucket has a token; otherwise the message is re-enqueued with a short delay so that the worker moves on to other work
+instead of blocking until a token is available. The new message starts with a receive count of one, so throttling
+does not move a task towards the dead letter queue. On a FIFO queue the visibility of the message is changed instead,
+which counts as a receive. Buckets are local to the process by default, or shared by
+the worker processes on a host with a SQLite database file.
+"""
+
+
+def take(tokens, updated, rate, burst, now, count=1):
+    """
+    Refill a token bucket and take count tokens if available
+    :param tokens: the tokens in the bucket when last updated, None for a new bucket
+    :param updated: the time the bucket was last updated
+    :param rate: tokens added per second
+    :param burst: the capacity of the bucket
+    :param now: the current time
+    :param count: tokens to take
+    :return: tuple of the tokens left and the seconds to wait, 0 if the tokens were taken
+    """
+    if tokens is None:
+        tokens = burst
+    else:
+        tokens = min(burst, tokens + max(0, now - updated) * rate)
+
+    if tokens >= count:
+        return tokens - count, 0
+    return tokens, (count - tokens) / rate
+
+
+class BucketStore(ABC):
+    """
+    Storage for the state of the token buckets.
+    """
+
+    @abstractmethod
+    def take(self, key, rate, burst, count=1):
+        """
+        :param key: the bucket key
+        :param rate: tokens added per second
+        :param burst: the capacity of the bucket
+        :param count: tokens to take
+        :return: seconds to wait until the tokens are available, 0 if they were taken
+        """
+
+
+class MemoryBucketStore(BucketStore):
+    """
+    Buckets local to the process.
+    """
+
+    def __init__(self):
+        # key -> (tokens, updated)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, count=1):
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (None, now))
+            tokens, wait = take(tokens, updated, rate, burst, now, count)
+            self._buckets[key] = (tokens, now)
+            return wait
+
+
+class SQLiteBucketStore(BucketStore):
+    """
+    Buckets stored in a SQLite database file.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+
+    def take(self, key, rate, burst, count=1):
+        now = time.time()
+        with transaction(self.path, self.timeout) as connection:
+            row = connection.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row is not None else (None, now)
+            tokens, wait = take(tokens, updated, rate, burst, now, count)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, now)
+            )
+            return wait
+
+
+class RateLimiter:
+    """
+    Opt in rate limiting for TaskManager.task_generator.
+
+    limiter = RateLimiter({'Recompute': 5, 'Export': (0.5, 10)}, store=SQLiteBucketStore('/tmp/buckets.db'))
+    for task, kwargs, message in tm.task_generator(sqs_timeout=30, rate_limiter=limiter):
+        ...
+
+    Tasks without a limit are not throttled.
+    """
+
+    def __init__(self, limits, store=None, max_defer=60, jitter=0.5):
+        """
+        :param limits: dict of task name to the rate in tasks per second, or a tuple of rate and burst. The burst
+                       defaults to the rate, and at least 1.
+        :param store: the BucketStore, a MemoryBucketStore by default
+        :param max_defer: the maximum seconds a throttled message is deferred
+        :param jitter: fraction of the wait added at random to the deferral, so that deferred messages do not all
+                       return at once
+        """
+        self.limits = {}
+        for task, limit in limits.items():
+            rate, burst = limit if isinstance(limit, tuple) else (limit, None)
+            burst = max(1, rate) if burst is None else burst
+            if rate <= 0:
+                raise ValueError(
+                    "Rate {} for task {} must be greater than zero".format(rate, task)
+                )
+            if burst < 1:
+                raise ValueError(
+                    "Burst {} for task {} must be at least 1".format(burst, task)
+                )
+            self.limits[task] = (rate, burst)
+
+        if max_defer < 1:
+            raise ValueError("Max defer {} must be at least 1".format(max_defer))
+
+        self.store = store or MemoryBucketStore()
+        self.max_defer = max_defer
+        self.jitter = jitter
+
+    def acquire(self, task):
+        """
+        Take a token for the task
+        :return: seconds to wait until a token is available, 0 if the task may run
+        """
+        limit = self.limits.get(task)
+        if limit is None:
+            return 0
+        return self.store.take(task, *limit)
+
+    def defer_seconds(self, wait):
+        """
+        :return: the delay or visibility timeout for a message throttled for wait seconds
+        """
+        wait *= 1 + random.random() * self.jitter
+        return max(1, min(self.max_defer, math.ceil(wait)))
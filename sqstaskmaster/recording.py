@@ -0,0 +1,165 @@
+import gzip
+import json
+import logging
+import threading
+import time
+
+from sqstaskmaster.dead_letter import SENT_TIMESTAMP
+from sqstaskmaster.fifo import MESSAGE_DEDUPLICATION_ID, MESSAGE_GROUP_ID
+from sqstaskmaster.task_manager import MAX_BATCH_ENTRIES
+
+logger = logging.getLogger(__name__)
+"""
+Recording and replay of queue traffic to reproduce production load locally. Messages are recorded with their body,
+attributes and arrival time as gzipped json lines, either as the task_generator receives them or by peeking a queue,
+and replayed into a LocalQueue or any queue with the original inter-arrival times, optionally sped up.
+"""
+
+
+def arrival_time(message):
+    """
+    :return: epoch seconds the message was sent to the queue, or now when the SentTimestamp attribute is missing
+    """
+    sent = (message.attributes or {}).get(SENT_TIMESTAMP)
+    return int(sent) / 1000 if sent is not None else time.time()
+
+
+class Recorder:
+    """
+    Appends messages to a gzipped json lines file. Pass to the task_generator to record the messages it receives.
+
+    with Recorder('/tmp/traffic.jsonl.gz') as recorder:
+        for task, kwargs, message in tm.task_generator(sqs_timeout=30, recorder=recorder):
+            ...
+    """
+
+    def __init__(self, path, compresslevel=6):
+        self.path = path
+        self.count = 0
+        self._file = gzip.open(path, "at", compresslevel=compresslevel)
+        self._lock = threading.Lock()
+
+    def record(self, message):
+        line = json.dumps(
+            {
+                "time": arrival_time(message),
+                "message_id": message.message_id,
+                "body": message.body,
+                "attributes": message.attributes,
+                "message_attributes": message.message_attributes,
+            },
+            separators=(",", ":"),
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def peek(task_manager, recorder, visibility_timeout=30, empty_receives=3, limit=None):
+    """
+    Record the messages of a queue without deleting them. Received messages are hidden from the next receives until the
+    visibility timeout expires, so it should cover the whole peek; they are retried as usual afterwards.
+
+    :param task_manager: the TaskManager of the queue
+    :param recorder: the Recorder
+    :param visibility_timeout: seconds received messages stay hidden
+    :param empty_receives: receives in a row without a new message before the peek stops
+    :param limit: optional number of messages after which the peek stops
+    :return: the number of messages recorded
+    """
+    seen = set()
+    empty = 0
+    while empty < empty_receives and (limit is None or len(seen) < limit):
+        messages = task_manager.queue.receive_messages(
+            AttributeNames=["All"],
+            MessageAttributeNames=["All"],
+            MaxNumberOfMessages=MAX_BATCH_ENTRIES,
+            WaitTimeSeconds=1,
+            VisibilityTimeout=visibility_timeout,
+        )
+        messages = [m for m in messages if m.message_id not in seen]
+        if limit is not None:
+            messages = messages[: limit - len(seen)]
+        empty = 0 if messages else empty + 1
+        for message in messages:
+            seen.add(message.message_id)
+            recorder.record(message)
+
+    logger.info("Recorded %d messages from %s", len(seen), task_manager.url)
+    return len(seen)
+
+
+class Replayer:
+    """
+    Sends recorded messages to a queue with their original inter-arrival times divided by speed.
+
+    replayed = Replayer('/tmp/traffic.jsonl.gz', speed=10).replay(TaskManager(url, queue_constructor=LocalQueue))
+    """
+
+    def __init__(self, path, speed=1.0):
+        """
+        :param path: the recording
+        :param speed: the replay speed up; None sends the messages as fast as possible
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError("Speed {} must be greater than zero".format(speed))
+
+        self.path = path
+        self.speed = speed
+
+    def records(self):
+        """
+        :return: Iterator of the recorded dicts, read as a stream
+        """
+        with gzip.open(self.path, "rt") as fh:
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line)
+
+    def replay(self, task_manager, limit=None):
+        """
+        Send the recorded messages in the order of the file. A message recorded out of order is sent immediately
+        rather than early.
+
+        :param task_manager: the TaskManager of the queue to send to
+        :param limit: optional number of messages after which the replay stops
+        :return: the number of messages sent
+        """
+        start = time.monotonic()
+        first = None
+        sent = 0
+        for record in self.records():
+            if limit is not None and sent >= limit:
+                break
+
+            if first is None:
+                first = record["time"]
+            if self.speed is not None:
+                delay = start + (record["time"] - first) / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            fields = {}
+            if task_manager.fifo:
+                fields[MESSAGE_GROUP_ID] = record["attributes"][MESSAGE_GROUP_ID]
+                # Recorded bodies may repeat within the deduplication interval
+                fields[MESSAGE_DEDUPLICATION_ID] = record["message_id"]
+            task_manager.queue.send_message(
+                MessageBody=record["body"],
+                MessageAttributes=record["message_attributes"] or {},
+                **fields
+            )
+            sent += 1
+
+        logger.info("Replayed %d messages to %s", sent, task_manager.url)
+        return sent
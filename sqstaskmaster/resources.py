@@ -0,0 +1,160 @@
+import logging
+import math
+import os
+import resource
+import signal
+from contextlib import contextmanager
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+logger = logging.getLogger(__name__)
+"""
+Resource controls for several worker processes on a host. Each worker takes a slot: it is pinned to its share of the
+CPUs and the OpenMP and BLAS thread pools are sized to that share, so that N workers do not oversubscribe the cores.
+Address space and CPU time limits are applied to each task and removed when it exits.
+"""
+
+# Read by the OpenMP and BLAS libraries when their thread pools start
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def available_cpus():
+    """
+    :return: sorted list of the CPUs the process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ResourcePolicy:
+    """
+    Pass to a MessageHandler, which applies the policy when it is entered.
+
+    policy = ResourcePolicy.for_slot(int(os.environ['WORKER_SLOT']), 4, address_space=8 * 2 ** 30, cpu_time=3600)
+    policy.apply()  # before importing numpy or xgboost, so that their thread pools start at the right size
+    with MyHandler(message, sqs_timeout=30, alarm_timeout=25, hard_timeout=300, resource_policy=policy) as handler:
+        handler.run()
+    """
+
+    def __init__(self, cpus=None, threads=None, address_space=None, cpu_time=None):
+        """
+        :param cpus: optional CPU ids to pin the worker to
+        :param threads: optional thread count for the OpenMP and BLAS pools, defaults to the number of cpus
+        :param address_space: optional RLIMIT_AS in bytes for each task; allocations beyond it raise MemoryError
+        :param cpu_time: optional CPU seconds for each task; the task raises TimeoutError when they are used
+        """
+        self.cpus = sorted(cpus) if cpus is not None else None
+        self.threads = (
+            threads if threads is not None else (len(self.cpus) if self.cpus else None)
+        )
+
+        if self.cpus is not None and not self.cpus:
+            raise ValueError("Cpus must not be empty")
+
+        if self.threads is not None and self.threads < 1:
+            raise ValueError(
+                "Threads {} must be greater than zero".format(self.threads)
+            )
+
+        if address_space is not None and address_space <= 0:
+            raise ValueError(
+                "Address space {} must be greater than zero".format(address_space)
+            )
+
+        if cpu_time is not None and cpu_time <= 0:
+            raise ValueError("Cpu time {} must be greater than zero".format(cpu_time))
+
+        self.address_space = address_space
+        self.cpu_time = cpu_time
+
+    @classmethod
+    def for_slot(cls, slot, slots, cpus=None, **kwargs):
+        """
+        Divide the cpus into slots contiguous shares. With more slots than cpus, slots share a cpu.
+        :param slot: the index of the worker on the host
+        :param slots: the number of workers on the host
+        :param cpus: the cpus to divide, defaults to the available cpus
+        :param kwargs: the other ResourcePolicy arguments
+        """
+        if not 0 <= slot < slots:
+            raise ValueError(
+                "Invalid slot {}; must be between 0 and {}".format(slot, slots - 1)
+            )
+
+        cpus = sorted(cpus) if cpus is not None else available_cpus()
+        if slots >= len(cpus):
+            return cls(cpus=[cpus[slot * len(cpus) // slots]], **kwargs)
+        share = cpus[slot * len(cpus) // slots : (slot + 1) * len(cpus) // slots]
+        return cls(cpus=share, **kwargs)
+
+    def apply(self):
+        """
+        Pin the process and size the thread pools. Thread pools already started are resized with threadpoolctl when
+        it is installed.
+        """
+        if self.cpus is not None:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, self.cpus)
+            else:
+                logger.warning("CPU affinity is not supported on this platform")
+
+        if self.threads is not None:
+            for name in THREAD_ENV_VARS:
+                os.environ[name] = str(self.threads)
+            if threadpoolctl is not None:
+                threadpoolctl.threadpool_limits(limits=self.threads)
+
+    @contextmanager
+    def limits(self):
+        """
+        Apply the address space and CPU time limits of a task for the duration of the block
+        """
+        previous = {}
+        handler = None
+        try:
+            if self.address_space is not None:
+                previous[resource.RLIMIT_AS] = self._set_soft_limit(
+                    resource.RLIMIT_AS, self.address_space
+                )
+
+            if self.cpu_time is not None:
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                handler = signal.signal(signal.SIGXCPU, self._handle_cpu_time)
+                # The limit is on the CPU time of the process, so add the time used by earlier tasks
+                previous[resource.RLIMIT_CPU] = self._set_soft_limit(
+                    resource.RLIMIT_CPU,
+                    math.ceil(usage.ru_utime + usage.ru_stime + self.cpu_time),
+                )
+            yield self
+        finally:
+            for limit, soft in previous.items():
+                resource.setrlimit(limit, (soft, resource.getrlimit(limit)[1]))
+            if handler is not None:
+                signal.signal(signal.SIGXCPU, handler)
+
+    @staticmethod
+    def _set_soft_limit(limit, value):
+        soft, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit, (value, hard))
+        return soft
+
+    def _handle_cpu_time(self, signum, frame):
+        raise TimeoutError("Hit CPU time limit {} for task".format(self.cpu_time))
+
+    def __str__(self):
+        return "ResourcePolicy(cpus: {}; threads: {}; address space: {}; cpu time: {})".format(
+            self.cpus, self.threads, self.address_space, self.cpu_time
+        )
@@ -0,0 +1,317 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from sqstaskmaster.dedupe import task_hash
+from sqstaskmaster.sqlite import transaction
+
+logger = logging.getLogger(__name__)
+"""
+Memoized results for deterministic tasks. A task whose result is cached for the same name and kwargs is acked by the
+task_generator without running, and submit skips enqueuing it. Handlers store the result of a successful run with
+ResultCache.put. Only cache tasks whose result depends on nothing but their kwargs.
+"""
+
+
+class ResultStore(ABC):
+    """
+    Storage for json encoded results by key. Expired and evicted results are misses.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """
+        :return: the encoded result of the key or None
+        """
+
+    @abstractmethod
+    def put(self, key, value):
+        """
+        Store the encoded result, replacing the previous result of the key
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """
+        Remove the result of the key if there is one
+        """
+
+    def contains(self, key):
+        """
+        :return: True if there is a result for the key
+        """
+        return self.get(key) is not None
+
+
+class MemoryResultStore(ResultStore):
+    """
+    In process LRU of at most max_size results.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        """
+        :param max_size: the number of results kept
+        :param ttl: optional seconds a result is kept
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class FileResultStore(ResultStore):
+    """
+    One json file per result in a directory shared by the worker processes on a host. The ttl runs from the time
+    the result was written and once there are more than max_size files the oldest are removed.
+    """
+
+    def __init__(self, directory, ttl=None, max_size=None):
+        """
+        :param directory: the cache directory, created if missing
+        :param ttl: optional seconds a result is kept
+        :param max_size: optional number of results kept; each put lists the directory to enforce it
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, "{}.json".format(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if (
+                self.ttl is not None
+                and os.path.getmtime(path) + self.ttl <= time.time()
+            ):
+                self.delete(key)
+                return None
+            with open(path) as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        # Write then rename so readers never see a partial result
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "w") as fh:
+            fh.write(value)
+        os.replace(tmp_path, path)
+
+        if self.max_size is not None:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".json"):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:
+                        pass
+
+        if len(entries) <= self.max_size:
+            return
+
+        entries.sort()
+        for _, path in entries[: len(entries) - self.max_size]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def contains(self, key):
+        try:
+            mtime = os.path.getmtime(self._path(key))
+        except FileNotFoundError:
+            return False
+        return self.ttl is None or mtime + self.ttl > time.time()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteResultStore(ResultStore):
+    """
+    Results stored in a SQLite database file. Once there are more than max_size results the least recently used are
+    removed. Lookups only take the write lock on a hit to update its access time; call purge_expired periodically to
+    delete expired results.
+    """
+
+    def __init__(self, path, ttl=None, max_size=None, timeout=30):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.timeout = timeout
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+
+    def _select(self, column, key, now):
+        with transaction(self.path, self.timeout, immediate=False) as connection:
+            return connection.execute(
+                "SELECT {} FROM results WHERE key = ? AND (expires IS NULL OR expires > ?)".format(
+                    column
+                ),
+                (key, now),
+            ).fetchone()
+
+    def get(self, key):
+        now = time.time()
+        row = self._select("value", key, now)
+        if row is None:
+            return None
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return row[0]
+
+    def contains(self, key):
+        return self._select("1", key, time.time()) is not None
+
+    def put(self, key, value):
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, value, expires, now),
+            )
+            if self.max_size is not None:
+                connection.execute(
+                    "DELETE FROM results WHERE key IN "
+                    "(SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,),
+                )
+
+    def delete(self, key):
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def purge_expired(self):
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "DELETE FROM results WHERE expires IS NOT NULL AND expires <= ?",
+                (time.time(),),
+            )
+
+
+class KeyValueResultStore(ResultStore):
+    """
+    Results stored in a remote key value store shared by all workers. The client must implement the redis-py methods
+    set(name, value, ex=None), get(name) and delete(name), for instance redis.Redis(decode_responses=True). Size based
+    eviction is left to the server, for instance with maxmemory-policy allkeys-lru.
+    """
+
+    def __init__(self, client, ttl=None, prefix="sqstaskmaster:results:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def put(self, key, value):
+        self.client.set(
+            self.prefix + key, value, ex=int(self.ttl) if self.ttl is not None else None
+        )
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class ResultCache:
+    """
+    Pass to a TaskManager to skip tasks with a cached result.
+
+    cache = ResultCache(SQLiteResultStore('/tmp/results.db', ttl=24 * 60 * 60), tasks={'Geocode'})
+    tm = TaskManager(sqs_url, result_cache=cache)
+    for task, kwargs, message in tm.task_generator(sqs_timeout=30):
+        with GeocodeHandler(message, sqs_timeout=30, alarm_timeout=25, hard_timeout=300, **kwargs) as handler:
+            cache.put(task, kwargs, handler.run())
+    """
+
+    def __init__(self, store, tasks=None):
+        """
+        :param store: the ResultStore
+        :param tasks: optional names of the deterministic tasks to cache, all tasks by default
+        """
+        self.store = store
+        self.tasks = frozenset(tasks) if tasks is not None else None
+
+    def cacheable(self, task):
+        return self.tasks is None or task in self.tasks
+
+    def lookup(self, task, kwargs):
+        """
+        :return: tuple of True and the cached result, or False and None on a miss
+        """
+        if not self.cacheable(task):
+            return False, None
+
+        value = self.store.get(task_hash(task, kwargs))
+        if value is None:
+            return False, None
+        return True, json.loads(value)["result"]
+
+    def contains(self, task, kwargs):
+        """
+        :return: True if the result of the task is cached, without decoding it
+        """
+        return self.cacheable(task) and self.store.contains(task_hash(task, kwargs))
+
+    def put(self, task, kwargs, result):
+        """
+        Store the json serializable result of the task. Results of tasks that are not cached are ignored.
+        """
+        if not self.cacheable(task):
+            return
+        # Wrapped so that a None result is a hit
+        self.store.put(task_hash(task, kwargs), json.dumps({"result": result}))
+
+    def invalidate(self, task, kwargs):
+        self.store.delete(task_hash(task, kwargs))
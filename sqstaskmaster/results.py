@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+from sqstaskmaster.sqlite import transaction
+
+logger = logging.getLogger(__name__)
+
+JOB_ID = "job_id"
+SHARD = "shard"
+ITEMS = "items"
+
+
+class ResultBackend(ABC):
+    """
+    Storage for the results of the shards of a job submitted with TaskManager.map.
+    Consumer handlers report completion of a shard with put or report, the Job handle reads the results.
+    Results must be json serializable.
+    """
+
+    @abstractmethod
+    def put(self, job_id, shard, result):
+        """
+        Store the result of a shard. Storing a shard again replaces the result.
+        """
+
+    @abstractmethod
+    def results(self, job_id):
+        """
+        :return: dict of shard index to result for the completed shards of the job
+        """
+
+    def count(self, job_id):
+        return len(self.results(job_id))
+
+    def report(self, kwargs, result):
+        """
+        Store the result of a shard using the kwargs the consumer received for it
+        :param kwargs: the task kwargs including job_id and shard
+        :param result: the shard result
+        """
+        self.put(kwargs[JOB_ID], kwargs[SHARD], result)
+
+
+class FileResultBackend(ResultBackend):
+    """
+    One json file per shard in a directory per job. Suitable for tests and workers sharing a file system.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _job_directory(self, job_id):
+        return os.path.join(self.directory, str(job_id))
+
+    def put(self, job_id, shard, result):
+        directory = self._job_directory(job_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "{:d}.json".format(shard))
+
+        # Write then rename so readers never see a partial result
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "w") as fh:
+            json.dump(result, fh)
+        os.replace(tmp_path, path)
+
+    def results(self, job_id):
+        directory = self._job_directory(job_id)
+        if not os.path.isdir(directory):
+            return {}
+
+        results = {}
+        for name in os.listdir(directory):
+            shard, extension = os.path.splitext(name)
+            if extension == ".json":
+                with open(os.path.join(directory, name)) as fh:
+                    results[int(shard)] = json.load(fh)
+        return results
+
+    def count(self, job_id):
+        directory = self._job_directory(job_id)
+        if not os.path.isdir(directory):
+            return 0
+        return sum(1 for name in os.listdir(directory) if name.endswith(".json"))
+
+
+class SQLiteResultBackend(ResultBackend):
+    """
+    Results stored in a SQLite database file. Each call opens its own connection so the backend can be shared by
+    threads and processes on a host.
+    """
+
+    def __init__(self, path, timeout=30):
+        """
+        :param path: the database file
+        :param timeout: seconds to wait for a lock held by another connection
+        """
+        self.path = path
+        self.timeout = timeout
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(job_id TEXT, shard INTEGER, result TEXT, PRIMARY KEY (job_id, shard))"
+            )
+
+    def put(self, job_id, shard, result):
+        with transaction(self.path, self.timeout) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                (str(job_id), shard, json.dumps(result)),
+            )
+
+    def results(self, job_id):
+        with transaction(self.path, self.timeout, immediate=False) as connection:
+            rows = connection.execute(
+                "SELECT shard, result FROM results WHERE job_id = ?", (str(job_id),)
+            ).fetchall()
+        return {shard: json.loads(result) for shard, result in rows}
+
+    def count(self, job_id):
+        with transaction(self.path, self.timeout, immediate=False) as connection:
+            (count,) = connection.execute(
+                "SELECT COUNT(*) FROM results WHERE job_id = ?", (str(job_id),)
+            ).fetchone()
+        return count
+
+
+class Job:
+    """
+    Handle for the shards of a job submitted with TaskManager.map.
+    A Job can be reconstructed in another process from the job_id, the number of shards and the backend.
+    """
+
+    def __init__(self, job_id, total, backend):
+        self.job_id = job_id
+        self.total = total
+        self.backend = backend
+
+    def progress(self):
+        """
+        :return: tuple of completed shards and total shards
+        """
+        return self.backend.count(self.job_id), self.total
+
+    def done(self):
+        completed, total = self.progress()
+        return completed >= total
+
+    def results(self, poll_interval=5, timeout=None):
+        """
+        Iterate over the shard results as they complete
+        :param poll_interval: seconds between checks of the backend
+        :param timeout: seconds to wait for all shards, None waits indefinitely
+        :return: Iterator[shard, result]
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        seen = set()
+        while True:
+            for shard, result in sorted(self.backend.results(self.job_id).items()):
+                if shard not in seen:
+                    seen.add(shard)
+                    yield shard, result
+
+            if len(seen) >= self.total:
+                return
+
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError(
+                    "Job {} completed {} of {} shards".format(
+                        self.job_id, len(seen), self.total
+                    )
+                )
+
+            logger.debug(
+                "Job %s completed %d of %d shards", self.job_id, len(seen), self.total
+            )
+            time.sleep(
+                poll_interval
+                if deadline is None
+                else max(0, min(poll_interval, deadline - time.time()))
+            )
+
+    def __str__(self):
+        return "Job(job_id: {}; total: {})".format(self.job_id, self.total)
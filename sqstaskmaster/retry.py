@@ -0,0 +1,147 @@
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-visibility-timeout.html
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+# Message attributes with the last error of a dead lettered message
+ERROR_TYPE = "error_type"
+ERROR_MESSAGE = "error_message"
+MAX_ERROR_MESSAGE_LENGTH = 1024
+
+
+def error_attributes(error):
+    """
+    :param error: the exception or None
+    :return: the SQS message attributes describing the error
+    """
+    if error is None:
+        return {}
+
+    attributes = {
+        ERROR_TYPE: {"StringValue": type(error).__name__, "DataType": "String"}
+    }
+    message = str(error)[:MAX_ERROR_MESSAGE_LENGTH]
+    # Empty attribute values are rejected by SQS
+    if message:
+        attributes[ERROR_MESSAGE] = {"StringValue": message, "DataType": "String"}
+    return attributes
+
+
+class RetryPolicy:
+    """
+    Retry policy for failed messages based on the SQS ApproximateReceiveCount attribute.
+
+    By default a failed message stays invisible for the remainder of the sqs timeout. Depending on the timeout that
+    either retries too slowly or hot loops. The policy sets the visibility of a failed message to an exponential
+    backoff with jitter instead:
+
+        backoff = min(cap, base * 2 ** (receive_count - 1))
+        visibility = uniform(backoff / 2, backoff)
+
+    After max_receives attempts a poison message is sent to the dead letter queue and deleted from the source queue
+    without waiting for the redrive policy of the queue. The dead lettered message keeps its message attributes and
+    gets the type and text of the last error in the error_type and error_message attributes, for instance to filter a
+    Redrive.
+
+    Usage:
+    policy = RetryPolicy(base=30, cap=3600, max_receives=5, dead_letter_queue=boto3.resource("sqs").Queue(dlq_url))
+    with MyHandler(message, sqs_timeout=30, alarm_timeout=25, hard_timeout=300, retry_policy=policy) as handler:
+        handler.run()
+
+    The task_generator requests all attributes and message attributes so the receive count and the sender are
+    available.
+    """
+
+    RECEIVE_COUNT = "ApproximateReceiveCount"
+
+    def __init__(
+        self,
+        base=30,
+        cap=MAX_VISIBILITY_TIMEOUT,
+        jitter=True,
+        max_receives=None,
+        dead_letter_queue=None,
+    ):
+        """
+        :param base: visibility timeout in seconds after the first failure
+        :param cap: maximum visibility timeout in seconds
+        :param jitter: randomize the backoff to spread retries of messages that failed together
+        :param max_receives: number of receives after which a failed message goes to the dead letter queue
+        :param dead_letter_queue: SQS Queue (or LocalQueue) for poison messages
+        """
+        if base < 0:
+            raise ValueError(
+                "Base backoff {} must be greater than or equal to zero".format(base)
+            )
+
+        if cap < base or cap > MAX_VISIBILITY_TIMEOUT:
+            raise ValueError(
+                "Backoff cap {} must be between base {} and 12 hours".format(cap, base)
+            )
+
+        if max_receives is not None and max_receives < 1:
+            raise ValueError(
+                "Max receives {} must be greater than zero".format(max_receives)
+            )
+
+        if (max_receives is None) != (dead_letter_queue is None):
+            raise ValueError(
+                "Max receives and dead letter queue must be specified together"
+            )
+
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.max_receives = max_receives
+        self.dead_letter_queue = dead_letter_queue
+
+    def receive_count(self, message):
+        return int((message.attributes or {}).get(self.RECEIVE_COUNT, 1))
+
+    def backoff(self, receive_count):
+        """
+        :param receive_count: the number of times the message has been received
+        :return: visibility timeout in seconds
+        """
+        backoff = min(self.cap, self.base * 2 ** max(0, receive_count - 1))
+        if self.jitter:
+            backoff = random.uniform(backoff / 2, backoff)
+        return int(backoff)
+
+    def exhausted(self, receive_count):
+        return self.max_receives is not None and receive_count >= self.max_receives
+
+    def handle_failure(self, message, error=None):
+        """
+        Set the visibility backoff for the failed message or move it to the dead letter queue.
+        Raises ClientError if the SQS calls fail.
+        :param message: the SQS message
+        :param error: optional exception of the failure, recorded on the dead lettered message
+        """
+        receive_count = self.receive_count(message)
+        if self.exhausted(receive_count):
+            logger.warning(
+                "Moving message %s to dead letter queue after %d receives",
+                message,
+                receive_count,
+            )
+            self.dead_letter_queue.send_message(
+                MessageBody=message.body,
+                MessageAttributes={
+                    **(message.message_attributes or {}),
+                    **error_attributes(error),
+                },
+            )
+            message.delete()
+        else:
+            seconds = self.backoff(receive_count)
+            logger.info(
+                "Retrying message %s in %d seconds after %d receives",
+                message,
+                seconds,
+                receive_count,
+            )
+            message.change_visibility(VisibilityTimeout=seconds)
@@ -0,0 +1,221 @@
+import logging
+import math
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+
+class ScalingPolicy(ABC):
+    """
+    Decides the desired number of workers for a Provisioner rule.
+    """
+
+    @abstractmethod
+    def desired_count(
+        self,
+        key,
+        backlog,
+        current_count,
+        active_size,
+        now,
+        history=None,
+        observed_backlog=None,
+    ):
+        """
+        :param key: identifies the service; policies keep their state per key
+        :param backlog: pending, in flight and delayed messages in the queue
+        :param current_count: the last known desired count of the service or None if unknown
+        :param active_size: the ACTIVE_SIZE of the rule
+        :param now: the current time in epoch seconds
+        :param history: the DepthHistory of the queue or None if not recorded
+        :param observed_backlog: the measured backlog when backlog is a forecast, defaults to backlog
+        :return: the desired count
+        """
+
+
+class AllOrNothingPolicy(ScalingPolicy):
+    """
+    The default policy: ACTIVE_SIZE workers while there are messages in the queue, otherwise zero.
+    Simple and only wasteful at the tail end of a large process queue.
+    """
+
+    def desired_count(
+        self,
+        key,
+        backlog,
+        current_count,
+        active_size,
+        now,
+        history=None,
+        observed_backlog=None,
+    ):
+        return active_size if backlog > 0 else 0
+
+
+class ProportionalPolicy(ScalingPolicy):
+    """
+    Scale the workers in proportion to the backlog so that it drains in about target_drain_time seconds:
+
+        desired = ceil(backlog / (throughput * target_drain_time)) bounded by min_size and max_size
+
+    The per worker throughput (messages per second) starts from the configured estimate and is updated with an
+    exponentially weighted average of the observed drain rate. Messages drained and worker seconds are accumulated
+    across polls, including polls where nothing finished, until min_completions messages have drained, so that polls
+    shorter than a task do not bias the estimate up. Arrivals during the window are not observed, so the measurement
+    is a lower bound. The throughput is measured on the observed backlog, not on the forecast of a PredictivePolicy.
+
+    To avoid thrashing the service count, changes within the hysteresis fraction of the current count are ignored, and
+    a change is only made after the scale up or scale down cooldown since the last change. Beware that scaling in stops
+    running tasks unless the workers drain gracefully or are protected.
+    """
+
+    def __init__(
+        self,
+        throughput,
+        target_drain_time,
+        min_size=0,
+        max_size=None,
+        scale_up_cooldown=60,
+        scale_down_cooldown=300,
+        hysteresis=0.1,
+        smoothing=0.3,
+        min_completions=3,
+    ):
+        """
+        :param throughput: initial estimate of messages per second processed by one worker
+        :param target_drain_time: seconds in which the backlog should be processed
+        :param min_size: minimum count while there is a backlog, and when idle
+        :param max_size: maximum count, defaults to the ACTIVE_SIZE of the rule
+        :param scale_up_cooldown: seconds after a change before scaling up again
+        :param scale_down_cooldown: seconds after a change before scaling down again
+        :param hysteresis: fraction of the current count within which changes are ignored
+        :param smoothing: weight of the newest throughput measurement
+        :param min_completions: messages drained in a measurement window before the throughput is updated
+        """
+        if throughput <= 0:
+            raise ValueError(
+                "Throughput {} must be greater than zero".format(throughput)
+            )
+
+        if target_drain_time <= 0:
+            raise ValueError(
+                "Target drain time {} must be greater than zero".format(
+                    target_drain_time
+                )
+            )
+
+        if min_size < 0 or (max_size is not None and max_size < min_size):
+            raise ValueError(
+                "Invalid size bounds min {} max {}".format(min_size, max_size)
+            )
+
+        if not 0 < smoothing <= 1:
+            raise ValueError("Smoothing {} must be in (0, 1]".format(smoothing))
+
+        if min_completions < 1:
+            raise ValueError(
+                "Min completions {} must be greater than zero".format(min_completions)
+            )
+
+        self.throughput = throughput
+        self.target_drain_time = target_drain_time
+        self.min_size = min_size
+        self.max_size = max_size
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.hysteresis = hysteresis
+        self.smoothing = smoothing
+        self.min_completions = min_completions
+
+        # key -> state of the last decision
+        self._state = {}
+
+    def throughput_for(self, key):
+        state = self._state.get(key)
+        return self.throughput if state is None else state["throughput"]
+
+    def _observe(self, state, backlog, now):
+        elapsed = now - state["time"]
+        workers = state["count"]
+        if elapsed <= 0:
+            return
+
+        if not workers or state["backlog"] <= 0:
+            # Idle workers say nothing about the throughput
+            state.update(drained=0, work=0)
+            return
+
+        state["drained"] += max(0, state["backlog"] - backlog)
+        state["work"] += elapsed * workers
+        if state["drained"] >= self.min_completions:
+            measured = state["drained"] / state["work"]
+            state["throughput"] += self.smoothing * (measured - state["throughput"])
+            state.update(drained=0, work=0)
+
+    def target(self, key, backlog, active_size):
+        """
+        :return: the bounded count proportional to the backlog, ignoring cooldowns and hysteresis
+        """
+        max_size = active_size if self.max_size is None else self.max_size
+        if backlog <= 0:
+            return min(self.min_size, max_size)
+
+        count = math.ceil(backlog / (self.throughput_for(key) * self.target_drain_time))
+        return max(self.min_size, 1, min(count, max_size))
+
+    def desired_count(
+        self,
+        key,
+        backlog,
+        current_count,
+        active_size,
+        now,
+        history=None,
+        observed_backlog=None,
+    ):
+        observed = backlog if observed_backlog is None else observed_backlog
+        state = self._state.get(key)
+        if state is None:
+            state = self._state[key] = {
+                "throughput": self.throughput,
+                "changed": None,
+                "time": now,
+                "backlog": observed,
+                "count": current_count,
+                # Messages drained and worker seconds of the measurement window
+                "drained": 0,
+                "work": 0,
+            }
+        else:
+            self._observe(state, observed, now)
+
+        target = self.target(key, backlog, active_size)
+        desired = target
+
+        if current_count is not None and target != current_count:
+            cooldown = (
+                self.scale_up_cooldown
+                if target > current_count
+                else self.scale_down_cooldown
+            )
+            in_band = (
+                target != 0
+                and abs(target - current_count) <= self.hysteresis * current_count
+            )
+            cooling = state["changed"] is not None and now - state["changed"] < cooldown
+            if in_band or cooling:
+                logger.debug(
+                    "Holding %s at %s instead of %s (hysteresis %s cooldown %s)",
+                    key,
+                    current_count,
+                    target,
+                    in_band,
+                    cooling,
+                )
+                desired = current_count
+
+        if desired != current_count:
+            state["changed"] = now
+
+        state.update(time=now, backlog=observed, count=desired)
+        return desired
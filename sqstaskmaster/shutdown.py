@@ -0,0 +1,99 @@
+import logging
+import math
+import signal
+import time
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+
+class ShutdownCoordinator:
+    """
+    Coordinates a graceful exit of a worker process when the container is asked to stop.
+
+    ECS sends SIGTERM when a service is scaled in (for instance by the Provisioner setting the desiredCount to 0) and
+    SIGKILL once the stop timeout expires. Without a drain, the message being processed stays invisible until the
+    sqs_timeout expires which may be hours for long running tasks.
+
+    The drain has three steps:
+     1. Stop polling: TaskManager.task_generator checks the coordinator before each receive and returns.
+     2. Let the current MessageHandler finish within the grace period: the alarm is rearmed to fire no later than the
+        deadline and the handler raises TimeoutError if it is still working.
+     3. Release anything unfinished or prefetched by setting the visibility to 0 so another worker picks it up in
+        seconds.
+
+    Usage:
+    shutdown = ShutdownCoordinator(grace_period=20).install()
+    for task, kwargs, message in TaskManager(sqs_url).task_generator(shutdown=shutdown):
+        with MyHandler(message, sqs_timeout=30, alarm_timeout=25, hard_timeout=300, shutdown=shutdown) as handler:
+            handler.run()
+
+    The grace period should be less than the ECS stopTimeout for the container.
+    """
+
+    def __init__(self, grace_period=20, signals=(signal.SIGTERM,)):
+        """
+        :param grace_period: seconds the current handler may continue after shutdown is requested
+        :param signals: the signals which request a shutdown
+        """
+        if grace_period < 0:
+            raise ValueError(
+                "Grace period {} must be greater than or equal to zero".format(
+                    grace_period
+                )
+            )
+
+        self.grace_period = grace_period
+        self.signals = signals
+        self._requested_at = None
+
+    def install(self):
+        for signum in self.signals:
+            signal.signal(signum, self._handle_signal)
+        return self
+
+    def _handle_signal(self, signum, frame):
+        logger.warning("Received signal %s; draining worker", signum)
+        self.request()
+
+    def request(self):
+        """
+        Request shutdown. The first request starts the grace period, later requests are ignored.
+        """
+        if self._requested_at is not None:
+            return
+
+        self._requested_at = time.time()
+
+        # If a MessageHandler alarm is pending, make sure it fires no later than the end of the grace period
+        remaining = signal.alarm(0)
+        if remaining:
+            signal.alarm(min(remaining, max(1, math.ceil(self.grace_period))))
+
+    @property
+    def requested(self):
+        return self._requested_at is not None
+
+    def time_remaining(self):
+        """
+        :return: seconds left in the grace period, or None if shutdown has not been requested
+        """
+        if self._requested_at is None:
+            return None
+        return max(0.0, self._requested_at + self.grace_period - time.time())
+
+    def expired(self):
+        return self.requested and self.time_remaining() <= 0
+
+    def release(self, message):
+        """
+        Make the message immediately visible to other workers
+        :param message: the SQS message
+        """
+        try:
+            message.change_visibility(VisibilityTimeout=0)
+            logger.info("Released message %s", message)
+        except ClientError:
+            # The message will become visible when the sqs timeout expires
+            logger.exception("Failed to release message %s", message)
@@ -0,0 +1,305 @@
+import heapq
+import logging
+import math
+import random
+from array import array
+from collections import deque
+
+from sqstaskmaster.forecast import DepthHistory
+
+logger = logging.getLogger(__name__)
+"""
+Offline backtesting of scaling policies. A trace of message arrivals is replayed against a simulated queue and ECS
+service with a simulated clock. The policy is asked for the desired count every interval seconds as the Provisioner
+would, new workers become ready after the startup delay, and surplus workers stop when idle or after their current task.
+"""
+
+SIMULATION_KEY = ("simulation", "simulation")
+
+
+def arrivals_from_history(history):
+    """
+    Convert a recorded DepthHistory to an arrival trace. The first sample is the initial backlog and the arrival rate
+    of each later sample is spread over the interval before it.
+    :return: list of (time, count)
+    """
+    arrivals = []
+    previous = None
+    for time, depth, rate in history.samples():
+        if previous is None:
+            count = int(round(depth))
+        else:
+            count = int(round(rate * (time - previous)))
+        if count > 0:
+            arrivals.append((time, count))
+        previous = time
+    return arrivals
+
+
+def poisson_arrivals(rate, duration, start=0, interval=1, seed=None):
+    """
+    A synthetic trace of arrivals at rate messages per second, counted in buckets of interval seconds
+    :return: list of (time, count)
+    """
+    rng = random.Random(seed)
+    buckets = {}
+    time = start + rng.expovariate(rate)
+    while time < start + duration:
+        bucket = start + math.floor((time - start) / interval) * interval
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+        time += rng.expovariate(rate)
+    return sorted(buckets.items())
+
+
+def percentile(values, q):
+    """
+    :param values: sorted values
+    :param q: the percentile in [0, 100]
+    :return: the nearest rank percentile or None if there are no values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+class SimulationResult:
+    """
+    The outcome of a simulation:
+
+    worker_hours: hours of provisioned workers including startup
+    drain_time: seconds from the last arrival until the queue was empty, None if it did not drain
+    completed: number of processed messages
+    remaining: number of messages left in the queue or in flight at the end
+    max_backlog: maximum number of queued and in flight messages
+    wait_percentiles: dict of percentile to seconds a message waited in the queue before a worker took it
+    scale_events: number of changes of the desired count
+    """
+
+    def __init__(
+        self,
+        worker_hours,
+        drain_time,
+        completed,
+        remaining,
+        max_backlog,
+        wait_percentiles,
+        scale_events,
+    ):
+        self.worker_hours = worker_hours
+        self.drain_time = drain_time
+        self.completed = completed
+        self.remaining = remaining
+        self.max_backlog = max_backlog
+        self.wait_percentiles = wait_percentiles
+        self.scale_events = scale_events
+
+    def __str__(self):
+        return (
+            "SimulationResult(worker_hours: {:.2f}; drain_time: {}; completed: {}; remaining: {}; "
+            "max_backlog: {}; wait_percentiles: {}; scale_events: {})".format(
+                self.worker_hours,
+                self.drain_time,
+                self.completed,
+                self.remaining,
+                self.max_backlog,
+                self.wait_percentiles,
+                self.scale_events,
+            )
+        )
+
+
+class Simulator:
+    """
+    Replay arrival traces through a ScalingPolicy.
+
+    simulator = Simulator(active_size=20, startup_delay=90, duration=lambda rng: rng.lognormvariate(4, 0.5), seed=1)
+    for drain_time in (600, 1800, 3600):
+        result = simulator.run(ProportionalPolicy(0.02, drain_time), arrivals)
+
+    Policies keep state, so use a new policy instance for each run. The same seed replays the same task durations.
+    """
+
+    # Events at the same time are processed in this order
+    _READY = 0
+    _DONE = 1
+
+    def __init__(
+        self,
+        active_size,
+        startup_delay=60,
+        duration=60,
+        interval=10,
+        timeout=24 * 60 * 60,
+        history_interval=60,
+        percentiles=(50, 90, 99),
+        seed=None,
+    ):
+        """
+        :param active_size: the ACTIVE_SIZE of the simulated rule
+        :param startup_delay: seconds from requesting a worker until it takes messages
+        :param duration: seconds per task, or a callable of a random.Random returning the seconds
+        :param interval: seconds between Provisioner runs
+        :param timeout: seconds after the last arrival to stop the simulation if workers are still provisioned
+        :param history_interval: seconds between samples of the DepthHistory passed to the policy
+        :param percentiles: the wait percentiles to report
+        :param seed: seed for the task durations
+        """
+        if interval <= 0:
+            raise ValueError("Interval {} must be greater than zero".format(interval))
+
+        self.active_size = active_size
+        self.startup_delay = startup_delay
+        self.duration = duration
+        self.interval = interval
+        self.timeout = timeout
+        self.history_interval = history_interval
+        self.percentiles = percentiles
+        self.seed = seed
+
+    def run(self, policy, arrivals):
+        """
+        :param policy: the ScalingPolicy
+        :param arrivals: iterable of (time, count) of messages sent to the queue
+        :return: SimulationResult
+        """
+        arrivals = sorted(arrivals)
+        if not arrivals:
+            return SimulationResult(0.0, 0.0, 0, 0, 0, {}, 0)
+
+        rng = random.Random(self.seed)
+        duration = (
+            self.duration if callable(self.duration) else lambda _rng: self.duration
+        )
+        history = DepthHistory(min_interval=self.history_interval)
+
+        queue = deque()  # [arrival time, count]
+        queued = 0
+        waits = array("d")
+        events = []  # (time, kind, sequence)
+        sequence = 0
+
+        starting = idle = busy = retiring = cancelled = 0
+        current = 0
+        completed = max_backlog = scale_events = 0
+        worker_seconds = 0.0
+
+        last_arrival = arrivals[-1][0]
+        end = last_arrival + self.timeout
+        now = tick = arrivals[0][0]
+        drained_at = None
+        index = 0
+
+        while True:
+            next_arrival = arrivals[index][0] if index < len(arrivals) else math.inf
+            next_event = events[0][0] if events else math.inf
+            next_time = min(next_arrival, next_event, tick)
+            if next_time > end:
+                worker_seconds += (starting + idle + busy) * (end - now)
+                break
+
+            worker_seconds += (starting + idle + busy) * (next_time - now)
+            now = next_time
+
+            if next_arrival == now:
+                count = arrivals[index][1]
+                index += 1
+                queue.append([now, count])
+                queued += count
+                drained_at = None
+            elif next_event == now:
+                _, kind, _ = heapq.heappop(events)
+                if kind == self._READY:
+                    if cancelled:
+                        cancelled -= 1
+                    else:
+                        starting -= 1
+                        idle += 1
+                else:
+                    busy -= 1
+                    completed += 1
+                    if retiring:
+                        retiring -= 1
+                    else:
+                        idle += 1
+            else:
+                backlog = queued + busy
+                history.append(now, backlog)
+                desired = policy.desired_count(
+                    SIMULATION_KEY,
+                    backlog,
+                    current,
+                    self.active_size,
+                    now,
+                    history=history,
+                )
+                if desired != current:
+                    scale_events += 1
+                    current = desired
+
+                running = starting + idle + busy - retiring
+                if desired > running:
+                    revived = min(desired - running, retiring)
+                    retiring -= revived
+                    for _ in range(desired - running - revived):
+                        sequence += 1
+                        heapq.heappush(
+                            events, (now + self.startup_delay, self._READY, sequence)
+                        )
+                        starting += 1
+                elif desired < running:
+                    surplus = running - desired
+                    stopped = min(surplus, starting)
+                    starting -= stopped
+                    cancelled += stopped
+                    surplus -= stopped
+
+                    stopped = min(surplus, idle)
+                    idle -= stopped
+                    surplus -= stopped
+
+                    # Busy workers drain their current task before stopping
+                    retiring += surplus
+                tick += self.interval
+
+            # Dispatch queued messages to idle workers
+            while idle and queued:
+                entry = queue[0]
+                waits.append(now - entry[0])
+                entry[1] -= 1
+                queued -= 1
+                if not entry[1]:
+                    queue.popleft()
+                idle -= 1
+                busy += 1
+                sequence += 1
+                heapq.heappush(events, (now + duration(rng), self._DONE, sequence))
+
+            max_backlog = max(max_backlog, queued + busy)
+            if index == len(arrivals) and not queued and not busy:
+                if drained_at is None:
+                    drained_at = now
+                if not starting and not idle:
+                    break
+
+        waits = sorted(waits)
+        return SimulationResult(
+            worker_hours=worker_seconds / 3600,
+            drain_time=None if drained_at is None else drained_at - last_arrival,
+            completed=completed,
+            remaining=queued + busy,
+            max_backlog=max_backlog,
+            wait_percentiles={q: percentile(waits, q) for q in self.percentiles},
+            scale_events=scale_events,
+        )
+
+    def compare(self, policies, arrivals):
+        """
+        Run each policy against the same trace and durations
+        :param policies: dict of name to a callable returning a new ScalingPolicy
+        :param arrivals: iterable of (time, count)
+        :return: dict of name to SimulationResult
+        """
+        arrivals = list(arrivals)
+        return {
+            name: self.run(factory(), arrivals) for name, factory in policies.items()
+        }
@@ -0,0 +1,31 @@
+import logging
+import sqlite3
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+"""
+Transactions on a SQLite database file shared by the worker processes on a host. Each transaction opens its own
+connection so the stores are safe to use from any thread or forked process.
+"""
+
+
+@contextmanager
+def transaction(path, timeout=30, immediate=True):
+    """
+    :param path: the database file
+    :param timeout: seconds to wait for the lock held by another process
+    :param immediate: take the write lock up front so that a read and the write that depends on it are atomic across
+                      processes; a deferred transaction only takes the write lock on its first write
+    :return: context manager of the connection, committed on exit and rolled back on an exception
+    """
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    try:
+        connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.close()
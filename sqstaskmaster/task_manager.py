@@ -1,21 +1,91 @@
 import logging
 import json
+import math
+import time
+import uuid
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
 
 import boto3
+from botocore.exceptions import ClientError
 from json import JSONDecodeError
 from sqstaskmaster import local
+from sqstaskmaster.fifo import (
+    MAX_ID_LENGTH,
+    MESSAGE_DEDUPLICATION_ID,
+    MESSAGE_GROUP_ID,
+    TrackedMessage,
+    group_by_kwarg,
+    interleave_groups,
+    is_fifo,
+    message_group,
+)
+from sqstaskmaster.envelope import (
+    MAX_DELAY_SECONDS,
+    Coalescer,
+    Envelope,
+    MAX_ENVELOPE_SIZE,
+    SubMessage,
+    TASKS,
+)
+from sqstaskmaster.logs import Preview, message_context, message_fields
+from sqstaskmaster.metrics import DEPTH_ATTRIBUTES, QueueMetricsCache
+from sqstaskmaster.results import Job, JOB_ID, SHARD, ITEMS
 
 logger = logging.getLogger(__name__)
 
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/quotas-messages.html
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_SIZE = 256 * 1024
+
+# Body field with the epoch seconds before which a delayed task is re-enqueued rather than yielded
+NOT_BEFORE = "not_before"
+
 
 class TaskManager:
-    def __init__(self, sqs_url, notify=None, queue_constructor=None, sender_name=None):
+    def __init__(
+        self,
+        sqs_url,
+        notify=None,
+        queue_constructor=None,
+        sender_name=None,
+        metrics_cache=None,
+        group_id=None,
+        deduplication_id=None,
+        result_cache=None,
+    ):
+        """
+        :param metrics_cache: optional QueueMetricsCache shared with other components for attributes and depth
+        :param group_id: for FIFO queues, the name of the kwarg holding the message group id or a callable of task and
+                         kwargs returning it
+        :param deduplication_id: for FIFO queues, optional callable of task, kwargs and body returning the
+                                 deduplication id such as fifo.content_deduplication_id. Leave None when the queue
+                                 has ContentBasedDeduplication enabled.
+        :param result_cache: optional ResultCache; tasks with a cached result are not enqueued by submit and are acked
+                             without being yielded by the task_generator
+        """
         self.url = sqs_url
         self.sender_name = sender_name
+        self.metrics_cache = metrics_cache
+        self.fifo = is_fifo(sqs_url)
+        self.group_id = (
+            group_by_kwarg(group_id) if isinstance(group_id, str) else group_id
+        )
+        self.deduplication_id = deduplication_id
+        self.result_cache = result_cache
+
+        if (group_id is not None or deduplication_id is not None) and not self.fifo:
+            raise ValueError(
+                "Group and deduplication ids require a FIFO queue: {}".format(sqs_url)
+            )
 
         if queue_constructor is None:
             self.sqs = boto3.resource("sqs")
             self.queue = self.sqs.Queue(sqs_url)
+            if self.metrics_cache is None:
+                # Uncached, but only fetches the requested attributes
+                self.metrics_cache = QueueMetricsCache(self.sqs.meta.client, max_age=0)
         elif queue_constructor is local.LocalQueue:
             self.queue = queue_constructor(sqs_url)
             # TODO how to validate the boto3 SQS meta class or the Queue constructor?
@@ -25,10 +95,13 @@ class TaskManager:
                 "sqstaskmaster.local.LocalQueue".format(queue_constructor)
             )
 
+        self._queue_constructor = queue_constructor
         self._notify = notify
+        self._coalescer = None
 
-    def attributes(self):
+    def attributes(self, attribute_names=None, max_age=None):
         """
+        Get all the queue attributes, or only the attribute_names from the metrics cache of the TaskManager:
              'QueueArn': 'ARN_STRING',
              'ApproximateNumberOfMessages': '<int>',
              'ApproximateNumberOfMessagesNotVisible': '<int>',
@@ -42,33 +115,323 @@ class TaskManager:
              'ReceiveMessageWaitTimeSeconds': '<int>',
              'FifoQueue': 'true/false',
              'ContentBasedDeduplication': 'true/false'
+        :param attribute_names: optional list of the attributes to get
+        :param max_age: seconds a cached value may be served, defaults to max_age of the metrics cache
         :return: dict
         """
+        if attribute_names is not None and self.metrics_cache is not None:
+            return self.metrics_cache.get(self.url, attribute_names, max_age=max_age)
+
         self.queue.load()
-        return self.queue.attributes
+        attributes = self.queue.attributes
+        if attribute_names is not None:
+            return {name: attributes[name] for name in attribute_names}
+        return attributes
+
+    def depth(self, max_age=None):
+        """
+        :param max_age: seconds a cached value may be served, defaults to max_age of the metrics cache
+        :return: the number of visible, in flight and delayed messages in the queue
+        """
+        attributes = self.attributes(DEPTH_ATTRIBUTES, max_age=max_age)
+        return sum(int(attributes[name]) for name in DEPTH_ATTRIBUTES)
 
     def purge(self):
         self.queue.purge()
 
+    @staticmethod
+    def _encode(task, kwargs, not_before=None):
+        content = {"task": task, "kwargs": kwargs}
+        if not_before is not None:
+            content[NOT_BEFORE] = not_before
+        return json.dumps(content, default=lambda o: o.__str__())
+
+    def _message_attributes(self):
+        return {
+            "service_name": {
+                "StringValue": self.sender_name or "Unknown sender to: " + self.url,
+                "DataType": "String",
+            }
+        }
+
+    def _fifo_fields(self, task, kwargs, body):
+        """
+        :return: the MessageGroupId and MessageDeduplicationId send parameters for a FIFO queue
+        """
+        if not self.fifo:
+            return {}
+
+        if self.group_id is None:
+            raise ValueError(
+                "Submitting to FIFO queue {} requires a group_id".format(self.url)
+            )
+
+        fields = {MESSAGE_GROUP_ID: str(self.group_id(task, kwargs))[:MAX_ID_LENGTH]}
+        if self.deduplication_id is not None:
+            fields[MESSAGE_DEDUPLICATION_ID] = str(
+                self.deduplication_id(task, kwargs, body)
+            )[:MAX_ID_LENGTH]
+        return fields
+
     def submit(self, task, **kwargs):
-        body = json.dumps(
-            {"task": task, "kwargs": kwargs}, default=lambda o: o.__str__()
+        """
+        Send the task to the queue. Inside a coalesce block the task is buffered and None is returned unless the
+        buffer was sent. None is also returned when the result of the task is cached and it is not sent.
+        """
+        if self._cached(task, kwargs):
+            return None
+
+        body = self._encode(task, kwargs)
+        if self._coalescer is not None:
+            return self._coalescer.add(body)
+        return self._send(body, **self._fifo_fields(task, kwargs, body))
+
+    def _cached(self, task, kwargs):
+        """
+        :return: True if the result of the task is cached and it need not be sent
+        """
+        if self.result_cache is not None and self.result_cache.contains(task, kwargs):
+            logger.info("Skipped submitting task %s with a cached result", task)
+            return True
+        return False
+
+    def submit_after(self, delay, task, **kwargs):
+        """
+        Send the task to the queue to be received in delay seconds. Delays up to 15 minutes use the SQS DelaySeconds
+        of the message. Longer delays are chained: the message carries the time it is due and the task_generator
+        re-enqueues it with the remaining delay, up to 15 minutes at a time, until it is due.
+
+        Delayed tasks are sent immediately inside a coalesce block. Per message delays are not supported by FIFO queues.
+        Use sqstaskmaster.timer_wheel.LocalScheduler to schedule tasks in process instead.
+
+        :param delay: seconds until the task is received
+        :return: the send_message response or None when the result of the task is cached
+        """
+        if delay < 0:
+            raise ValueError(
+                "Invalid delay {} seconds; must be greater than or equal to zero".format(
+                    delay
+                )
+            )
+
+        if self.fifo and delay > 0:
+            raise ValueError(
+                "Per message delays are not supported by FIFO queue {}".format(self.url)
+            )
+
+        if self._cached(task, kwargs):
+            return None
+
+        not_before = time.time() + delay if delay > MAX_DELAY_SECONDS else None
+        body = self._encode(task, kwargs, not_before)
+        return self._send(
+            body,
+            DelaySeconds=min(MAX_DELAY_SECONDS, math.ceil(delay)),
+            **self._fifo_fields(task, kwargs, body)
         )
+
+    def submit_at(self, when, task, **kwargs):
+        """
+        Send the task to the queue to be received at when, see submit_after. Tasks due in the past are sent without
+        a delay.
+
+        :param when: datetime or epoch seconds
+        """
+        if hasattr(when, "timestamp"):
+            when = when.timestamp()
+        return self.submit_after(max(0, when - time.time()), task, **kwargs)
+
+    def _send(self, body, **fields):
         return self.queue.send_message(
-            MessageBody=body,
-            MessageAttributes={
-                "service_name": {
-                    "StringValue": self.sender_name or "Unknown sender to: " + self.url,
-                    "DataType": "String",
+            MessageBody=body, MessageAttributes=self._message_attributes(), **fields
+        )
+
+    def _send_batch(self, bodies):
+        """
+        Send message bodies with as few send_messages calls as the SQS batch limits allow.
+        Entries that fail in a batch are sent individually.
+        :param bodies: iterable of message bodies, or of tuples of body and FIFO fields
+        :return: the number of messages sent
+        """
+        attributes = self._message_attributes()
+        attributes_size = sum(
+            len(name) + len(value["StringValue"]) + len(value["DataType"])
+            for name, value in attributes.items()
+        )
+
+        sent = 0
+        entries, size = [], 0
+        for body in bodies:
+            fields = {}
+            if isinstance(body, tuple):
+                body, fields = body
+            body_size = len(body.encode("utf-8")) + attributes_size
+            if entries and (
+                len(entries) >= MAX_BATCH_ENTRIES or size + body_size > MAX_BATCH_SIZE
+            ):
+                sent += self._send_entries(entries)
+                entries, size = [], 0
+
+            entries.append(
+                {
+                    "Id": str(len(entries)),
+                    "MessageBody": body,
+                    "MessageAttributes": attributes,
+                    **fields,
                 }
-            },
+            )
+            size += body_size
+
+        if entries:
+            sent += self._send_entries(entries)
+        return sent
+
+    def _send_entries(self, entries):
+        response = self.queue.send_messages(Entries=entries)
+        failed = response.get("Failed", [])
+        if failed:
+            logger.warning("Retrying failed batch entries: %s", failed)
+            by_id = {entry["Id"]: entry for entry in entries}
+            for failure in failed:
+                entry = by_id[failure["Id"]]
+                self.queue.send_message(
+                    **{name: value for name, value in entry.items() if name != "Id"}
+                )
+        return len(entries)
+
+    def map(self, task, iterable, chunk_size=1, backend=None, job_id=None, **kwargs):
+        """
+        Split the iterable into shards of chunk_size items and submit a task for each shard using batched sends.
+
+        Each shard task receives the kwargs plus:
+            items: the list of items in the shard
+            job_id: the id of the job
+            shard: the index of the shard
+        The consumer handler reports the shard result with backend.report(kwargs, result). Shards with a cached result
+        are not sent; their result is reported to the backend instead.
+
+        job = tm.map('TrainModel', store_ids, chunk_size=50, backend=SQLiteResultBackend(path))
+        for shard, result in job.results():
+            ...
+
+        :param task: the task name
+        :param iterable: the items to process
+        :param chunk_size: the number of items per shard
+        :param backend: the ResultBackend the consumers report results to
+        :param job_id: optional id for the job, a random id is generated by default
+        :param kwargs: kwargs common to every shard
+        :return: Job handle
+        """
+        if chunk_size < 1:
+            raise ValueError(
+                "Invalid chunk size {}; must be greater than zero".format(chunk_size)
+            )
+
+        for name in (ITEMS, JOB_ID, SHARD):
+            if name in kwargs:
+                raise ValueError("The {} kwarg is reserved by map".format(name))
+
+        job_id = job_id or uuid.uuid4().hex
+        iterator = iter(iterable)
+        chunks = iter(lambda: list(islice(iterator, chunk_size)), [])
+
+        total = 0
+
+        def shards():
+            nonlocal total
+            for shard, chunk in enumerate(chunks):
+                total += 1
+                shard_kwargs = {**kwargs, ITEMS: chunk, JOB_ID: job_id, SHARD: shard}
+                if self.result_cache is not None:
+                    hit, result = self.result_cache.lookup(task, shard_kwargs)
+                    if hit:
+                        logger.info(
+                            "Skipped submitting shard %d with a cached result", shard
+                        )
+                        if backend is not None:
+                            backend.report(shard_kwargs, result)
+                        continue
+                body = self._encode(task, shard_kwargs)
+                yield body, self._fifo_fields(task, shard_kwargs, body)
+
+        self._send_batch(shards())
+
+        logger.info("Submitted job %s %s with %d shards", task, job_id, total)
+        return Job(job_id, total, backend)
+
+    @contextmanager
+    def coalesce(self, max_size=MAX_ENVELOPE_SIZE):
+        """
+        Pack the tasks submitted in the block into as few messages as possible. Use for many small tasks where the
+        SQS send, receive, delete and visibility calls dominate the cost of the task.
+
+        with tm.coalesce():
+            for merchant in merchants:
+                tm.submit('Recompute', merchant=merchant)
+
+        The task_generator unpacks the tasks and yields each with its own message. Tasks that are not acked are
+        re-enqueued once every task in the envelope has been yielded, delayed by their last visibility change such as
+        the backoff of a RetryPolicy, then the envelope is deleted.
+
+        The tasks submitted before an exception in the block are still sent.
+
+        :param max_size: maximum size of each message body in bytes
+        """
+        if self._coalescer is not None:
+            raise RuntimeError("TaskManager is already coalescing tasks")
+
+        if self.fifo:
+            # Envelopes mix groups and re-enqueued tasks would lose their order
+            raise RuntimeError(
+                "Coalescing is not supported for FIFO queue {}".format(self.url)
+            )
+
+        self._coalescer = Coalescer(self._send, max_size=max_size)
+        try:
+            yield self
+        finally:
+            # Submit returned for the buffered tasks, so they are sent even when the block raises
+            try:
+                self._coalescer.flush()
+            finally:
+                self._coalescer = None
+
+    def redrive(self, dead_letter_url, **kwargs):
+        """
+        Re-send the messages of a dead letter queue to this queue in batches and delete them from the dead letter
+        queue. See sqstaskmaster.dead_letter.Redrive for the filter, rate, dry run and checkpoint options.
+
+        :param dead_letter_url: the url of the dead letter queue
+        :return: RedriveStats
+        """
+        # Imported here since the dead_letter module uses the batch limits of this one
+        from sqstaskmaster.dead_letter import Redrive
+
+        dead_letter = TaskManager(
+            dead_letter_url,
+            notify=self._notify,
+            queue_constructor=self._queue_constructor,
+            metrics_cache=self.metrics_cache,
         )
+        return Redrive(dead_letter, self, **kwargs).run()
 
     def notify(self, exception, context=None):
+        """
+        :param context: dict, or callable returning the dict so that it is only built when there is a notifier
+        """
         if self._notify:
-            self._notify(exception, context=context)
+            self._notify(exception, context=context() if callable(context) else context)
 
-    def task_generator(self, wait_time=20, sqs_timeout=20):
+    def task_generator(
+        self,
+        wait_time=20,
+        sqs_timeout=20,
+        shutdown=None,
+        dedupe=None,
+        max_messages=1,
+        rate_limiter=None,
+        recorder=None,
+    ):
         """
         Run as:
 
@@ -86,6 +449,15 @@ class TaskManager:
 
         :param wait_time: time to wait for messages if none are immediately available (max is 20 seconds)
         :param sqs_timeout: visibility timeout for processing the message - another worker will retry if this expires
+        :param shutdown: optional ShutdownCoordinator; polling stops and received messages are released once requested
+        :param dedupe: optional Deduplicator; tasks completed or in progress elsewhere are acked or skipped
+        :param max_messages: number of messages to receive per call, up to 10. The visibility of each message is
+                             extended before it is yielded. From a FIFO queue the messages are yielded round robin
+                             across their message groups, and when a message is not acked the later messages of its
+                             group are released so that the group is retried in order.
+        :param rate_limiter: optional RateLimiter; throttled messages are deferred with a short visibility timeout and
+                             throttled tasks from an envelope are re-enqueued
+        :param recorder: optional recording.Recorder the received messages are written to
         :return: Iterator[task, kwargs, message]
         """
         if 0 > wait_time or wait_time > 20:
@@ -104,10 +476,19 @@ class TaskManager:
                 )
             )
 
-        while True:
+        if 1 > max_messages or max_messages > MAX_BATCH_ENTRIES:
+            raise ValueError(
+                "Invalid max messages {}; must be between 1 and {}".format(
+                    max_messages, MAX_BATCH_ENTRIES
+                )
+            )
+
+        while shutdown is None or not shutdown.requested:
             messages = self.queue.receive_messages(
                 AttributeNames=["All"],
-                MaxNumberOfMessages=1,
+                # Keeps the sender attributes when the message is re-enqueued or dead lettered
+                MessageAttributeNames=["All"],
+                MaxNumberOfMessages=max_messages,
                 WaitTimeSeconds=wait_time,
                 VisibilityTimeout=sqs_timeout,
             )  # Do not handle exceptions - bomb out and restart the container process
@@ -115,28 +496,211 @@ class TaskManager:
             if not messages:
                 logger.info("Waiting for work from SQS!")
 
-            for message in messages:  # Always length one but use a loop anyway
-                logger.debug(
-                    "received %s with body %s attrs %s",
-                    message,
-                    message.body,
-                    message.attributes,
-                )
+            if recorder is not None:
+                for message in messages:
+                    recorder.record(message)
+
+            if self.fifo and len(messages) > 1:
+                messages = [TrackedMessage(m) for m in interleave_groups(messages)]
+            failed_groups = set()
+
+            for index, message in enumerate(messages):
+                if shutdown is not None and shutdown.requested:
+                    for prefetched in messages[index:]:
+                        shutdown.release(prefetched)
+                    break
+
+                if index > 0:
+                    if isinstance(message, TrackedMessage):
+                        # A group fails when one of its messages is not acked
+                        failed_groups.update(
+                            message_group(m) for m in messages[:index] if not m.deleted
+                        )
+                    released = message_group(message) in failed_groups
+                    try:
+                        # Release the rest of a failed group so that it is retried in order, otherwise extend the
+                        # visibility of a message that waited in the batch since it was received
+                        message.change_visibility(
+                            VisibilityTimeout=0 if released else sqs_timeout
+                        )
+                    except ClientError as ce:
+                        self.notify(ce, context=partial(message_context, message))
+                        logger.exception("failed to update visibility of %s", message)
+                        continue
+                    if released:
+                        continue
+
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "received %s with body %s attrs %s",
+                        message,
+                        Preview(message.body),
+                        message.attributes,
+                        extra=message_fields(message),
+                    )
                 try:
                     content = json.loads(message.body)
-                    yield content["task"], content["kwargs"], message
+                    if TASKS in content:
+                        yield from self._unpack(
+                            message,
+                            content[TASKS],
+                            shutdown,
+                            dedupe,
+                            sqs_timeout,
+                            rate_limiter,
+                        )
+                    elif self._defer(message, content):
+                        continue
+                    else:
+                        yield from self._claim(
+                            content["task"],
+                            content["kwargs"],
+                            message,
+                            dedupe,
+                            sqs_timeout,
+                            rate_limiter,
+                        )
                 except JSONDecodeError as e:
-                    self.notify(e, context={"body": message.body, **message.attributes})
+                    self.notify(e, context=partial(message_context, message))
                     logger.exception(
                         "failed to decode message %s with %s",
-                        message.body,
+                        Preview(message.body),
                         message.attributes,
+                        extra=message_fields(message),
                     )
                 except KeyError as e:
-                    self.notify(e, context={"body": message.body, **message.attributes})
+                    self.notify(e, context=partial(message_context, message))
                     logger.exception(
                         "failed to get required field %s from content %s with %s",
                         e,
-                        message.body,
+                        Preview(message.body),
                         message.attributes,
+                        extra=message_fields(message),
                     )
+
+        logger.info("Shutdown requested; stopped polling for work from SQS")
+
+    def _defer(self, message, content):
+        """
+        Re-enqueue a delayed task that is not due yet with the remaining delay and delete the message
+        :return: True if the task is not due
+        """
+        not_before = content.get(NOT_BEFORE)
+        if not_before is None:
+            return False
+
+        remaining = not_before - time.time()
+        if remaining <= 0:
+            return False
+
+        self._resend(message, remaining)
+        return True
+
+    def _resend(self, message, delay):
+        """
+        Send the body of the message again with a delay and delete the message. Unlike a visibility change this
+        does not count as a receive of the task.
+        """
+        try:
+            self.queue.send_message(
+                MessageBody=message.body,
+                # Message attributes are only received when requested, so add ours like submit does
+                MessageAttributes={
+                    **self._message_attributes(),
+                    **(message.message_attributes or {}),
+                },
+                DelaySeconds=min(MAX_DELAY_SECONDS, math.ceil(delay)),
+            )
+            message.delete()
+        except ClientError as ce:
+            # The message is received again when the sqs timeout expires
+            self.notify(ce, context=partial(message_context, message))
+            logger.exception("failed to defer message %s", message)
+
+    def _claim(self, task, kwargs, message, dedupe, lease, rate_limiter=None):
+        if self.result_cache is not None and self.result_cache.contains(task, kwargs):
+            self._ack_cached(task, message)
+            return
+
+        if rate_limiter is not None:
+            wait = rate_limiter.acquire(task)
+            if wait > 0:
+                self._throttle(task, message, rate_limiter.defer_seconds(wait))
+                return
+
+        if dedupe is not None:
+            message = dedupe.claim(task, kwargs, message, lease)
+            if message is None:
+                return
+        yield task, kwargs, message
+
+    def _ack_cached(self, task, message):
+        logger.info("Acking task %s with a cached result: %s", task, message)
+        try:
+            message.delete()
+        except ClientError as ce:
+            # The message is received again when the sqs timeout expires
+            self.notify(ce, context=partial(message_context, message))
+            logger.exception("failed to delete message %s", message)
+
+    def _throttle(self, task, message, seconds):
+        logger.info(
+            "Deferring throttled task %s for %d seconds: %s", task, seconds, message
+        )
+        if isinstance(message, SubMessage):
+            # Left pending, the task is re-enqueued with the delay when the envelope is resolved
+            message.visibility = seconds
+            return
+
+        if not self.fifo:
+            # Re-enqueued so that throttling does not count towards the receives of a RetryPolicy or redrive policy
+            self._resend(message, seconds)
+            return
+
+        # FIFO queues have no per message delay and a new message would lose its place in the group
+        try:
+            message.change_visibility(VisibilityTimeout=seconds)
+        except ClientError as ce:
+            # The message is received again when the sqs timeout expires
+            self.notify(ce, context=partial(message_context, message))
+            logger.exception("failed to defer message %s", message)
+
+    def _unpack(self, message, tasks, shutdown, dedupe, lease, rate_limiter=None):
+        envelope = Envelope(message, tasks)
+        try:
+            for sub_message in envelope:
+                if shutdown is not None and shutdown.requested:
+                    # The remaining tasks are re-enqueued for another worker
+                    break
+
+                try:
+                    task, kwargs = sub_message.task, sub_message.kwargs
+                except KeyError as e:
+                    # Drop the task rather than re-enqueue it forever
+                    sub_message.delete()
+                    # The body of the sub message needs the missing field, so report the raw entry
+                    self.notify(
+                        e,
+                        context=partial(
+                            message_context,
+                            message,
+                            json.dumps(sub_message.content, default=str),
+                        ),
+                    )
+                    logger.exception(
+                        "failed to get required field %s from task %s in %s",
+                        e,
+                        Preview(sub_message.content),
+                        Preview(message.body),
+                    )
+                    continue
+
+                yield from self._claim(
+                    task, kwargs, sub_message, dedupe, lease, rate_limiter
+                )
+        finally:
+            try:
+                envelope.resolve(self._send)
+            except ClientError as ce:
+                self.notify(ce, context=partial(message_context, message))
+                logger.exception("failed to resolve envelope %s", message)
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import Mock, call
+
+from sqstaskmaster.async_provisioner import AsyncProvisioner
+from sqstaskmaster.queue_scale import Provisioner
+
+
+def rule(service, **kwargs):
+    return dict(
+        {
+            Provisioner.QUEUE_NAME: "https://sqs/" + service,
+            Provisioner.SERVICE_NAME: service,
+            Provisioner.CLUSTER_NAME: "cluster",
+            Provisioner.ACTIVE_SIZE: 2,
+        },
+        **kwargs
+    )
+
+
+def mock_provisioner(rules):
+    provisioner = Mock(spec=Provisioner)
+    provisioner.CLUSTER_NAME = Provisioner.CLUSTER_NAME
+    provisioner.SERVICE_NAME = Provisioner.SERVICE_NAME
+    provisioner.rules = rules
+    provisioner.max_workers = 10
+    provisioner.history_directory = None
+    provisioner.history_save_interval = 300
+    return provisioner
+
+
+async def run_for(runner, seconds):
+    task = asyncio.ensure_future(runner.run())
+    await asyncio.sleep(seconds)
+    runner.stop()
+    await task
+
+
+class TestAsyncProvisioner(unittest.TestCase):
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Interval 0 must be greater than zero"):
+            AsyncProvisioner(Mock(), interval=0)
+
+        with self.assertRaisesRegex(ValueError, "Timeout 0 must be greater than zero"):
+            AsyncProvisioner(Mock(), timeout=0)
+
+    def test_per_rule_intervals(self):
+        fast = rule("fast", interval=0.05)
+        slow = rule("slow")
+        provisioner = mock_provisioner([fast, slow])
+        runner = AsyncProvisioner(provisioner, interval=10, lag_interval=0.05)
+
+        asyncio.run(run_for(runner, 0.3))
+
+        runs = [
+            c[0][0][Provisioner.SERVICE_NAME]
+            for c in provisioner.run_rule.call_args_list
+        ]
+        self.assertEqual(1, runs.count("slow"))
+        self.assertGreaterEqual(runs.count("fast"), 4)
+        provisioner.reconcile_stale.assert_any_call([slow])
+
+        metrics = runner.metrics()
+        self.assertEqual(1, metrics["rules"][("cluster", "slow")]["cycles"])
+        self.assertIsNotNone(metrics["rules"][("cluster", "fast")]["cycle_time"])
+        self.assertGreaterEqual(metrics["max_loop_lag"], metrics["loop_lag"])
+
+    def test_slow_rule_does_not_delay_others(self):
+        fast = rule("fast", interval=0.05)
+        slow = rule("slow", timeout=0.1)
+        provisioner = mock_provisioner([fast, slow])
+        release = threading.Event()
+
+        def run_rule(r):
+            if r is slow:
+                release.wait(5)
+
+        provisioner.run_rule.side_effect = run_rule
+        runner = AsyncProvisioner(provisioner, interval=10)
+
+        start = time.monotonic()
+        asyncio.run(run_for(runner, 0.3))
+        release.set()
+        self.assertLess(time.monotonic() - start, 1)
+
+        metrics = runner.metrics()["rules"]
+        self.assertEqual(1, metrics[("cluster", "slow")]["timeouts"])
+        self.assertGreaterEqual(metrics[("cluster", "fast")]["cycles"], 4)
+
+    def test_hung_rule_does_not_starve_others(self):
+        rules = [rule("hung", interval=0.05, timeout=0.05), rule("a", interval=0.05)]
+        provisioner = mock_provisioner(rules)
+        # Fewer pool workers than rules
+        provisioner.max_workers = 1
+        release = threading.Event()
+
+        def run_rule(r):
+            if r is rules[0]:
+                release.wait(5)
+
+        provisioner.run_rule.side_effect = run_rule
+        runner = AsyncProvisioner(provisioner, interval=10)
+
+        asyncio.run(run_for(runner, 0.3))
+        release.set()
+
+        metrics = runner.metrics()["rules"]
+        self.assertGreaterEqual(metrics[("cluster", "hung")]["timeouts"], 2)
+        self.assertEqual(0, metrics[("cluster", "a")]["timeouts"])
+        self.assertGreaterEqual(metrics[("cluster", "a")]["cycles"], 4)
+
+    def test_save_history(self):
+        provisioner = mock_provisioner([rule("a")])
+        provisioner.history_directory = "/tmp/history"
+        provisioner.history_save_interval = 0.05
+        runner = AsyncProvisioner(provisioner)
+
+        asyncio.run(run_for(runner, 0.3))
+
+        saves = provisioner.save_history.call_count
+        # Every interval and once more on stop
+        self.assertGreaterEqual(saves, 4)
+        asyncio.run(run_for(runner, 0))
+        self.assertEqual(saves + 1, provisioner.save_history.call_count)
+
+    def test_errors(self):
+        r = rule("broken")
+        provisioner = mock_provisioner([r])
+        error = KeyError("oops")
+        provisioner.run_rule.side_effect = error
+        runner = AsyncProvisioner(provisioner, interval=0.05)
+
+        asyncio.run(run_for(runner, 0.2))
+
+        self.assertGreaterEqual(
+            runner.metrics()["rules"][("cluster", "broken")]["errors"], 2
+        )
+        provisioner.notify.assert_has_calls([call(error, context=r)])
+
+    def test_stop_before_run(self):
+        provisioner = mock_provisioner([rule("a")])
+        runner = AsyncProvisioner(provisioner)
+        runner.stop()
+        asyncio.run(asyncio.wait_for(runner.run(), 1))
+        provisioner.run_rule.assert_not_called()
+
+    def test_run_forever_stop_from_thread(self):
+        provisioner = mock_provisioner([rule("a", interval=0.05)])
+        runner = AsyncProvisioner(provisioner)
+        timer = threading.Timer(0.2, runner.stop)
+        timer.start()
+        runner.run_forever()
+        timer.join()
+        self.assertGreaterEqual(provisioner.run_rule.call_count, 2)
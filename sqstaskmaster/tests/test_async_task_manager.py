@@ -0,0 +1,285 @@
+import asyncio
+import json
+import unittest
+from unittest.mock import Mock, patch
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.async_task_manager import (
+    AsyncMessageHandler,
+    AsyncTaskManager,
+    SqsBatcher,
+)
+from sqstaskmaster.local import LocalQueue
+from sqstaskmaster.result_cache import MemoryResultStore, ResultCache
+from sqstaskmaster.task_manager import TaskManager
+
+
+class SleepHandler(AsyncMessageHandler):
+    def __init__(self, message, seconds=0, fail=False, stuck=False, **kwargs):
+        super().__init__(message, **kwargs)
+        self.seconds = seconds
+        self.fail = fail
+        self.stuck = stuck
+        self.done = False
+        self.notified = []
+
+    async def run(self):
+        await asyncio.sleep(self.seconds)
+        if self.fail:
+            raise KeyError("boom")
+        self.done = True
+
+    def running(self):
+        return not self.stuck
+
+    def notify(self, exception, context=None):
+        self.notified.append(exception)
+
+
+def message(body="{}"):
+    return Mock(body=body, attributes={}, receipt_handle="handle")
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class TestAsyncMessageHandler(unittest.TestCase):
+    def handler(self, msg, **kwargs):
+        options = dict(sqs_timeout=3, heartbeat_interval=0.05, hard_timeout=1)
+        options.update(kwargs)
+        return SleepHandler(msg, **options)
+
+    async def process(self, handler):
+        async with handler:
+            await handler.run()
+
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Heartbeat interval must be"):
+            self.handler(message(), heartbeat_interval=0)
+        with self.assertRaisesRegex(ValueError, "SQS timeout must be"):
+            self.handler(message(), sqs_timeout=0)
+        with self.assertRaisesRegex(ValueError, "Hard timeout must be"):
+            self.handler(message(), hard_timeout=0)
+        with self.assertRaisesRegex(ValueError, "is to long to reset"):
+            self.handler(message(), heartbeat_interval=2)
+
+    def test_success(self):
+        msg = message()
+        handler = self.handler(msg, seconds=0.12)
+        run(self.process(handler))
+        self.assertTrue(handler.done)
+        msg.delete.assert_called_once_with()
+        # Set on enter and by the heartbeats
+        self.assertGreaterEqual(msg.change_visibility.call_count, 2)
+        msg.change_visibility.assert_called_with(VisibilityTimeout=3)
+
+    @patch("sqstaskmaster.async_task_manager.logger")
+    def test_failure(self, mock_logger):
+        msg = message()
+        handler = self.handler(msg, fail=True)
+        run(self.process(handler))
+        msg.delete.assert_not_called()
+        self.assertIsInstance(handler.notified[0], KeyError)
+
+    @patch("sqstaskmaster.async_task_manager.logger")
+    def test_hard_timeout(self, mock_logger):
+        msg = message()
+        handler = self.handler(msg, seconds=10, hard_timeout=0.1)
+        run(self.process(handler))
+        self.assertFalse(handler.done)
+        msg.delete.assert_not_called()
+        self.assertIsInstance(handler.notified[0], TimeoutError)
+
+    @patch("sqstaskmaster.async_task_manager.logger")
+    def test_stuck(self, mock_logger):
+        handler = self.handler(message(), seconds=10, stuck=True)
+        run(self.process(handler))
+        self.assertIsInstance(handler.notified[0], RuntimeError)
+
+    @patch("sqstaskmaster.async_task_manager.logger")
+    def test_heartbeat_failure(self, mock_logger):
+        msg = message()
+        handler = self.handler(msg, seconds=0.08)
+        msg.change_visibility.side_effect = [None, ClientError({}, "change")]
+        run(self.process(handler))
+        self.assertTrue(handler.done)
+        self.assertIsInstance(handler.notified[0], ClientError)
+        msg.delete.assert_called_once_with()
+
+    def test_cancelled_by_caller(self):
+        msg = message()
+
+        async def cancel():
+            task = asyncio.ensure_future(
+                self.process(self.handler(msg, seconds=10, hard_timeout=20))
+            )
+            await asyncio.sleep(0.05)
+            task.cancel()
+            await task
+
+        with patch("sqstaskmaster.async_task_manager.logger"):
+            with self.assertRaises(asyncio.CancelledError):
+                run(cancel())
+        msg.delete.assert_not_called()
+
+
+class TestSqsBatcher(unittest.TestCase):
+    def test_batches(self):
+        queue = Mock()
+        queue.delete_messages.return_value = {"Failed": [{"Id": "1", "Code": "X"}]}
+
+        async def delete_all():
+            batcher = SqsBatcher(queue, interval=0.01)
+            messages = [Mock(receipt_handle=str(i)) for i in range(12)]
+            results = await asyncio.gather(
+                *(batcher.delete(m) for m in messages), return_exceptions=True
+            )
+            await batcher.close()
+            return results
+
+        results = run(delete_all())
+        self.assertEqual(2, queue.delete_messages.call_count)
+        first, second = [c[1]["Entries"] for c in queue.delete_messages.call_args_list]
+        self.assertEqual(10, len(first))
+        self.assertEqual({"Id": "0", "ReceiptHandle": "0"}, first[0])
+        self.assertEqual({"Id": "1", "ReceiptHandle": "11"}, second[1])
+        self.assertIsInstance(results[1], ClientError)
+        self.assertIsInstance(results[11], ClientError)
+        self.assertEqual(10, results.count(None))
+
+    def test_call_failure(self):
+        queue = Mock()
+        queue.change_message_visibility_batch.side_effect = ClientError({}, "batch")
+
+        async def change():
+            batcher = SqsBatcher(queue, interval=0.01)
+            await batcher.change_visibility(Mock(receipt_handle="h"), 30)
+
+        with self.assertRaises(ClientError):
+            run(change())
+        queue.change_message_visibility_batch.assert_called_once_with(
+            Entries=[{"Id": "0", "ReceiptHandle": "h", "VisibilityTimeout": 30}]
+        )
+
+
+class TestAsyncTaskManager(unittest.TestCase):
+    URL = "async"
+
+    def setUp(self):
+        self.tm = TaskManager(self.URL, queue_constructor=LocalQueue)
+        self.tm.purge()
+
+    def tearDown(self):
+        self.tm.purge()
+        LocalQueue.local_queues.clear()
+
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Invalid concurrency 0"):
+            AsyncTaskManager(self.tm, concurrency=0)
+        with self.assertRaisesRegex(ValueError, "Invalid polling wait time 21"):
+            AsyncTaskManager(self.tm, wait_time=21)
+        fifo = TaskManager("async.fifo", queue_constructor=LocalQueue)
+        with self.assertRaisesRegex(ValueError, "is not supported"):
+            AsyncTaskManager(fifo)
+
+    def test_run(self):
+        for index in range(50):
+            self.tm.submit("sleep", index=index)
+        self.tm.submit("unknown")
+        self.tm.queue.send_message(MessageBody="not json")
+
+        consumer = AsyncTaskManager(self.tm, concurrency=20, wait_time=0)
+        handlers = []
+        max_in_flight = []
+
+        def dispatch(task, kwargs, message):
+            max_in_flight.append(consumer.in_flight)
+            if task != "sleep":
+                return None
+            handler = SleepHandler(
+                message,
+                seconds=0.1,
+                sqs_timeout=30,
+                heartbeat_interval=20,
+                hard_timeout=60,
+            )
+            handlers.append((kwargs["index"], handler))
+            if len(handlers) == 50:
+                consumer.stop()
+            return handler
+
+        with patch("sqstaskmaster.async_task_manager.logger"):
+            run(consumer.run(dispatch))
+
+        self.assertEqual(list(range(50)), sorted(index for index, _ in handlers))
+        self.assertTrue(all(handler.done for _, handler in handlers))
+        self.assertLessEqual(max(max_in_flight), 20)
+        self.assertGreater(max(max_in_flight), 1)
+        self.assertEqual(0, consumer.in_flight)
+
+    def test_delayed(self):
+        self.tm.queue.send_message(
+            MessageBody=json.dumps({"task": "later", "kwargs": {}, "not_before": 1e12})
+        )
+        consumer = AsyncTaskManager(self.tm, wait_time=0)
+        dispatch = Mock()
+
+        async def run_once():
+            task = asyncio.ensure_future(consumer.run(dispatch))
+            await asyncio.sleep(0.1)
+            consumer.stop()
+            await task
+
+        run(run_once())
+        dispatch.assert_not_called()
+        self.assertEqual(
+            1, self.tm.queue.attributes["ApproximateNumberOfMessagesDelayed"]
+        )
+
+    def test_result_cache(self):
+        self.tm.result_cache = ResultCache(MemoryResultStore())
+        self.tm.result_cache.put("cached", {}, 1)
+        self.tm.queue.send_message(
+            MessageBody=json.dumps({"task": "cached", "kwargs": {}})
+        )
+        consumer = AsyncTaskManager(self.tm, wait_time=0)
+        dispatch = Mock()
+
+        async def run_once():
+            task = asyncio.ensure_future(consumer.run(dispatch))
+            await asyncio.sleep(0.1)
+            consumer.stop()
+            await task
+
+        run(run_once())
+        dispatch.assert_not_called()
+        self.assertEqual(0, self.tm.depth())
+
+    def test_enter_failure(self):
+        self.tm.submit("sleep")
+        consumer = AsyncTaskManager(self.tm, wait_time=0)
+        handlers = []
+
+        def dispatch(task, kwargs, message):
+            consumer.stop()
+            handlers.append(
+                SleepHandler(
+                    message, sqs_timeout=30, heartbeat_interval=20, hard_timeout=60
+                )
+            )
+            return handlers[0]
+
+        with patch.object(
+            self.tm.queue,
+            "change_message_visibility_batch",
+            side_effect=ClientError({}, "batch"),
+        ), patch("sqstaskmaster.async_task_manager.logger") as mock_logger:
+            run(consumer.run(dispatch))
+
+        self.assertFalse(handlers[0].done)
+        self.assertEqual(1, len(handlers[0].notified))
+        self.assertIsInstance(handlers[0].notified[0], ClientError)
+        mock_logger.exception.assert_called_once()
+        self.assertEqual(0, consumer.in_flight)
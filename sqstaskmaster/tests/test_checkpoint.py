@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.checkpoint import (
+    FileCheckpointStore,
+    MemoryCheckpointStore,
+    S3CheckpointStore,
+    checkpoint_key,
+)
+from sqstaskmaster.dedupe import task_hash
+
+
+class TestCheckpointKey(unittest.TestCase):
+    def test_task(self):
+        message = Mock(body=json.dumps({"task": "t", "kwargs": {"a": 1, "b": 2}}))
+        self.assertEqual(task_hash("t", {"b": 2, "a": 1}), checkpoint_key(message))
+
+    def test_not_a_task(self):
+        self.assertEqual(64, len(checkpoint_key(Mock(body="not json"))))
+        self.assertNotEqual(
+            checkpoint_key(Mock(body="[1]")), checkpoint_key(Mock(body="[2]"))
+        )
+
+
+class CheckpointStoreTests:
+    def test_save_load_delete(self):
+        self.assertIsNone(self.store.load("key"))
+        self.store.save("key", {"done": [1, 2]})
+        self.store.save("key", {"done": [1, 2, 3]})
+        self.store.save("other", 1)
+        self.assertEqual({"done": [1, 2, 3]}, self.store.load("key"))
+        self.store.delete("key")
+        self.assertIsNone(self.store.load("key"))
+        self.assertEqual(1, self.store.load("other"))
+        # Does not raise when missing
+        self.store.delete("key")
+
+
+class TestMemoryCheckpointStore(CheckpointStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryCheckpointStore()
+
+
+class TestFileCheckpointStore(CheckpointStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = FileCheckpointStore(os.path.join(self.directory.name, "nested"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_no_partial_files(self):
+        self.store.save("key", [1])
+        self.assertEqual(["key.json"], os.listdir(self.store.directory))
+
+
+class TestS3CheckpointStore(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.store = S3CheckpointStore("bucket", prefix="cp/", client=self.client)
+
+    def test_save(self):
+        self.store.save("key", {"a": 1})
+        self.client.put_object.assert_called_once_with(
+            Bucket="bucket",
+            Key="cp/key.json",
+            Body=b'{"a": 1}',
+            ContentType="application/json",
+        )
+
+    def test_load(self):
+        self.client.get_object.return_value = {"Body": Mock(read=lambda: b"[1, 2]")}
+        self.assertEqual([1, 2], self.store.load("key"))
+        self.client.get_object.assert_called_once_with(
+            Bucket="bucket", Key="cp/key.json"
+        )
+
+    def test_load_missing(self):
+        self.client.get_object.side_effect = ClientError(
+            {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+        )
+        self.assertIsNone(self.store.load("key"))
+
+        self.client.get_object.side_effect = ClientError(
+            {"Error": {"Code": "AccessDenied"}}, "GetObject"
+        )
+        with self.assertRaises(ClientError):
+            self.store.load("key")
+
+    def test_delete(self):
+        self.store.delete("key")
+        self.client.delete_object.assert_called_once_with(
+            Bucket="bucket", Key="cp/key.json"
+        )
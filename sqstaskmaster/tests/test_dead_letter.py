@@ -0,0 +1,231 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.dead_letter import Redrive, RedriveCheckpoint
+from sqstaskmaster.local import LocalQueue
+from sqstaskmaster.retry import ERROR_TYPE, RetryPolicy
+from sqstaskmaster.task_manager import TaskManager
+
+
+def mock_message(message_id, task="task", **attributes):
+    return Mock(
+        message_id=message_id,
+        receipt_handle="receipt-" + message_id,
+        body=json.dumps({"task": task, "kwargs": {}}),
+        attributes=attributes,
+        message_attributes={},
+    )
+
+
+def mock_manager(url, messages=()):
+    manager = Mock(url=url, fifo=url.endswith(".fifo"))
+    manager.queue.receive_messages.side_effect = [list(messages), [], [], []]
+    manager.queue.send_messages.return_value = {"Failed": []}
+    manager.queue.delete_messages.return_value = {"Failed": []}
+    return manager
+
+
+class TestRedrive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tm = TaskManager("source", queue_constructor=LocalQueue)
+        self.dlq = TaskManager("source-dlq", queue_constructor=LocalQueue)
+
+    def tearDown(self):
+        self.tm.purge()
+        self.dlq.purge()
+        self.directory.cleanup()
+
+    def test_redrive(self):
+        for task in ("a", "b", "a", "a", "b"):
+            self.dlq.submit(task)
+        self.dlq.queue.send_message(MessageBody="not json")
+
+        stats = self.tm.redrive("source-dlq", tasks={"a"}, wait_time=0)
+        self.assertEqual(
+            (6, 3, 3, 0), (stats.received, stats.matched, stats.sent, stats.failed)
+        )
+        self.assertEqual(3, self.tm.depth())
+        message = self.tm.queue.receive_messages()[0]
+        self.assertEqual({"task": "a", "kwargs": {}}, json.loads(message.body))
+        # The attributes of the original sender are kept
+        self.assertEqual(
+            "Unknown sender to: source-dlq",
+            message.message_attributes["service_name"]["StringValue"],
+        )
+
+    def test_redrive_error_predicate(self):
+        policy = RetryPolicy(max_receives=1, dead_letter_queue=self.dlq.queue)
+        self.tm.submit("a", x=1)
+        self.tm.submit("a", x=2)
+        for error in (TimeoutError("slow"), KeyError("x")):
+            task, kwargs, message = next(self.tm.task_generator(wait_time=0))
+            policy.handle_failure(message, error)
+        self.assertEqual(0, self.tm.depth())
+
+        stats = self.tm.redrive(
+            "source-dlq",
+            predicate=lambda message, content: message.message_attributes[ERROR_TYPE][
+                "StringValue"
+            ]
+            == "TimeoutError",
+            wait_time=0,
+        )
+        self.assertEqual((2, 1), (stats.received, stats.sent))
+        message = self.tm.queue.receive_messages(MessageAttributeNames=["All"])[0]
+        self.assertEqual({"task": "a", "kwargs": {"x": 1}}, json.loads(message.body))
+        self.assertEqual(
+            "Unknown sender to: source",
+            message.message_attributes["service_name"]["StringValue"],
+        )
+
+    def test_limit(self):
+        for _ in range(25):
+            self.dlq.submit("a")
+        stats = self.tm.redrive("source-dlq", limit=12, wait_time=0)
+        self.assertEqual(12, stats.sent)
+        self.assertEqual(12, self.tm.depth())
+
+    def test_dry_run(self):
+        self.dlq.submit("a", x=1)
+        path = os.path.join(self.directory.name, "dry_run.jsonl")
+
+        stats = self.tm.redrive("source-dlq", dry_run=path, wait_time=0)
+        self.assertEqual(1, stats.sent)
+        self.assertEqual(0, self.tm.depth())
+        with open(path) as fh:
+            lines = [json.loads(line) for line in fh]
+        self.assertEqual(1, len(lines))
+        self.assertEqual(
+            {"task": "a", "kwargs": {"x": 1}}, json.loads(lines[0]["body"])
+        )
+
+    def test_checkpoint_resume(self):
+        path = os.path.join(self.directory.name, "redrive.db")
+        RedriveCheckpoint(path).add(["1"])
+        messages = [mock_message("1"), mock_message("2")]
+        dead_letter, target = mock_manager("dlq", messages), mock_manager("source")
+
+        stats = Redrive(dead_letter, target, checkpoint=path, wait_time=0).run()
+        self.assertEqual((2, 2, 1), (stats.received, stats.matched, stats.sent))
+        entries = target.queue.send_messages.call_args[1]["Entries"]
+        self.assertEqual([messages[1].body], [e["MessageBody"] for e in entries])
+        # The message sent before the interruption is only deleted
+        self.assertEqual(
+            [
+                [{"Id": "0", "ReceiptHandle": "receipt-1"}],
+                [{"Id": "0", "ReceiptHandle": "receipt-2"}],
+            ],
+            [c[1]["Entries"] for c in dead_letter.queue.delete_messages.call_args_list],
+        )
+        self.assertEqual({"1", "2"}, RedriveCheckpoint(path).done(["1", "2", "3"]))
+
+    def test_dry_run_checkpoint(self):
+        path = os.path.join(self.directory.name, "redrive.db")
+        dry_run = os.path.join(self.directory.name, "dry_run.jsonl")
+        messages = [mock_message("1"), mock_message("2")]
+
+        dead_letter, target = mock_manager("dlq", messages), mock_manager("source")
+        Redrive(
+            dead_letter, target, dry_run=dry_run, checkpoint=path, wait_time=0
+        ).run()
+        self.assertEqual(set(), RedriveCheckpoint(path).done(["1", "2"]))
+
+        # The real run sends the messages the dry run only wrote to the file
+        dead_letter, target = mock_manager("dlq", messages), mock_manager("source")
+        stats = Redrive(dead_letter, target, checkpoint=path, wait_time=0).run()
+        self.assertEqual(2, stats.sent)
+        entries = target.queue.send_messages.call_args[1]["Entries"]
+        self.assertEqual(
+            [m.body for m in messages], [e["MessageBody"] for e in entries]
+        )
+
+    def test_send_failures(self):
+        messages = [mock_message(str(i)) for i in range(3)]
+        dead_letter, target = mock_manager("dlq", messages), mock_manager("source")
+        target.queue.send_messages.return_value = {"Failed": [{"Id": "1"}]}
+
+        stats = Redrive(dead_letter, target, wait_time=0).run()
+        self.assertEqual((2, 1), (stats.sent, stats.failed))
+        self.assertEqual(
+            ["receipt-0", "receipt-2"],
+            [
+                e["ReceiptHandle"]
+                for e in dead_letter.queue.delete_messages.call_args[1]["Entries"]
+            ],
+        )
+
+        # Nothing is deleted when the call fails
+        dead_letter, target = mock_manager("dlq", messages), mock_manager("source")
+        target.queue.send_messages.side_effect = ClientError({}, "SendMessageBatch")
+        with patch("sqstaskmaster.dead_letter.logger"):
+            stats = Redrive(dead_letter, target, wait_time=0).run()
+        self.assertEqual((0, 3), (stats.sent, stats.failed))
+        dead_letter.queue.delete_messages.assert_not_called()
+        target.notify.assert_called_once()
+
+    def test_fifo(self):
+        messages = [mock_message("1", MessageGroupId="g")]
+        dead_letter, target = mock_manager("dlq.fifo", messages), mock_manager(
+            "source.fifo"
+        )
+        Redrive(dead_letter, target, wait_time=0).run()
+        entry = target.queue.send_messages.call_args[1]["Entries"][0]
+        self.assertEqual("g", entry["MessageGroupId"])
+        self.assertEqual("1", entry["MessageDeduplicationId"])
+
+        with self.assertRaisesRegex(ValueError, "Cannot redrive standard queue"):
+            Redrive(mock_manager("dlq"), target)
+
+    def test_matches(self):
+        now_ms = int(time.time() * 1000)
+        redrive = Redrive(
+            mock_manager("dlq"),
+            mock_manager("source"),
+            min_age=60,
+            max_age=3600,
+            predicate=lambda message, content: content is not None,
+        )
+        self.assertFalse(redrive.matches(mock_message("1", SentTimestamp=now_ms)))
+        self.assertTrue(
+            redrive.matches(mock_message("1", SentTimestamp=now_ms - 120000))
+        )
+        self.assertFalse(
+            redrive.matches(mock_message("1", SentTimestamp=now_ms - 7200000))
+        )
+        self.assertFalse(redrive.matches(Mock(body="not json", attributes={})))
+
+    @patch("sqstaskmaster.rate_limit.time.monotonic")
+    @patch("sqstaskmaster.dead_letter.time.sleep")
+    def test_rate(self, mock_sleep, mock_monotonic):
+        clock = [1000.0]
+        mock_monotonic.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds
+        )
+        messages = [mock_message(str(i)) for i in range(10)]
+        dead_letter = mock_manager("dlq")
+        dead_letter.queue.receive_messages.side_effect = [
+            messages,
+            [mock_message(str(i)) for i in range(10, 15)],
+            [],
+            [],
+            [],
+        ]
+        stats = Redrive(dead_letter, mock_manager("source"), rate=5, wait_time=0).run()
+        self.assertEqual(15, stats.sent)
+        # The burst of 10 is sent at once, then 5 at 5 per second
+        mock_sleep.assert_called_once()
+        mock_sleep.assert_called_once_with(1.0)
+
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Rate 0 must be greater than zero"):
+            Redrive(mock_manager("dlq"), mock_manager("source"), rate=0)
+        with self.assertRaisesRegex(ValueError, "Empty receives 0"):
+            Redrive(mock_manager("dlq"), mock_manager("source"), empty_receives=0)
@@ -0,0 +1,183 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch, Mock
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.dedupe import (
+    ACQUIRED,
+    COMPLETED,
+    IN_PROGRESS,
+    Deduplicator,
+    KeyValueDedupeStore,
+    LeasedMessage,
+    MemoryDedupeStore,
+    SQLiteDedupeStore,
+    content_key,
+    message_key,
+    task_hash,
+)
+
+
+class TestKeys(unittest.TestCase):
+    def test_task_hash(self):
+        self.assertEqual(
+            task_hash("task", {"a": 1, "b": 2}), task_hash("task", {"b": 2, "a": 1})
+        )
+        self.assertNotEqual(task_hash("task", {"a": 1}), task_hash("task", {"a": 2}))
+        self.assertNotEqual(task_hash("task", {"a": 1}), task_hash("other", {"a": 1}))
+        self.assertEqual(len(task_hash("task", {})), 64)
+
+    def test_key_functions(self):
+        message = Mock(message_id="the-id")
+        self.assertEqual(
+            content_key("task", {"a": 1}, message), task_hash("task", {"a": 1})
+        )
+        self.assertEqual(message_key("task", {"a": 1}, message), "the-id")
+
+
+class StoreTests:
+    def test_acquire(self):
+        self.assertEqual(self.store.acquire("key", 30), ACQUIRED)
+        self.assertEqual(self.store.acquire("key", 30), IN_PROGRESS)
+        self.assertEqual(self.store.acquire("other", 30), ACQUIRED)
+
+    def test_release(self):
+        self.store.acquire("key", 30)
+        self.store.release("key")
+        self.assertEqual(self.store.acquire("key", 30), ACQUIRED)
+
+    def test_complete(self):
+        self.store.acquire("key", 30)
+        self.store.complete("key")
+        self.assertEqual(self.store.acquire("key", 30), COMPLETED)
+
+        # Completed keys are not released or renewed
+        self.store.release("key")
+        self.store.renew("key", 30)
+        self.assertEqual(self.store.acquire("key", 30), COMPLETED)
+
+    def test_lease_expires(self):
+        with patch("sqstaskmaster.dedupe.time.time", return_value=1000.0):
+            self.store.acquire("key", 10)
+            self.store.acquire("renewed", 10)
+        with patch("sqstaskmaster.dedupe.time.time", return_value=1005.0):
+            self.store.renew("renewed", 10)
+        with patch("sqstaskmaster.dedupe.time.time", return_value=1011.0):
+            self.assertEqual(self.store.acquire("key", 10), ACQUIRED)
+            self.assertEqual(self.store.acquire("renewed", 10), IN_PROGRESS)
+
+
+class TestMemoryDedupeStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryDedupeStore()
+
+    def test_lru_eviction(self):
+        store = MemoryDedupeStore(max_size=2)
+        store.complete("a")
+        store.complete("b")
+        store.acquire("a", 30)  # touch
+        store.complete("c")
+        self.assertEqual(store.acquire("a", 30), COMPLETED)
+        self.assertEqual(store.acquire("b", 30), ACQUIRED)
+
+
+class TestSQLiteDedupeStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SQLiteDedupeStore(os.path.join(self.directory.name, "dedupe.db"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shared_between_instances(self):
+        self.store.acquire("key", 30)
+        other = SQLiteDedupeStore(self.store.path)
+        self.assertEqual(other.acquire("key", 30), IN_PROGRESS)
+
+    def test_purge_expired(self):
+        self.store.acquire("key", -1)
+        self.store.purge_expired()
+        self.assertEqual(self.store.acquire("key", 30), ACQUIRED)
+
+
+class FakeKeyValueClient:
+    """
+    Minimal stand in for a redis client with expiring keys
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        value, expires = self.data.get(name, (None, 0))
+        return value if expires > time.time() else None
+
+    def set(self, name, value, nx=False, ex=None):
+        if nx and self.get(name) is not None:
+            return None
+        self.data[name] = (value, time.time() + ex)
+        return True
+
+    def delete(self, name):
+        self.data.pop(name, None)
+
+
+class TestKeyValueDedupeStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = KeyValueDedupeStore(FakeKeyValueClient())
+
+    def test_prefix(self):
+        self.store.acquire("key", 30)
+        self.assertListEqual(list(self.store.client.data), ["sqstaskmaster:dedupe:key"])
+
+
+class TestDeduplicator(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryDedupeStore()
+        self.instance = Deduplicator(self.store, key=message_key)
+
+    def test_claim(self):
+        message = Mock(message_id="m1")
+        leased = self.instance.claim("task", {}, message, 30)
+        self.assertIsInstance(leased, LeasedMessage)
+        self.assertEqual(leased.key, "m1")
+        self.assertEqual(leased.body, message.body)
+
+        # In progress elsewhere
+        duplicate = Mock(message_id="m1")
+        self.assertIsNone(self.instance.claim("task", {}, duplicate, 30))
+        duplicate.delete.assert_not_called()
+        # Received again soon rather than after the sqs timeout
+        duplicate.change_visibility.assert_called_once_with(VisibilityTimeout=60)
+
+        # Completed
+        leased.delete()
+        message.delete.assert_called_once_with()
+        self.assertIsNone(self.instance.claim("task", {}, duplicate, 30))
+        duplicate.delete.assert_called_once_with()
+
+        with self.assertRaisesRegex(ValueError, "In progress visibility -1"):
+            Deduplicator(self.store, in_progress_visibility=-1)
+
+    def test_claim_delete_fails(self):
+        self.store.complete("m1")
+        duplicate = Mock(message_id="m1")
+        duplicate.delete.side_effect = ClientError({}, "DeleteMessage")
+        with patch("sqstaskmaster.dedupe.logger") as mock_logger:
+            self.assertIsNone(self.instance.claim("task", {}, duplicate, 30))
+        mock_logger.exception.assert_called_once()
+
+    def test_leased_message_visibility(self):
+        message = Mock(message_id="m1")
+        leased = self.instance.claim("task", {}, message, 30)
+
+        with patch.object(self.store, "renew") as renew:
+            leased.change_visibility(VisibilityTimeout=60)
+            message.change_visibility.assert_called_once_with(VisibilityTimeout=60)
+            renew.assert_called_once_with("m1", 60)
+
+        leased.change_visibility(VisibilityTimeout=0)
+        self.assertEqual(self.store.acquire("m1", 30), ACQUIRED)
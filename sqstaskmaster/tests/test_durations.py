@@ -0,0 +1,104 @@
+import os
+import random
+import tempfile
+import unittest
+
+from sqstaskmaster.durations import AdaptiveTimeouts, P2Quantile
+
+
+class TestP2Quantile(unittest.TestCase):
+    def test_invalid(self):
+        with self.assertRaisesRegex(ValueError, "Quantile 1 must be between 0 and 1"):
+            P2Quantile(1)
+
+    def test_few_values(self):
+        estimate = P2Quantile(0.5)
+        self.assertIsNone(estimate.value())
+        for value in [5, 1, 3]:
+            estimate.add(value)
+        self.assertEqual(3, estimate.value())
+
+    def test_uniform(self):
+        rng = random.Random(7)
+        for q in (0.5, 0.9, 0.99):
+            estimate = P2Quantile(q)
+            for _ in range(20000):
+                estimate.add(rng.uniform(0, 100))
+            self.assertAlmostEqual(q * 100, estimate.value(), delta=2)
+            # Constant memory
+            self.assertEqual(5, len(estimate.heights))
+
+    def test_exponential(self):
+        rng = random.Random(11)
+        values = [rng.expovariate(1 / 60) for _ in range(20000)]
+        estimate = P2Quantile(0.9)
+        for value in values:
+            estimate.add(value)
+        exact = sorted(values)[int(0.9 * len(values))]
+        self.assertAlmostEqual(exact, estimate.value(), delta=exact * 0.05)
+
+    def test_round_trip(self):
+        estimate = P2Quantile(0.9)
+        for value in range(100):
+            estimate.add(value)
+        copy = P2Quantile.from_dict(estimate.to_dict())
+        for value in range(100, 200):
+            estimate.add(value)
+            copy.add(value)
+        self.assertEqual(estimate.value(), copy.value())
+        self.assertEqual(estimate.count, copy.count)
+
+
+class TestAdaptiveTimeouts(unittest.TestCase):
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Invalid timeouts 30 and 30"):
+            AdaptiveTimeouts(min_timeout=30, max_retry_latency=30)
+        with self.assertRaisesRegex(ValueError, "Invalid timeouts 30 and 50000"):
+            AdaptiveTimeouts(max_retry_latency=50000)
+        with self.assertRaisesRegex(ValueError, "Min timeout 2 must be at least 3"):
+            AdaptiveTimeouts(min_timeout=2)
+        with self.assertRaisesRegex(ValueError, "Quantile 0 must be between 0 and 1"):
+            AdaptiveTimeouts(quantile=0)
+
+    def test_timeouts(self):
+        adaptive = AdaptiveTimeouts(
+            quantile=0.5, margin=1.5, max_retry_latency=600, min_samples=3
+        )
+        adaptive.record("task", 100)
+        adaptive.record("task", 100)
+        self.assertEqual((30, 25), adaptive.timeouts("task"))
+        self.assertEqual((30, 25), adaptive.timeouts("unknown"))
+
+        adaptive.recorder("task")(100)
+        self.assertEqual(3, adaptive.count("task"))
+        self.assertEqual(100, adaptive.duration("task"))
+        self.assertEqual((150, 135), adaptive.timeouts("task"))
+
+        # Bounded by the retry latency and the minimum
+        for _ in range(10):
+            adaptive.record("slow", 3600)
+            adaptive.record("fast", 0.1)
+        self.assertEqual((600, 540), adaptive.timeouts("slow"))
+        self.assertEqual((30, 27), adaptive.timeouts("fast"))
+
+        kwargs = adaptive.handler_kwargs("slow")
+        self.assertEqual(600, kwargs["sqs_timeout"])
+        self.assertEqual(540, kwargs["alarm_timeout"])
+        kwargs["duration_recorder"](1)
+        self.assertEqual(11, adaptive.count("slow"))
+
+    def test_small_timeouts(self):
+        adaptive = AdaptiveTimeouts(min_timeout=3, min_samples=1)
+        adaptive.record("task", 1)
+        self.assertEqual((3, 1), adaptive.timeouts("task"))
+
+    def test_save_load(self):
+        adaptive = AdaptiveTimeouts(min_samples=1)
+        for value in range(50):
+            adaptive.record("task", value * 10)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "durations.json")
+            adaptive.save(path)
+            loaded = AdaptiveTimeouts(min_samples=1).load(path)
+        self.assertEqual(adaptive.timeouts("task"), loaded.timeouts("task"))
+        self.assertEqual(50, loaded.count("task"))
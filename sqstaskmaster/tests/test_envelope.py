@@ -0,0 +1,157 @@
+import json
+import unittest
+from unittest.mock import Mock, call
+
+from sqstaskmaster.envelope import (
+    MAX_DELAY_SECONDS,
+    Coalescer,
+    Envelope,
+    SubMessage,
+    pack,
+)
+from sqstaskmaster.retry import RetryPolicy
+
+
+class TestCoalescer(unittest.TestCase):
+    def test_pack(self):
+        self.assertEqual(pack([]), '{"tasks": []}')
+        self.assertDictEqual(
+            json.loads(
+                pack(['{"task": "a", "kwargs": {}}', '{"task": "b", "kwargs": {}}'])
+            ),
+            {"tasks": [{"task": "a", "kwargs": {}}, {"task": "b", "kwargs": {}}]},
+        )
+
+    def test_add_and_flush(self):
+        send = Mock()
+        instance = Coalescer(send)
+
+        self.assertIsNone(instance.flush())
+        self.assertIsNone(instance.add('{"task": "a", "kwargs": {}}'))
+        self.assertIsNone(instance.add('{"task": "b", "kwargs": {}}'))
+        self.assertEqual(len(instance), 2)
+        send.assert_not_called()
+
+        self.assertEqual(instance.flush(), send.return_value)
+        send.assert_called_once_with(
+            '{"tasks": [{"task": "a", "kwargs": {}}, {"task": "b", "kwargs": {}}]}'
+        )
+        self.assertEqual(len(instance), 0)
+
+    def test_add_respects_max_size(self):
+        send = Mock()
+        body = '{"task": "a", "kwargs": {}}'
+        # Room for exactly two tasks
+        instance = Coalescer(send, max_size=len(pack([body, body])))
+
+        self.assertIsNone(instance.add(body))
+        self.assertIsNone(instance.add(body))
+        self.assertEqual(instance.add(body), send.return_value)
+        send.assert_called_once_with(pack([body, body]))
+        self.assertEqual(len(instance), 1)
+
+        instance.flush()
+        for sent in send.call_args_list:
+            self.assertLessEqual(len(sent[0][0]), instance.max_size)
+
+    def test_add_oversize_task(self):
+        send = Mock()
+        instance = Coalescer(send, max_size=30)
+        instance.add('{"task": "a"}')
+        instance.add('{"task": "a", "kwargs": {"big": "value"}}')
+        send.assert_has_calls(
+            [
+                call('{"tasks": [{"task": "a"}]}'),
+                call('{"task": "a", "kwargs": {"big": "value"}}'),
+            ]
+        )
+
+
+class TestEnvelope(unittest.TestCase):
+    def setUp(self):
+        self.message = Mock()
+        self.message.attributes = {"ApproximateReceiveCount": "2", "other": "attr"}
+        self.envelope = Envelope(
+            self.message,
+            [
+                {"task": "a", "kwargs": {"x": 1}},
+                {"task": "b", "kwargs": {"x": 2}, "receives": 3},
+            ],
+        )
+
+    def test_sub_messages(self):
+        first, second = self.envelope
+        self.assertIsInstance(first, SubMessage)
+        self.assertEqual((first.task, first.kwargs), ("a", {"x": 1}))
+        self.assertEqual(json.loads(first.body), {"task": "a", "kwargs": {"x": 1}})
+        self.assertDictEqual(
+            first.attributes, {"ApproximateReceiveCount": "2", "other": "attr"}
+        )
+        self.assertDictEqual(
+            second.attributes, {"ApproximateReceiveCount": "5", "other": "attr"}
+        )
+        self.assertEqual(first.message_attributes, self.message.message_attributes)
+
+    def test_change_visibility(self):
+        first, _ = self.envelope
+        first.change_visibility(VisibilityTimeout=30)
+        self.message.change_visibility.assert_called_once_with(VisibilityTimeout=30)
+
+        # Releasing one task must not release the envelope
+        first.change_visibility(VisibilityTimeout=0)
+        self.message.change_visibility.assert_called_once_with(VisibilityTimeout=30)
+
+    def test_resolve_all_done(self):
+        send = Mock()
+        for sub in self.envelope:
+            sub.delete()
+        self.assertListEqual(self.envelope.pending(), [])
+
+        self.envelope.resolve(send)
+        send.assert_not_called()
+        self.message.delete.assert_called_once_with()
+
+    def test_resolve_reenqueues_pending(self):
+        send = Mock()
+        first, second = self.envelope
+        first.delete()
+
+        self.envelope.resolve(send)
+        send.assert_called_once_with(
+            pack([json.dumps({"task": "b", "kwargs": {"x": 2}, "receives": 5})])
+        )
+        self.message.delete.assert_called_once_with()
+
+    def test_resolve_delays_retries(self):
+        send = Mock()
+        first, second = self.envelope
+        # The backoff of a RetryPolicy for the first and the heartbeat of a long running second
+        RetryPolicy(base=600, jitter=False).handle_failure(first)
+        self.message.change_visibility.assert_called_once_with(VisibilityTimeout=1200)
+        second.change_visibility(VisibilityTimeout=60)
+
+        self.envelope.resolve(send)
+        self.assertEqual(
+            [
+                call(
+                    pack(
+                        [json.dumps({"task": "a", "kwargs": {"x": 1}, "receives": 2})]
+                    ),
+                    DelaySeconds=MAX_DELAY_SECONDS,
+                ),
+                call(
+                    pack(
+                        [json.dumps({"task": "b", "kwargs": {"x": 2}, "receives": 5})]
+                    ),
+                    DelaySeconds=60,
+                ),
+            ],
+            send.call_args_list,
+        )
+        self.message.delete.assert_called_once_with()
+
+    def test_resolve_send_fails(self):
+        send = Mock(side_effect=Exception("boom"))
+        with self.assertRaises(Exception):
+            self.envelope.resolve(send)
+        self.message.delete.assert_not_called()
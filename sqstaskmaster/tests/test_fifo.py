@@ -0,0 +1,58 @@
+import unittest
+from unittest.mock import Mock
+
+from sqstaskmaster.fifo import (
+    TrackedMessage,
+    content_deduplication_id,
+    group_by_kwarg,
+    interleave_groups,
+    is_fifo,
+)
+
+
+def message(group, name):
+    mock = Mock(name=name)
+    mock.attributes = {"MessageGroupId": group}
+    return mock
+
+
+class TestFifo(unittest.TestCase):
+    def test_is_fifo(self):
+        self.assertTrue(is_fifo("https://sqs/123/queue.fifo"))
+        self.assertFalse(is_fifo("https://sqs/123/queue"))
+
+    def test_group_by_kwarg(self):
+        self.assertEqual("42", group_by_kwarg("store_id")("task", {"store_id": 42}))
+        with self.assertRaises(KeyError):
+            group_by_kwarg("store_id")("task", {})
+
+    def test_content_deduplication_id(self):
+        self.assertEqual(
+            content_deduplication_id("a", {}, "body"),
+            content_deduplication_id("b", {"x": 1}, "body"),
+        )
+        self.assertNotEqual(
+            content_deduplication_id("a", {}, "body"),
+            content_deduplication_id("a", {}, "other"),
+        )
+        self.assertEqual(64, len(content_deduplication_id("a", {}, "body")))
+
+    def test_interleave_groups(self):
+        a1, a2, a3 = message("a", "a1"), message("a", "a2"), message("a", "a3")
+        b1, b2 = message("b", "b1"), message("b", "b2")
+        c1 = message("c", "c1")
+        self.assertEqual(
+            [a1, b1, c1, a2, b2, a3], interleave_groups([a1, a2, a3, b1, c1, b2])
+        )
+        self.assertEqual([], interleave_groups([]))
+
+    def test_tracked_message(self):
+        mock = message("a", "a1")
+        tracked = TrackedMessage(mock)
+        self.assertIs(mock.attributes, tracked.attributes)
+        self.assertFalse(tracked.deleted)
+        tracked.change_visibility(VisibilityTimeout=10)
+        mock.change_visibility.assert_called_once_with(VisibilityTimeout=10)
+        tracked.delete()
+        self.assertTrue(tracked.deleted)
+        mock.delete.assert_called_once_with()
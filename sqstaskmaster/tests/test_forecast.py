@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from sqstaskmaster.forecast import DepthHistory, PredictivePolicy
+from sqstaskmaster.scaling import AllOrNothingPolicy, ProportionalPolicy
+
+
+class TestDepthHistory(unittest.TestCase):
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Capacity 1 must be at least 2"):
+            DepthHistory(capacity=1)
+
+        with self.assertRaisesRegex(ValueError, r"Alpha 0 must be in \(0, 1\]"):
+            DepthHistory(alpha=0)
+
+    def test_append(self):
+        history = DepthHistory(capacity=3, min_interval=10, alpha=0.5)
+        self.assertEqual(0, len(history))
+        self.assertIsNone(history.ewma_forecast(60))
+
+        self.assertTrue(history.append(0, 10))
+        self.assertFalse(history.append(5, 100))
+        self.assertTrue(history.append(10, 30))
+        self.assertTrue(history.append(20, 20))
+
+        self.assertEqual(
+            [(0.0, 10.0, 0.0), (10.0, 30.0, 2.0), (20.0, 20.0, 0.0)],
+            history.samples(),
+        )
+        self.assertEqual(20, history.ewma_depth)
+        self.assertEqual(0.5, history.ewma_rate)
+        self.assertEqual(25, history.ewma_forecast(10))
+
+    def test_ring(self):
+        history = DepthHistory(capacity=3, min_interval=1)
+        for t in range(5):
+            history.append(t, t * 2)
+
+        self.assertEqual(3, len(history))
+        self.assertEqual([2.0, 3.0, 4.0], [s[0] for s in history.samples()])
+        self.assertEqual(6, history.max_depth_between(0, 3))
+        self.assertEqual(8, history.max_depth_between(3.5, 10))
+        self.assertIsNone(history.max_depth_between(5, 10))
+
+    def test_seasonal_forecast(self):
+        history = DepthHistory(capacity=100, min_interval=60)
+        for t in range(0, 3600, 60):
+            history.append(t, 500 if 1200 <= t < 1500 else 0)
+
+        self.assertEqual(500, history.seasonal_forecast(1000 + 3600, 300, 3600))
+        self.assertEqual(0, history.seasonal_forecast(3000 + 3600, 300, 3600))
+        self.assertIsNone(history.seasonal_forecast(10000, 300, 3600))
+
+    def test_save_load(self):
+        history = DepthHistory(capacity=3, min_interval=1)
+        for t in range(5):
+            history.append(t, t * 2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "history.depth")
+            history.save(path)
+            self.assertEqual(3 * 3 * 8, os.path.getsize(path))
+
+            loaded = DepthHistory(capacity=3, min_interval=1).load(path)
+
+        self.assertEqual(
+            [s[:2] for s in history.samples()], [s[:2] for s in loaded.samples()]
+        )
+        # The estimates are rebuilt from the retained samples only
+        self.assertAlmostEqual(5.62, loaded.ewma_depth)
+
+
+class TestPredictivePolicy(unittest.TestCase):
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Lead time -1"):
+            PredictivePolicy(AllOrNothingPolicy(), lead_time=-1)
+
+    def test_no_history(self):
+        base = Mock()
+        policy = PredictivePolicy(base)
+        self.assertEqual(
+            base.desired_count.return_value,
+            policy.desired_count("key", 5, 2, 8, 1000),
+        )
+        base.desired_count.assert_called_once_with(
+            "key", 5, 2, 8, 1000, history=None, observed_backlog=5
+        )
+
+    def test_seasonal_prescale(self):
+        history = DepthHistory(capacity=100, min_interval=60)
+        for t in range(0, 3600, 60):
+            history.append(t, 500 if 1200 <= t < 1500 else 0)
+
+        policy = PredictivePolicy(
+            AllOrNothingPolicy(), lead_time=300, season=3600, trend=False
+        )
+        self.assertEqual(500, policy.forecast(0, 4600, history))
+        self.assertEqual(8, policy.desired_count("key", 0, 0, 8, 4600, history))
+        self.assertEqual(0, policy.desired_count("key", 0, 0, 8, 6600, history))
+
+    def test_trend_prescale(self):
+        history = DepthHistory(capacity=10, min_interval=60, alpha=1)
+        history.append(0, 0)
+        history.append(60, 60)
+
+        policy = PredictivePolicy(AllOrNothingPolicy(), lead_time=600, season=None)
+        self.assertEqual(610, policy.forecast(10, 60, history))
+
+        policy = PredictivePolicy(
+            AllOrNothingPolicy(), lead_time=600, season=None, trend=False
+        )
+        self.assertEqual(10, policy.forecast(10, 60, history))
+
+    def test_proportional_throughput(self):
+        # A seasonal spike in the forecast that passes out of the lead time
+        history = Mock(ewma_rate=0.0, __len__=Mock(return_value=1))
+        history.seasonal_forecast.side_effect = [1000, 1000, 5, 5, 5, 5]
+        proportional = ProportionalPolicy(
+            throughput=0.01, target_drain_time=3600, min_completions=1
+        )
+        policy = PredictivePolicy(proportional, lead_time=300, season=3600)
+
+        count = 1
+        for now in range(0, 360, 60):
+            # The real backlog stays at 5, nothing drains
+            count = policy.desired_count("key", 5, count, 20, now, history)
+        self.assertEqual(0.01, proportional.throughput_for("key"))
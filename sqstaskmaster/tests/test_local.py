@@ -114,6 +114,23 @@ class TestLocalQueue(unittest.TestCase):
                 [call(mock_cls.return_value), call(mock_cls.return_value)]
             )
 
+    @patch("sqstaskmaster.local.LocalMessage")
+    def test_send_messages(self, mock_cls):
+        lq = LocalQueue("url1")
+        result = lq.send_messages(
+            Entries=[
+                {"Id": "0", "MessageBody": "first"},
+                {"Id": "1", "MessageBody": "second", "MessageAttributes": {"a": "b"}},
+            ]
+        )
+
+        self.assertListEqual([m["Id"] for m in result["Successful"]], ["0", "1"])
+        self.assertListEqual(result["Failed"], [])
+        mock_cls.assert_has_calls(
+            [call("first", {}, {}), call("second", {}, {"a": "b"})]
+        )
+        self.assertEqual(lq.queue.qsize(), 2)
+
     @patch("sqstaskmaster.local.LocalMessage")
     def test_receive_messages(self, mock_cls):
 
@@ -159,6 +176,194 @@ def example_producer(url, messages):
     logger.info("Submitted messages")
 
 
+class TestLocalDelayedQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = LocalQueue("delayed")
+        self.queue.purge()
+
+    def tearDown(self):
+        self.queue.purge()
+        LocalQueue.local_queues.clear()
+
+    def test_delay(self):
+        self.queue.send_message(MessageBody="later", DelaySeconds=0.2)
+        self.queue.send_message(MessageBody="now")
+        self.assertEqual(1, self.queue.attributes["ApproximateNumberOfMessagesDelayed"])
+
+        self.assertEqual(
+            ["now"],
+            [m.body for m in self.queue.receive_messages(WaitTimeSeconds=0)],
+        )
+        self.assertEqual([], self.queue.receive_messages(WaitTimeSeconds=0))
+
+        # Waits for the delayed message
+        tic = time.perf_counter()
+        self.assertEqual(
+            ["later"],
+            [m.body for m in self.queue.receive_messages(WaitTimeSeconds=1)],
+        )
+        self.assertLess(time.perf_counter() - tic, 0.9)
+        self.assertEqual(0, self.queue.attributes["ApproximateNumberOfMessagesDelayed"])
+
+    def test_purge(self):
+        self.queue.send_message(MessageBody="later", DelaySeconds=0.1)
+        self.queue.purge()
+        time.sleep(0.1)
+        self.assertEqual([], self.queue.receive_messages(WaitTimeSeconds=0))
+
+
+class TestLocalFifoQueue(unittest.TestCase):
+    URL = "local.fifo"
+
+    def setUp(self):
+        self.queue = LocalQueue(self.URL)
+        self.queue.purge()
+
+    def tearDown(self):
+        self.queue.purge()
+        LocalQueue.local_queues.clear()
+
+    def send(self, body, group, **kwargs):
+        self.queue.send_message(MessageBody=body, MessageGroupId=group, **kwargs)
+
+    def test_send_requires_group(self):
+        with self.assertRaisesRegex(ValueError, "MessageGroupId is required"):
+            self.queue.send_message(MessageBody="body")
+
+    def test_deduplication(self):
+        self.send("one", "a")
+        self.send("one", "a")
+        self.send("one", "a", MessageDeduplicationId="other")
+        self.send("two", "a", MessageDeduplicationId="other")
+        self.assertEqual(2, self.queue.queue.qsize())
+
+    def test_group_locking(self):
+        for body, group in [("a1", "a"), ("b1", "b"), ("a2", "a"), ("b2", "b")]:
+            self.send(body, group)
+
+        a1, b1 = self.queue.receive_messages(
+            WaitTimeSeconds=0, MaxNumberOfMessages=1
+        ) + (self.queue.receive_messages(WaitTimeSeconds=0, MaxNumberOfMessages=1))
+        self.assertEqual(["a1", "b1"], [a1.body, b1.body])
+        self.assertEqual({"MessageGroupId": "a"}, a1.attributes)
+
+        # Both groups are locked
+        self.assertEqual(
+            [], self.queue.receive_messages(WaitTimeSeconds=0, MaxNumberOfMessages=10)
+        )
+
+        b1.delete()
+        self.assertEqual(
+            ["b2"],
+            [
+                m.body
+                for m in self.queue.receive_messages(
+                    WaitTimeSeconds=0, MaxNumberOfMessages=10
+                )
+            ],
+        )
+
+        a1.change_visibility(VisibilityTimeout=0)
+        a1.delete()  # releases once
+        self.assertEqual(
+            ["a2"],
+            [
+                m.body
+                for m in self.queue.receive_messages(
+                    WaitTimeSeconds=0, MaxNumberOfMessages=10
+                )
+            ],
+        )
+
+    def test_wait_time(self):
+        tic = time.perf_counter()
+        self.assertEqual([], self.queue.receive_messages(WaitTimeSeconds=0.3))
+        self.assertGreaterEqual(time.perf_counter() - tic, 0.3)
+
+        # Wakes up for a delayed message
+        self.send("a1", "a", DelaySeconds=0.2)
+        tic = time.perf_counter()
+        self.assertEqual(
+            ["a1"], [m.body for m in self.queue.receive_messages(WaitTimeSeconds=2)]
+        )
+        self.assertLess(time.perf_counter() - tic, 0.5)
+
+    def test_batch_from_one_group(self):
+        for body in ["a1", "a2", "a3"]:
+            self.send(body, "a")
+
+        first, second = self.queue.receive_messages(
+            WaitTimeSeconds=0, MaxNumberOfMessages=2
+        )
+        self.assertEqual(["a1", "a2"], [first.body, second.body])
+        first.delete()
+        # a2 is still in flight
+        self.assertEqual(
+            [], self.queue.receive_messages(WaitTimeSeconds=0, MaxNumberOfMessages=2)
+        )
+        second.delete()
+        self.assertEqual(
+            ["a3"],
+            [
+                m.body
+                for m in self.queue.receive_messages(
+                    WaitTimeSeconds=0, MaxNumberOfMessages=2
+                )
+            ],
+        )
+
+    def test_batch_calls(self):
+        self.send("a1", "a")
+        self.send("a2", "a")
+        (a1,) = self.queue.receive_messages(WaitTimeSeconds=0, MaxNumberOfMessages=1)
+        self.assertEqual(
+            {"Successful": [{"Id": "0"}]},
+            self.queue.change_message_visibility_batch(
+                Entries=[
+                    {
+                        "Id": "0",
+                        "ReceiptHandle": a1.receipt_handle,
+                        "VisibilityTimeout": 30,
+                    }
+                ]
+            ),
+        )
+        self.assertEqual(
+            [], self.queue.receive_messages(WaitTimeSeconds=0, MaxNumberOfMessages=1)
+        )
+        self.assertEqual(
+            {"Successful": [{"Id": "0"}, {"Id": "1"}]},
+            self.queue.delete_messages(
+                Entries=[
+                    {"Id": "0", "ReceiptHandle": a1.receipt_handle},
+                    {"Id": "1", "ReceiptHandle": "unknown"},
+                ]
+            ),
+        )
+        self.assertEqual(
+            ["a2"],
+            [
+                m.body
+                for m in self.queue.receive_messages(
+                    WaitTimeSeconds=0, MaxNumberOfMessages=1
+                )
+            ],
+        )
+
+    def test_task_manager(self):
+        tm = TaskManager(self.URL, queue_constructor=LocalQueue, group_id="store")
+        for store, step in [(1, 0), (2, 0), (1, 1), (2, 1)]:
+            tm.submit("step", store=store, step=step)
+
+        done = []
+        generator = tm.task_generator(wait_time=0, max_messages=10)
+        for _ in range(2):
+            task, kwargs, message = next(generator)
+            done.append((kwargs["store"], kwargs["step"]))
+            message.delete()
+        self.assertEqual([(1, 0), (2, 0)], done)
+
+
 class MyHandler(MessageHandler):
     def __init__(
         self,
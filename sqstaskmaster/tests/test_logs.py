@@ -0,0 +1,52 @@
+import logging
+import unittest
+from unittest.mock import MagicMock, Mock
+
+from sqstaskmaster.local import LocalMessage
+from sqstaskmaster.logs import (
+    PREVIEW_LENGTH,
+    Preview,
+    message_context,
+    message_fields,
+    preview,
+)
+
+
+class TestLogs(unittest.TestCase):
+    def test_preview(self):
+        self.assertEqual("short", preview("short"))
+        self.assertEqual("x" * 10 + "... (11 chars)", preview("x" * 11, length=10))
+        self.assertEqual("{'a': 1}", preview({"a": 1}))
+        self.assertEqual(PREVIEW_LENGTH + 17, len(preview("x" * 10000)))
+
+    def test_preview_lazy(self):
+        text = MagicMock()
+        logger = logging.getLogger("sqstaskmaster.tests.test_logs")
+        logger.setLevel(logging.INFO)
+        logger.debug("body %s", Preview(text))
+        text.__str__.assert_not_called()
+
+        text.__str__.return_value = "y" * 1000
+        self.assertEqual(PREVIEW_LENGTH + 16, len(str(Preview(text))))
+
+    def test_message_context(self):
+        message = Mock(body="body", attributes={"ApproximateReceiveCount": "3"})
+        self.assertEqual(
+            {"body": "body", "ApproximateReceiveCount": "3"}, message_context(message)
+        )
+        self.assertEqual(
+            {"body": "task", "ApproximateReceiveCount": "3"},
+            message_context(message, "task"),
+        )
+        self.assertEqual(
+            {
+                "sqs_message_id": message.message_id,
+                "sqs_body_size": 4,
+                "sqs_receive_count": "3",
+            },
+            message_fields(message),
+        )
+
+    def test_local_message_str(self):
+        message = LocalMessage("z" * 10000, {}, {})
+        self.assertLess(len(str(message)), 400)
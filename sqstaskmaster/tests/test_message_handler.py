@@ -1,3 +1,5 @@
+import json
+import multiprocessing
 import signal
 import time
 import unittest
@@ -6,9 +8,13 @@ import subprocess
 import pyximport
 
 from abc import ABC
-from unittest.mock import patch, Mock, DEFAULT
+from unittest.mock import patch, Mock, MagicMock, DEFAULT, ANY
 from botocore.exceptions import ClientError
+from sqstaskmaster.checkpoint import MemoryCheckpointStore
+from sqstaskmaster.dedupe import ACQUIRED, Deduplicator, MemoryDedupeStore, message_key
 from sqstaskmaster.message_handler import MessageHandler
+from sqstaskmaster.protection import LocalTaskProtection
+from sqstaskmaster.retry import RetryPolicy
 
 pyximport.install(language_level=3)
 from sqstaskmaster.tests import cbusy  # noqa: ignore=E402
@@ -169,6 +175,234 @@ class TestMessageHandler(unittest.TestCase):
             exc_val, context={"body": mock_message.body, **mock_message.attributes}
         )
 
+    @patch("signal.alarm")
+    @patch("sqstaskmaster.message_handler.logger")
+    def test___exit__retry_policy(self, mock_logger, mock_alarm, notify=None):
+        mock_message = Mock()
+        mock_message.attributes.keys.return_value = []
+        mock_policy = Mock()
+        instance = MessageHandler(
+            mock_message,
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=17,
+            retry_policy=mock_policy,
+        )
+
+        instance.__exit__(None, None, None)
+        mock_policy.handle_failure.assert_not_called()
+
+        error = Exception("foo")
+        instance.__exit__(Exception, error, Mock())
+        mock_policy.handle_failure.assert_called_once_with(mock_message, error)
+
+        ce = ClientError({}, "operation")
+        mock_policy.handle_failure.side_effect = ce
+        self.assertTrue(instance.__exit__(Exception, Exception("foo"), Mock()))
+        mock_logger.exception.assert_called_with(
+            "failed to retry message %s", mock_message
+        )
+        notify.assert_called_with(
+            ce, context={"body": mock_message.body, **mock_message.attributes}
+        )
+
+    @patch("signal.alarm")
+    @patch("sqstaskmaster.message_handler.logger")
+    def test___exit__release_lease(self, mock_logger, mock_alarm, notify=None):
+        store = MemoryDedupeStore()
+        message = Mock(message_id="m1", attributes={})
+        leased = Deduplicator(store, key=message_key).claim("task", {}, message, 30)
+        instance = MessageHandler(
+            leased,
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=17,
+            retry_policy=RetryPolicy(base=60, jitter=False),
+        )
+
+        self.assertTrue(instance.__exit__(Exception, Exception("foo"), Mock()))
+        message.change_visibility.assert_called_once_with(VisibilityTimeout=60)
+        # The retry after the backoff is not skipped as in progress
+        self.assertEqual(ACQUIRED, store.acquire("m1", 30))
+
+    @patch("time.time", return_value=100)
+    def test_progress(self, mock_time, **kwargs):
+        instance = MessageHandler(
+            Mock(), sqs_timeout=13, alarm_timeout=11, hard_timeout=17
+        )
+        # Without a window the handler is assumed to be running
+        mock_time.return_value = 1000
+        self.assertTrue(instance.running())
+
+        mock_time.return_value = 100
+        instance = MessageHandler(
+            Mock(),
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=17,
+            progress_window=30,
+        )
+        mock_time.return_value = 130
+        self.assertTrue(instance.running())
+        mock_time.return_value = 131
+        self.assertFalse(instance.running())
+
+        instance.progress()
+        instance.progress(2)
+        self.assertEqual(3, instance.progress_count)
+        self.assertTrue(instance.running())
+        self.assertEqual(0, instance.progress_age())
+        mock_time.return_value = 150
+        self.assertEqual(19, instance.progress_age())
+        mock_time.return_value = 162
+        self.assertFalse(instance.running())
+
+        with self.assertRaisesRegex(
+            ValueError, "Progress window 10 is shorter than the alarm timeout 11"
+        ):
+            MessageHandler(
+                Mock(),
+                sqs_timeout=13,
+                alarm_timeout=11,
+                hard_timeout=17,
+                progress_window=10,
+            )
+
+    def test_progress_child_process(self, **kwargs):
+        instance = MessageHandler(
+            Mock(), sqs_timeout=13, alarm_timeout=11, hard_timeout=17
+        )
+        process = multiprocessing.get_context("fork").Process(
+            target=instance.progress, args=(5,)
+        )
+        process.start()
+        process.join()
+        self.assertEqual(5, instance.progress_count)
+
+    @patch("time.time", return_value=100)
+    def test_eta(self, mock_time, **kwargs):
+        instance = MessageHandler(
+            Mock(),
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=3600,
+            total=100,
+            eta_visibility=True,
+        )
+        self.assertIsNone(instance.eta())
+        self.assertEqual(13, instance._visibility_timeout())
+
+        mock_time.return_value = 120
+        instance.progress(10)
+        self.assertEqual(180, instance.eta())
+        self.assertEqual(191, instance._visibility_timeout())
+
+        # Bounded by the hard timeout
+        instance.total = 10000
+        self.assertEqual(3580 + 11, instance._visibility_timeout())
+
+        instance.eta_visibility = False
+        self.assertEqual(13, instance._visibility_timeout())
+        instance.total = None
+        self.assertIsNone(instance.eta())
+
+    @patch("time.time", return_value=100)
+    def test_checkpoint(self, mock_time, notify=None):
+        store = MemoryCheckpointStore()
+        body = json.dumps({"task": "t", "kwargs": {"a": 1}})
+
+        def handler():
+            return MessageHandler(
+                Mock(body=body, attributes={}),
+                sqs_timeout=13,
+                alarm_timeout=11,
+                hard_timeout=17,
+                checkpoint_store=store,
+                checkpoint_interval=60,
+            )
+
+        first = handler()
+        self.assertIsNone(first.restore())
+        self.assertTrue(first.checkpoint({"step": 1}))
+        mock_time.return_value = 159
+        self.assertFalse(first.checkpoint({"step": 2}))
+        mock_time.return_value = 160
+        self.assertTrue(first.checkpoint({"step": 3}))
+
+        # A redelivery resumes
+        second = handler()
+        self.assertEqual({"step": 3}, second.restore())
+
+        with patch.object(store, "save", side_effect=OSError("full")):
+            self.assertFalse(second.checkpoint({"step": 4}))
+        notify.assert_called_once_with(ANY, context={"body": body})
+
+        with self.assertRaisesRegex(RuntimeError, "No checkpoint store"):
+            MessageHandler(
+                Mock(), sqs_timeout=13, alarm_timeout=11, hard_timeout=17
+            ).checkpoint({})
+
+    @patch("signal.alarm")
+    def test___exit__checkpoint(self, mock_alarm, **kwargs):
+        store = MemoryCheckpointStore()
+        message = Mock(body=json.dumps({"task": "t", "kwargs": {}}), attributes={})
+        instance = MessageHandler(
+            message,
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=17,
+            checkpoint_store=store,
+        )
+        instance.checkpoint([1])
+
+        # Kept when the handler fails or the message is not deleted
+        with patch("sqstaskmaster.message_handler.logger"):
+            instance.__exit__(KeyError, KeyError("boom"), None)
+            message.delete.side_effect = ClientError({}, "delete")
+            instance.__exit__(None, None, None)
+        self.assertEqual([1], instance.restore())
+
+        message.delete.side_effect = None
+        instance.__exit__(None, None, None)
+        self.assertIsNone(instance.restore())
+        self.assertEqual({}, store.checkpoints)
+
+    @patch("signal.alarm")
+    @patch("signal.signal")
+    def test_handler_resource_policy(self, mock_signal, mock_alarm, **kwargs):
+        policy = MagicMock()
+        limits = policy.limits.return_value
+        instance = MessageHandler(
+            Mock(attributes={}),
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=17,
+            resource_policy=policy,
+        )
+        with instance:
+            policy.apply.assert_called_once_with()
+            limits.__enter__.assert_called_once_with()
+            limits.__exit__.assert_not_called()
+        limits.__exit__.assert_called_once_with(None, None, None)
+
+    @patch("signal.alarm")
+    @patch("time.time", return_value=100)
+    def test___exit__duration_recorder(self, mock_time, mock_alarm, **kwargs):
+        recorder = Mock()
+        instance = MessageHandler(
+            Mock(attributes={}),
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=17,
+            duration_recorder=recorder,
+        )
+        mock_time.return_value = 107.5
+        with patch("sqstaskmaster.message_handler.logger"):
+            instance.__exit__(KeyError, KeyError("boom"), None)
+        recorder.assert_not_called()
+        instance.__exit__(None, None, None)
+        recorder.assert_called_once_with(7.5)
+
     @patch("signal.alarm")
     def test__handle_alarm(self, mock_signal_alarm, **kwargs):
         mock_message = Mock()
@@ -201,6 +435,61 @@ class TestMessageHandler(unittest.TestCase):
                 ):
                     instance._handle_alarm(signum, frame)
 
+    @patch("signal.alarm")
+    def test__handle_alarm_shutdown(self, mock_signal_alarm, **kwargs):
+        mock_message = Mock()
+        mock_shutdown = Mock()
+        instance = MessageHandler(
+            mock_message,
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=17,
+            shutdown=mock_shutdown,
+        )
+
+        with patch.object(instance, "running", return_value=True):
+            # Within the grace period the alarm is rearmed to fire by the deadline
+            mock_shutdown.expired.return_value = False
+            mock_shutdown.time_remaining.return_value = 3.5
+            instance._handle_alarm(Mock(), Mock())
+            mock_signal_alarm.assert_called_with(4)
+            mock_message.change_visibility.assert_called_once_with(VisibilityTimeout=13)
+
+            mock_shutdown.expired.return_value = True
+            with self.assertRaisesRegex(
+                TimeoutError, "Hit shutdown grace period for message handler"
+            ):
+                instance._handle_alarm(Mock(), Mock())
+
+    @patch("signal.alarm")
+    @patch("sqstaskmaster.message_handler.logger")
+    def test___exit__shutdown_releases_message(
+        self, mock_logger, mock_alarm, notify=None
+    ):
+        mock_message = Mock()
+        mock_message.attributes.keys.return_value = []
+        mock_shutdown = Mock()
+        instance = MessageHandler(
+            mock_message,
+            sqs_timeout=13,
+            alarm_timeout=11,
+            hard_timeout=17,
+            shutdown=mock_shutdown,
+        )
+
+        mock_shutdown.requested = False
+        instance.__exit__(Exception, Exception("foo"), Mock())
+        mock_shutdown.release.assert_not_called()
+
+        mock_shutdown.requested = True
+        instance.__exit__(Exception, Exception("foo"), Mock())
+        mock_shutdown.release.assert_called_once_with(mock_message)
+
+        # Completed work is still deleted during shutdown
+        instance.__exit__(None, None, None)
+        mock_message.delete.assert_called_once_with()
+        mock_shutdown.release.assert_called_once_with(mock_message)
+
     @patch("signal.alarm")
     @patch("signal.signal")
     def test_handler_success(self, mock_signal, mock_alarm, **kwargs):
@@ -215,6 +504,65 @@ class TestMessageHandler(unittest.TestCase):
         mock_message.delete.assert_called_once_with()
         mock_alarm.assert_called_once_with(0)
 
+    @patch("signal.alarm")
+    @patch("signal.signal")
+    def test_handler_protection(self, mock_signal, mock_alarm, **kwargs):
+        protection = LocalTaskProtection()
+        with MessageHandler(
+            Mock(),
+            sqs_timeout=3,
+            alarm_timeout=1,
+            hard_timeout=3600,
+            protection=protection,
+        ):
+            self.assertTrue(protection.protected)
+            self.assertEqual(60, protection.expires_in_minutes)
+        self.assertFalse(protection.protected)
+
+        mock_message = Mock()
+        mock_message.attributes = {}
+        with MessageHandler(
+            mock_message,
+            sqs_timeout=3,
+            alarm_timeout=1,
+            hard_timeout=1,
+            protection=protection,
+        ):
+            self.assertEqual(1, protection.expires_in_minutes)
+            raise Exception("FooBar")
+        self.assertFalse(protection.protected)
+
+    @patch("signal.alarm")
+    @patch("signal.signal")
+    @patch("sqstaskmaster.message_handler.logger")
+    def test_handler_protection_failure(
+        self, mock_log, mock_signal, mock_alarm, notify=None
+    ):
+        mock_message = Mock()
+        mock_message.attributes.keys.return_value = []
+        protection = Mock()
+        error = OSError("Connection refused")
+        protection.protect.side_effect = error
+        protection.unprotect.side_effect = error
+        with MessageHandler(
+            mock_message,
+            sqs_timeout=3,
+            alarm_timeout=1,
+            hard_timeout=1,
+            protection=protection,
+        ):
+            pass
+
+        # The task still runs and the message is acked
+        mock_message.delete.assert_called_once_with()
+        self.assertEqual(2, notify.call_count)
+        mock_log.exception.assert_any_call(
+            "Failed to set task protection %s for %s", True, ANY
+        )
+        mock_log.exception.assert_any_call(
+            "Failed to set task protection %s for %s", False, ANY
+        )
+
     @patch("signal.alarm")
     @patch("signal.signal")
     @patch("sqstaskmaster.message_handler.logger")
@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.metrics import DEPTH_ATTRIBUTES, QueueMetricsCache
+
+URL = "https://sqs.us-east-1.amazonaws.com/123/queue"
+ATTRIBUTES = {
+    "ApproximateNumberOfMessages": "3",
+    "ApproximateNumberOfMessagesNotVisible": "2",
+    "ApproximateNumberOfMessagesDelayed": "1",
+}
+
+
+class TestQueueMetricsCache(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.client.get_queue_attributes.return_value = {"Attributes": ATTRIBUTES}
+
+    @patch("sqstaskmaster.metrics.boto3")
+    def test___init__(self, boto3):
+        cache = QueueMetricsCache()
+        boto3.client.assert_called_once_with("sqs")
+        self.assertIs(cache.client, boto3.client.return_value)
+
+        with self.assertRaisesRegex(
+            ValueError, "Max age -1 must be greater than or equal to zero"
+        ):
+            QueueMetricsCache(self.client, max_age=-1)
+
+    def test_get(self):
+        cache = QueueMetricsCache(self.client, max_age=60)
+        self.assertEqual(ATTRIBUTES, cache.get(URL))
+        self.assertEqual(
+            {"ApproximateNumberOfMessages": "3"},
+            cache.get(URL, ["ApproximateNumberOfMessages"]),
+        )
+        self.client.get_queue_attributes.assert_called_once_with(
+            QueueUrl=URL, AttributeNames=sorted(DEPTH_ATTRIBUTES)
+        )
+        self.assertEqual({"hits": 1, "misses": 1, "shared": 0}, cache.stats)
+
+    def test_get_max_age(self):
+        cache = QueueMetricsCache(self.client, max_age=60)
+        with patch("sqstaskmaster.metrics.time.time", return_value=1000):
+            cache.get(URL)
+        with patch("sqstaskmaster.metrics.time.time", return_value=1060):
+            cache.get(URL)
+            self.assertEqual(1, self.client.get_queue_attributes.call_count)
+            cache.get(URL, max_age=10)
+            self.assertEqual(2, self.client.get_queue_attributes.call_count)
+        with patch("sqstaskmaster.metrics.time.time", return_value=1121):
+            cache.get(URL)
+            self.assertEqual(3, self.client.get_queue_attributes.call_count)
+
+    def test_get_other_names(self):
+        cache = QueueMetricsCache(self.client, max_age=60)
+        cache.get(URL)
+        self.client.get_queue_attributes.return_value = {
+            "Attributes": {"VisibilityTimeout": "30"}
+        }
+        self.assertEqual(
+            {"VisibilityTimeout": "30"}, cache.get(URL, ["VisibilityTimeout"])
+        )
+        self.client.get_queue_attributes.assert_called_with(
+            QueueUrl=URL, AttributeNames=["VisibilityTimeout"]
+        )
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_queue_attributes(**kwargs):
+            started.set()
+            release.wait(5)
+            return {"Attributes": ATTRIBUTES}
+
+        self.client.get_queue_attributes.side_effect = get_queue_attributes
+        cache = QueueMetricsCache(self.client, max_age=0)
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.depth(URL)))
+            for _ in range(6)
+        ]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Give the followers time to wait on the call in progress
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual([6] * 6, results)
+        self.client.get_queue_attributes.assert_called_once()
+        self.assertEqual({"hits": 0, "misses": 1, "shared": 5}, cache.stats)
+
+    def test_single_flight_error(self):
+        error = ClientError({"Error": {"Code": "AccessDenied"}}, "GetQueueAttributes")
+        cache = QueueMetricsCache(self.client)
+        self.client.get_queue_attributes.side_effect = error
+        with self.assertRaises(ClientError):
+            cache.get(URL)
+
+        # The failed call is not cached
+        self.client.get_queue_attributes.side_effect = None
+        self.assertEqual(ATTRIBUTES, cache.get(URL))
+
+    def test_depth(self):
+        cache = QueueMetricsCache(self.client)
+        self.assertEqual(6, cache.depth(URL))
+
+    def test_invalidate(self):
+        cache = QueueMetricsCache(self.client, max_age=60)
+        cache.get(URL)
+        cache.invalidate(URL)
+        cache.get(URL)
+        cache.invalidate()
+        cache.get(URL)
+        self.assertEqual(3, self.client.get_queue_attributes.call_count)
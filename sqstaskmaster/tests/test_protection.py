@@ -0,0 +1,75 @@
+import io
+import json
+import unittest
+from unittest.mock import patch
+
+from sqstaskmaster.protection import (
+    EcsTaskProtection,
+    LocalTaskProtection,
+    protection_minutes,
+)
+
+
+class TestProtection(unittest.TestCase):
+    def test_protection_minutes(self):
+        self.assertEqual(1, protection_minutes(1))
+        self.assertEqual(1, protection_minutes(60))
+        self.assertEqual(2, protection_minutes(61))
+        self.assertEqual(48 * 60, protection_minutes(7 * 24 * 60 * 60))
+
+    def test_local(self):
+        protection = LocalTaskProtection()
+        self.assertFalse(protection.protected)
+        protection.protect(10)
+        self.assertTrue(protection.protected)
+        self.assertEqual(10, protection.expires_in_minutes)
+        protection.unprotect()
+        self.assertFalse(protection.protected)
+
+
+@patch("sqstaskmaster.protection.urllib.request.urlopen")
+class TestEcsTaskProtection(unittest.TestCase):
+    AGENT_URI = "http://169.254.170.2/api/task-id"
+
+    def respond(self, urlopen, result):
+        urlopen.return_value.__enter__.return_value = io.BytesIO(
+            json.dumps(result).encode("utf-8")
+        )
+
+    def test___init__(self, urlopen):
+        with patch.dict("os.environ", {"ECS_AGENT_URI": self.AGENT_URI}):
+            self.assertEqual(self.AGENT_URI, EcsTaskProtection().agent_uri)
+
+        with patch.dict("os.environ", {}, clear=True):
+            with self.assertRaisesRegex(ValueError, "ECS_AGENT_URI is not set"):
+                EcsTaskProtection()
+
+    def test_protect(self, urlopen):
+        protection = {"ProtectionEnabled": True, "TaskArn": "arn"}
+        self.respond(urlopen, {"protection": protection})
+
+        self.assertEqual(
+            protection, EcsTaskProtection(self.AGENT_URI, timeout=3).protect(60)
+        )
+
+        request = urlopen.call_args[0][0]
+        self.assertEqual(self.AGENT_URI + "/task-protection/v1/state", request.full_url)
+        self.assertEqual("PUT", request.get_method())
+        self.assertEqual(
+            {"ProtectionEnabled": True, "ExpiresInMinutes": 60},
+            json.loads(request.data.decode("utf-8")),
+        )
+        self.assertEqual(3, urlopen.call_args[1]["timeout"])
+
+    def test_unprotect(self, urlopen):
+        self.respond(urlopen, {"protection": {"ProtectionEnabled": False}})
+        EcsTaskProtection(self.AGENT_URI).unprotect()
+        self.assertEqual(
+            {"ProtectionEnabled": False},
+            json.loads(urlopen.call_args[0][0].data.decode("utf-8")),
+        )
+
+    def test_failure(self, urlopen):
+        self.respond(urlopen, {"failure": {"Reason": "TASK_NOT_VALID"}})
+        with self.assertRaisesRegex(RuntimeError, "Failed to set task protection"):
+            EcsTaskProtection(self.AGENT_URI).protect(60)
@@ -1,10 +1,15 @@
+import os
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, Mock
 
 from botocore.exceptions import ClientError
 
 from sqstaskmaster import queue_scale
 from sqstaskmaster.queue_scale import ServiceState
+from sqstaskmaster.scaling import AllOrNothingPolicy, ProportionalPolicy
 
 
 @patch("sqstaskmaster.queue_scale.boto3")
@@ -55,8 +60,10 @@ class TestBatchJobResourceMonitorTask(unittest.TestCase):
     def test_run_with_messages(self, boto3):
         provisioner = queue_scale.Provisioner([self.RULE])
 
-        boto3.resource.return_value.Queue.return_value.attributes = {
-            name: "2" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+        boto3.resource.return_value.meta.client.get_queue_attributes.return_value = {
+            "Attributes": {
+                name: "2" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+            }
         }
 
         with patch.object(
@@ -64,8 +71,9 @@ class TestBatchJobResourceMonitorTask(unittest.TestCase):
         ):
             provisioner.run()
 
-        boto3.resource.return_value.Queue.assert_called_with(
-            self.RULE[provisioner.QUEUE_NAME]
+        boto3.resource.return_value.meta.client.get_queue_attributes.assert_called_with(
+            QueueUrl=self.RULE[provisioner.QUEUE_NAME],
+            AttributeNames=list(provisioner.QUEUE_DEPTH_ATTRIBUTES.values()),
         )
         boto3.client.return_value.update_service.assert_called_with(
             cluster=self.RULE[provisioner.CLUSTER_NAME],
@@ -75,15 +83,18 @@ class TestBatchJobResourceMonitorTask(unittest.TestCase):
 
     def test_run_without_messages(self, boto3):
         provisioner = queue_scale.Provisioner([self.RULE])
-        boto3.resource.return_value.Queue.return_value.attributes = {
-            name: "0" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+        boto3.resource.return_value.meta.client.get_queue_attributes.return_value = {
+            "Attributes": {
+                name: "0" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+            }
         }
         with patch.object(
             queue_scale.Provisioner, "service_state", lambda _, __: ServiceState.ACTIVE
         ):
             provisioner.run()
-        boto3.resource.return_value.Queue.assert_called_with(
-            self.RULE[provisioner.QUEUE_NAME]
+        boto3.resource.return_value.meta.client.get_queue_attributes.assert_called_with(
+            QueueUrl=self.RULE[provisioner.QUEUE_NAME],
+            AttributeNames=list(provisioner.QUEUE_DEPTH_ATTRIBUTES.values()),
         )
         boto3.client.return_value.update_service.assert_called_with(
             cluster=self.RULE[provisioner.CLUSTER_NAME],
@@ -96,7 +107,7 @@ class TestBatchJobResourceMonitorTask(unittest.TestCase):
         notify = Mock()
         ce = ClientError({}, "operation")
         provisioner = queue_scale.Provisioner([self.RULE], notify=notify)
-        boto3.resource.return_value.Queue.side_effect = Mock(side_effect=ce)
+        boto3.resource.return_value.meta.client.get_queue_attributes.side_effect = ce
         with patch.object(
             queue_scale.Provisioner, "service_state", lambda _, __: ServiceState.ACTIVE
         ):
@@ -116,6 +127,425 @@ class TestBatchJobResourceMonitorTask(unittest.TestCase):
             provisioner.run()
         boto3.client.return_value.update_service.assert_not_called()
 
+    def test_max_workers(self, boto3):
+        self.assertEqual(queue_scale.Provisioner([self.RULE]).max_workers, 10)
+        with self.assertRaisesRegex(
+            ValueError, "Max workers 0 must be greater than zero"
+        ):
+            queue_scale.Provisioner([self.RULE], max_workers=0)
+
+    def test_run_all_rules_concurrently(self, boto3):
+        rules = [
+            dict(
+                self.RULE, **{queue_scale.Provisioner.SERVICE_NAME: "service" + str(i)}
+            )
+            for i in range(25)
+        ]
+        provisioner = queue_scale.Provisioner(rules, max_workers=4)
+        boto3.resource.return_value.meta.client.get_queue_attributes.return_value = {
+            "Attributes": {
+                name: "1" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+            }
+        }
+
+        with patch.object(
+            queue_scale.Provisioner, "service_state", lambda _, __: ServiceState.ACTIVE
+        ), patch(
+            "sqstaskmaster.queue_scale.ThreadPoolExecutor", wraps=ThreadPoolExecutor
+        ) as pool:
+            provisioner.run()
+
+        pool.assert_called_once_with(max_workers=4)
+        self.assertEqual(boto3.client.return_value.update_service.call_count, 25)
+        self.assertSetEqual(
+            {
+                c[1]["service"]
+                for c in boto3.client.return_value.update_service.call_args_list
+            },
+            {"service" + str(i) for i in range(25)},
+        )
+        # Desired counts are reconciled in batches of 10 services
+        self.assertEqual(boto3.client.return_value.describe_services.call_count, 3)
+
+    def test_describe_services_batches(self, boto3):
+        rules = [
+            dict(
+                self.RULE,
+                **{
+                    queue_scale.Provisioner.SERVICE_NAME: "service" + str(i),
+                    queue_scale.Provisioner.CLUSTER_NAME: "cluster" + str(i // 12),
+                }
+            )
+            for i in range(13)
+        ]
+        provisioner = queue_scale.Provisioner(rules)
+
+        def describe_services(cluster, services, include):
+            return {
+                "services": [{"serviceName": name} for name in services[1:]],
+                "failures": [{"arn": services[0], "reason": "MISSING"}],
+            }
+
+        boto3.client.return_value.describe_services.side_effect = describe_services
+        descriptions = provisioner.describe_services(rules)
+
+        self.assertListEqual(
+            [
+                (c[1]["cluster"], len(c[1]["services"]))
+                for c in boto3.client.return_value.describe_services.call_args_list
+            ],
+            [("cluster0", 10), ("cluster0", 2), ("cluster1", 1)],
+        )
+        self.assertEqual(len(descriptions), 10)
+        self.assertDictEqual(
+            descriptions[("cluster0", "service11")], {"serviceName": "service11"}
+        )
+        self.assertNotIn(("cluster0", "service0"), descriptions)
+
+    def test_run_with_service_state_uses_batched_descriptions(self, boto3):
+        class TaggedProvisioner(queue_scale.Provisioner):
+            def service_state(self, rule):
+                description = self.get_description(rule)
+                return (
+                    ServiceState.ACTIVE
+                    if description.get("status") == "ACTIVE"
+                    else ServiceState.STARTING
+                )
+
+        rules = [
+            self.RULE,
+            dict(self.RULE, **{queue_scale.Provisioner.SERVICE_NAME: "draining"}),
+        ]
+        provisioner = TaggedProvisioner(rules)
+        boto3.resource.return_value.meta.client.get_queue_attributes.return_value = {
+            "Attributes": {
+                name: "1" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+            }
+        }
+        boto3.client.return_value.describe_services.return_value = {
+            "services": [
+                {
+                    "serviceName": self.RULE[provisioner.SERVICE_NAME],
+                    "status": "ACTIVE",
+                },
+                {"serviceName": "draining", "status": "DRAINING"},
+            ],
+            "failures": [],
+        }
+
+        provisioner.run()
+
+        boto3.client.return_value.describe_services.assert_called_once_with(
+            cluster=self.RULE[provisioner.CLUSTER_NAME],
+            services=[self.RULE[provisioner.SERVICE_NAME], "draining"],
+            include=["TAGS"],
+        )
+        boto3.client.return_value.update_service.assert_called_once_with(
+            cluster=self.RULE[provisioner.CLUSTER_NAME],
+            service=self.RULE[provisioner.SERVICE_NAME],
+            desiredCount=self.RULE[provisioner.ACTIVE_SIZE],
+        )
+        self.assertDictEqual(provisioner._descriptions, {})
+
+    def test_run_skips_unchanged_desired_count(self, boto3):
+        provisioner = queue_scale.Provisioner([self.RULE])
+        get_queue_attributes = (
+            boto3.resource.return_value.meta.client.get_queue_attributes
+        )
+        describe_services = boto3.client.return_value.describe_services
+        update_service = boto3.client.return_value.update_service
+
+        get_queue_attributes.return_value = {
+            "Attributes": {
+                name: "2" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+            }
+        }
+        describe_services.return_value = {
+            "services": [
+                {"serviceName": self.RULE[provisioner.SERVICE_NAME], "desiredCount": 8}
+            ],
+            "failures": [],
+        }
+
+        # Observed count already matches
+        provisioner.run()
+        update_service.assert_not_called()
+        describe_services.assert_called_once()
+
+        # Target changes
+        get_queue_attributes.return_value = {
+            "Attributes": {
+                name: "0" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+            }
+        }
+        provisioner.run()
+        update_service.assert_called_once_with(
+            cluster=self.RULE[provisioner.CLUSTER_NAME],
+            service=self.RULE[provisioner.SERVICE_NAME],
+            desiredCount=0,
+        )
+
+        # Requested count is cached until the next reconcile
+        provisioner.run()
+        update_service.assert_called_once()
+        describe_services.assert_called_once()
+        self.assertDictEqual(
+            provisioner.stats, {"updates_issued": 1, "updates_skipped": 2}
+        )
+
+    def test_run_reconciles_after_ttl(self, boto3):
+        provisioner = queue_scale.Provisioner([self.RULE], service_cache_ttl=60)
+        boto3.resource.return_value.meta.client.get_queue_attributes.return_value = {
+            "Attributes": {
+                name: "0" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+            }
+        }
+        describe_services = boto3.client.return_value.describe_services
+        describe_services.return_value = {
+            "services": [
+                {"serviceName": self.RULE[provisioner.SERVICE_NAME], "desiredCount": 0}
+            ],
+            "failures": [],
+        }
+
+        with patch("sqstaskmaster.queue_scale.time.time", return_value=1000):
+            provisioner.run()
+        with patch("sqstaskmaster.queue_scale.time.time", return_value=1050):
+            provisioner.run()
+        self.assertEqual(describe_services.call_count, 1)
+
+        # Someone else scaled the service up - observed after the ttl
+        describe_services.return_value["services"][0]["desiredCount"] = 3
+        with patch("sqstaskmaster.queue_scale.time.time", return_value=1061):
+            provisioner.run()
+        self.assertEqual(describe_services.call_count, 2)
+        boto3.client.return_value.update_service.assert_called_once_with(
+            cluster=self.RULE[provisioner.CLUSTER_NAME],
+            service=self.RULE[provisioner.SERVICE_NAME],
+            desiredCount=0,
+        )
+
+    def test_set_desired_count_unknown_service(self, boto3):
+        provisioner = queue_scale.Provisioner([self.RULE])
+        self.assertTrue(provisioner.set_desired_count(self.RULE, 3))
+        # Never reconciled so the cache is stale and the update is issued again
+        self.assertTrue(provisioner.set_desired_count(self.RULE, 3))
+        self.assertEqual(boto3.client.return_value.update_service.call_count, 2)
+
+    def test_run_with_policy(self, boto3):
+        policy = ProportionalPolicy(throughput=0.01, target_drain_time=100)
+        provisioner = queue_scale.Provisioner(
+            [
+                self.RULE,
+                dict(
+                    self.RULE,
+                    **{
+                        queue_scale.Provisioner.SERVICE_NAME: "other",
+                        queue_scale.Provisioner.POLICY: AllOrNothingPolicy(),
+                    }
+                ),
+            ],
+            policy=policy,
+        )
+        self.assertIs(provisioner.policy, policy)
+        boto3.resource.return_value.meta.client.get_queue_attributes.return_value = {
+            "Attributes": {
+                name: "2" for name in provisioner.QUEUE_DEPTH_ATTRIBUTES.values()
+            }
+        }
+
+        provisioner.run()
+
+        boto3.client.return_value.update_service.assert_any_call(
+            cluster=self.RULE[provisioner.CLUSTER_NAME],
+            service=self.RULE[provisioner.SERVICE_NAME],
+            desiredCount=6,
+        )
+        boto3.client.return_value.update_service.assert_any_call(
+            cluster=self.RULE[provisioner.CLUSTER_NAME],
+            service="other",
+            desiredCount=self.RULE[provisioner.ACTIVE_SIZE],
+        )
+
+    def test_target_count(self, boto3):
+        policy = Mock()
+        provisioner = queue_scale.Provisioner([self.RULE], policy=policy)
+        provisioner._service_counts[
+            (self.RULE[provisioner.CLUSTER_NAME], self.RULE[provisioner.SERVICE_NAME])
+        ] = {"observed": 3, "requested": None, "reconciled": 0}
+
+        self.assertEqual(
+            provisioner.target_count(self.RULE, 12, now=1000),
+            policy.desired_count.return_value,
+        )
+        policy.desired_count.assert_called_once_with(
+            (self.RULE[provisioner.CLUSTER_NAME], self.RULE[provisioner.SERVICE_NAME]),
+            12,
+            3,
+            8,
+            1000,
+            history=None,
+        )
+
+    def test_queue_attributes_metrics_cache(self, boto3):
+        metrics_cache = Mock()
+        provisioner = queue_scale.Provisioner([self.RULE], metrics_cache=metrics_cache)
+        self.assertIs(
+            metrics_cache.get.return_value, provisioner.queue_attributes(self.RULE)
+        )
+        url, names = metrics_cache.get.call_args[0]
+        self.assertEqual(self.RULE[provisioner.QUEUE_NAME], url)
+        self.assertEqual(
+            sorted(provisioner.QUEUE_DEPTH_ATTRIBUTES.values()), sorted(names)
+        )
+        boto3.resource.return_value.meta.client.get_queue_attributes.assert_not_called()
+
+    def test_busy_count(self, boto3):
+        ecs = boto3.client.return_value
+        arns = ["arn{}".format(i) for i in range(12)]
+        ecs.list_tasks.side_effect = [
+            {"taskArns": arns[:7], "nextToken": "token"},
+            {"taskArns": arns[7:]},
+        ]
+        ecs.get_task_protection.side_effect = [
+            {
+                "protectedTasks": [
+                    {"taskArn": arn, "protectionEnabled": i % 2 == 0}
+                    for i, arn in enumerate(arns[:10])
+                ],
+                "failures": [],
+            },
+            {
+                "protectedTasks": [{"taskArn": "arn10", "protectionEnabled": True}],
+                "failures": [{"arn": "arn11", "reason": "MISSING"}],
+            },
+        ]
+        provisioner = queue_scale.Provisioner([self.RULE])
+
+        self.assertEqual(6, provisioner.busy_count(self.RULE))
+        ecs.list_tasks.assert_called_with(
+            cluster=self.RULE[provisioner.CLUSTER_NAME],
+            serviceName=self.RULE[provisioner.SERVICE_NAME],
+            desiredStatus="RUNNING",
+            nextToken="token",
+        )
+        ecs.get_task_protection.assert_any_call(
+            cluster=self.RULE[provisioner.CLUSTER_NAME], tasks=arns[:10]
+        )
+        ecs.get_task_protection.assert_called_with(
+            cluster=self.RULE[provisioner.CLUSTER_NAME], tasks=arns[10:]
+        )
+
+    def test_protect_busy(self, boto3):
+        provisioner = queue_scale.Provisioner([self.RULE], scale_in_protection=True)
+        provisioner.busy_count = Mock(return_value=3)
+
+        # Unknown count and scale out do not check the workers
+        self.assertEqual(0, provisioner.protect_busy(self.RULE, 0))
+        provisioner._service_counts[
+            (self.RULE[provisioner.CLUSTER_NAME], self.RULE[provisioner.SERVICE_NAME])
+        ] = {"observed": 8, "requested": None, "reconciled": time.time()}
+        self.assertEqual(8, provisioner.protect_busy(self.RULE, 8))
+        provisioner.busy_count.assert_not_called()
+
+        self.assertEqual(3, provisioner.protect_busy(self.RULE, 0))
+        self.assertEqual(5, provisioner.protect_busy(self.RULE, 5))
+        provisioner.busy_count.return_value = 10
+        self.assertEqual(8, provisioner.protect_busy(self.RULE, 0))
+
+    def test_run_scale_in_protection(self, boto3):
+        boto3.resource.return_value.meta.client.get_queue_attributes.return_value = {
+            "Attributes": {
+                "ApproximateNumberOfMessages": "0",
+                "ApproximateNumberOfMessagesNotVisible": "0",
+                "ApproximateNumberOfMessagesDelayed": "0",
+            }
+        }
+        boto3.client.return_value.describe_services.return_value = {
+            "services": [
+                {
+                    "serviceName": self.RULE[queue_scale.Provisioner.SERVICE_NAME],
+                    "desiredCount": 8,
+                }
+            ],
+            "failures": [],
+        }
+        provisioner = queue_scale.Provisioner([self.RULE], scale_in_protection=True)
+        provisioner.busy_count = Mock(return_value=2)
+        provisioner.run()
+
+        boto3.client.return_value.update_service.assert_called_once_with(
+            cluster=self.RULE[provisioner.CLUSTER_NAME],
+            service=self.RULE[provisioner.SERVICE_NAME],
+            desiredCount=2,
+        )
+
+    def test_record_depth(self, boto3):
+        policy = Mock()
+        provisioner = queue_scale.Provisioner([self.RULE], policy=policy)
+
+        history = provisioner.record_depth(self.RULE, 5, now=1000)
+        provisioner.record_depth(self.RULE, 7, now=1010)
+        provisioner.record_depth(self.RULE, 9, now=1060)
+        self.assertIs(provisioner.history[self.RULE[provisioner.QUEUE_NAME]], history)
+        self.assertEqual([(1000.0, 5.0, 0.0), (1060.0, 9.0, 4 / 60)], history.samples())
+
+        provisioner.target_count(self.RULE, 9, now=1060)
+        self.assertIs(policy.desired_count.call_args[1]["history"], history)
+
+    def test_save_history(self, boto3):
+        with tempfile.TemporaryDirectory() as directory:
+            provisioner = queue_scale.Provisioner(
+                [self.RULE], history_directory=directory
+            )
+            provisioner.record_depth(self.RULE, 5, now=1000)
+            provisioner.record_depth(self.RULE, 9, now=1060)
+            provisioner.save_history()
+
+            restarted = queue_scale.Provisioner(
+                [self.RULE], history_directory=directory
+            )
+            history = restarted.record_depth(self.RULE, 3, now=1120)
+            self.assertEqual(
+                [(1000.0, 5.0), (1060.0, 9.0), (1120.0, 3.0)],
+                [sample[:2] for sample in history.samples()],
+            )
+
+    def test_load_corrupt_history(self, boto3):
+        with tempfile.TemporaryDirectory() as directory:
+            provisioner = queue_scale.Provisioner(
+                [self.RULE], history_directory=directory
+            )
+            # Truncated in the middle of a sample
+            with open(
+                provisioner._history_path(self.RULE[provisioner.QUEUE_NAME]), "wb"
+            ) as fh:
+                fh.write(b"\x00" * 12)
+
+            with patch("sqstaskmaster.queue_scale.logger") as mock_logger:
+                history = provisioner.record_depth(self.RULE, 3, now=1120)
+            mock_logger.exception.assert_called_once()
+            self.assertEqual([(1120.0, 3.0)], [s[:2] for s in history.samples()])
+
+    def test_run_saves_history(self, boto3):
+        boto3.resource.return_value.meta.client.get_queue_attributes.return_value = {
+            "Attributes": {
+                "ApproximateNumberOfMessages": "2",
+                "ApproximateNumberOfMessagesNotVisible": "0",
+                "ApproximateNumberOfMessagesDelayed": "0",
+            }
+        }
+        boto3.client.return_value.describe_services.return_value = {
+            "services": [],
+            "failures": [],
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            provisioner = queue_scale.Provisioner(
+                [self.RULE], history_directory=directory, history_save_interval=0
+            )
+            provisioner.run()
+            self.assertEqual(1, len(os.listdir(directory)))
+
     def test_get_description_success(self, boto3):
         provisioner = queue_scale.Provisioner([self.RULE])
 
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, Mock
+
+from sqstaskmaster.rate_limit import (
+    MemoryBucketStore,
+    RateLimiter,
+    SQLiteBucketStore,
+    take,
+)
+
+
+class TestTake(unittest.TestCase):
+    def test_new_bucket(self):
+        self.assertEqual((2, 0), take(None, 0, rate=1, burst=3, now=10))
+
+    def test_refill(self):
+        self.assertEqual((0.5, 0), take(0, 10, rate=0.5, burst=3, now=13))
+        # Capped at the burst
+        self.assertEqual((2, 0), take(0, 10, rate=1, burst=3, now=100))
+
+    def test_wait(self):
+        tokens, wait = take(0, 10, rate=2, burst=3, now=10.25)
+        self.assertEqual(0.5, tokens)
+        self.assertEqual(0.25, wait)
+
+
+class BucketStoreTests:
+    def test_take(self):
+        self.assertEqual(0, self.store.take("task", 1, 2))
+        self.assertEqual(0, self.store.take("task", 1, 2))
+        self.assertGreater(self.store.take("task", 1, 2), 0)
+        # Buckets are independent
+        self.assertEqual(0, self.store.take("other", 1, 1))
+
+
+class TestMemoryBucketStore(BucketStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryBucketStore()
+
+    @patch("sqstaskmaster.rate_limit.time.monotonic")
+    def test_refill(self, mock_time):
+        mock_time.return_value = 100
+        self.assertEqual(0, self.store.take("task", 2, 1))
+        self.assertEqual(0.5, self.store.take("task", 2, 1))
+        mock_time.return_value = 100.5
+        self.assertEqual(0, self.store.take("task", 2, 1))
+
+
+class TestSQLiteBucketStore(BucketStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "buckets.db")
+        self.store = SQLiteBucketStore(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shared(self):
+        self.assertEqual(0, self.store.take("task", 0.001, 1))
+        self.assertGreater(SQLiteBucketStore(self.path).take("task", 0.001, 1), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_limits(self):
+        limiter = RateLimiter({"slow": 0.5, "fast": 5, "burst": (2, 10)})
+        self.assertEqual(
+            {"slow": (0.5, 1), "fast": (5, 5), "burst": (2, 10)}, limiter.limits
+        )
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(ValueError, "Rate 0 for task t"):
+            RateLimiter({"t": 0})
+        with self.assertRaisesRegex(ValueError, "Burst 0.5 for task t"):
+            RateLimiter({"t": (1, 0.5)})
+        with self.assertRaisesRegex(ValueError, "Max defer 0"):
+            RateLimiter({}, max_defer=0)
+
+    def test_acquire(self):
+        store = Mock()
+        store.take.return_value = 1.5
+        limiter = RateLimiter({"limited": (1, 2)}, store=store)
+        self.assertEqual(0, limiter.acquire("unlimited"))
+        self.assertEqual(1.5, limiter.acquire("limited"))
+        store.take.assert_called_once_with("limited", 1, 2)
+
+    @patch("sqstaskmaster.rate_limit.random.random", return_value=1)
+    def test_defer_seconds(self, mock_random):
+        limiter = RateLimiter({}, max_defer=30, jitter=0.5)
+        self.assertEqual(1, limiter.defer_seconds(0.1))
+        self.assertEqual(15, limiter.defer_seconds(10))
+        self.assertEqual(30, limiter.defer_seconds(100))
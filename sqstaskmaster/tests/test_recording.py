@@ -0,0 +1,107 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from sqstaskmaster.local import LocalQueue
+from sqstaskmaster.recording import Recorder, Replayer, arrival_time, peek
+from sqstaskmaster.task_manager import TaskManager
+
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "traffic.jsonl.gz")
+        self.source = TaskManager("recorded", queue_constructor=LocalQueue)
+        self.target = TaskManager("replayed", queue_constructor=LocalQueue)
+
+    def tearDown(self):
+        self.source.purge()
+        self.target.purge()
+        self.directory.cleanup()
+
+    def write(self, times):
+        with gzip.open(self.path, "wt") as fh:
+            for index, sent in enumerate(times):
+                record = {
+                    "time": sent,
+                    "message_id": str(index),
+                    "body": json.dumps({"task": "t", "kwargs": {"i": index}}),
+                    "attributes": {"MessageGroupId": "g"},
+                    "message_attributes": {},
+                }
+                fh.write(json.dumps(record) + "\n")
+
+    def test_arrival_time(self):
+        self.assertEqual(
+            1600000000.5,
+            arrival_time(Mock(attributes={"SentTimestamp": "1600000000500"})),
+        )
+        with patch("sqstaskmaster.recording.time.time", return_value=7.0):
+            self.assertEqual(7.0, arrival_time(Mock(attributes={})))
+
+    def test_record_task_generator(self):
+        for i in range(3):
+            self.source.submit("t", i=i)
+
+        with Recorder(self.path) as recorder:
+            generator = self.source.task_generator(
+                wait_time=0, max_messages=3, recorder=recorder
+            )
+            self.assertEqual([0, 1, 2], [next(generator)[1]["i"] for _ in range(3)])
+            self.assertEqual(3, recorder.count)
+
+        # Appends to the recording
+        self.source.submit("t", i=3)
+        with Recorder(self.path) as recorder:
+            self.assertEqual(1, peek(self.source, recorder, empty_receives=1))
+
+        records = list(Replayer(self.path).records())
+        self.assertEqual(
+            [0, 1, 2, 3], [json.loads(r["body"])["kwargs"]["i"] for r in records]
+        )
+        self.assertEqual(
+            "Unknown sender to: recorded",
+            records[0]["message_attributes"]["service_name"]["StringValue"],
+        )
+
+    def test_peek_limit(self):
+        for i in range(25):
+            self.source.submit("t", i=i)
+        with Recorder(self.path) as recorder:
+            self.assertEqual(12, peek(self.source, recorder, limit=12))
+        self.assertEqual(12, len(list(Replayer(self.path).records())))
+
+    @patch("sqstaskmaster.recording.time.sleep")
+    @patch("sqstaskmaster.recording.time.monotonic")
+    def test_replay(self, mock_monotonic, mock_sleep):
+        clock = [100.0]
+        mock_monotonic.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds
+        )
+        self.write([1000.0, 1002.0, 1001.0, 1010.0])
+
+        self.assertEqual(4, Replayer(self.path, speed=2).replay(self.target))
+        # The out of order message is sent without a sleep
+        self.assertEqual([1.0, 4.0], [c[0][0] for c in mock_sleep.call_args_list])
+        self.assertEqual(4, self.target.depth())
+        message = self.target.queue.receive_messages()[0]
+        self.assertEqual({"task": "t", "kwargs": {"i": 0}}, json.loads(message.body))
+
+    @patch("sqstaskmaster.recording.time.sleep")
+    def test_replay_fast(self, mock_sleep):
+        self.write([1000.0, 2000.0, 3000.0])
+        fifo = TaskManager("replayed.fifo", queue_constructor=LocalQueue)
+        try:
+            self.assertEqual(2, Replayer(self.path, speed=None).replay(fifo, limit=2))
+            mock_sleep.assert_not_called()
+            self.assertEqual(2, fifo.depth())
+        finally:
+            fifo.purge()
+
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Speed 0 must be greater than zero"):
+            Replayer(self.path, speed=0)
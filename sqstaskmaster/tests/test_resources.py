@@ -0,0 +1,120 @@
+import os
+import resource
+import signal
+import unittest
+from unittest.mock import Mock, call, patch
+
+from sqstaskmaster.resources import THREAD_ENV_VARS, ResourcePolicy, available_cpus
+
+
+class TestResourcePolicy(unittest.TestCase):
+    def test_init(self):
+        policy = ResourcePolicy(cpus={3, 1})
+        self.assertEqual([1, 3], policy.cpus)
+        self.assertEqual(2, policy.threads)
+        self.assertIsNone(ResourcePolicy().threads)
+        self.assertEqual(4, ResourcePolicy(cpus=[0], threads=4).threads)
+
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Cpus must not be empty"):
+            ResourcePolicy(cpus=[])
+        with self.assertRaisesRegex(ValueError, "Threads 0 must be greater than zero"):
+            ResourcePolicy(threads=0)
+        with self.assertRaisesRegex(ValueError, "Address space 0"):
+            ResourcePolicy(address_space=0)
+        with self.assertRaisesRegex(ValueError, "Cpu time -1"):
+            ResourcePolicy(cpu_time=-1)
+
+    def test_for_slot(self):
+        cpus = range(8)
+        self.assertEqual(
+            [[0, 1], [2, 3], [4, 5], [6, 7]],
+            [ResourcePolicy.for_slot(slot, 4, cpus=cpus).cpus for slot in range(4)],
+        )
+        self.assertEqual(
+            [[0], [1, 2]],
+            [
+                ResourcePolicy.for_slot(slot, 2, cpus=[0, 1, 2]).cpus
+                for slot in range(2)
+            ],
+        )
+        # More slots than cpus
+        self.assertEqual(
+            [[0], [0], [1], [1]],
+            [ResourcePolicy.for_slot(slot, 4, cpus=[0, 1]).cpus for slot in range(4)],
+        )
+        policy = ResourcePolicy.for_slot(0, 1, cpu_time=10)
+        self.assertEqual(available_cpus(), policy.cpus)
+        self.assertEqual(10, policy.cpu_time)
+
+        with self.assertRaisesRegex(
+            ValueError, "Invalid slot 4; must be between 0 and 3"
+        ):
+            ResourcePolicy.for_slot(4, 4)
+
+    @patch.dict(os.environ, {})
+    @patch("sqstaskmaster.resources.threadpoolctl")
+    @patch("sqstaskmaster.resources.os.sched_setaffinity", create=True)
+    def test_apply(self, mock_affinity, mock_threadpoolctl):
+        ResourcePolicy(cpus=[2, 3]).apply()
+        mock_affinity.assert_called_once_with(0, [2, 3])
+        for name in THREAD_ENV_VARS:
+            self.assertEqual("2", os.environ[name])
+        mock_threadpoolctl.threadpool_limits.assert_called_once_with(limits=2)
+
+    @patch.dict(os.environ, {})
+    @patch("sqstaskmaster.resources.threadpoolctl", None)
+    @patch("sqstaskmaster.resources.os.sched_setaffinity", create=True)
+    def test_apply_nothing(self, mock_affinity):
+        ResourcePolicy().apply()
+        mock_affinity.assert_not_called()
+        self.assertNotIn("OMP_NUM_THREADS", os.environ)
+
+    @patch("sqstaskmaster.resources.signal.signal")
+    @patch("sqstaskmaster.resources.resource")
+    def test_limits(self, mock_resource, mock_signal):
+        mock_resource.RLIMIT_AS = resource.RLIMIT_AS
+        mock_resource.RLIMIT_CPU = resource.RLIMIT_CPU
+        mock_resource.RLIM_INFINITY = resource.RLIM_INFINITY
+        mock_resource.getrlimit.side_effect = lambda limit: {
+            resource.RLIMIT_AS: (resource.RLIM_INFINITY, resource.RLIM_INFINITY),
+            resource.RLIMIT_CPU: (resource.RLIM_INFINITY, 500),
+        }[limit]
+        mock_resource.getrusage.return_value = Mock(ru_utime=10.2, ru_stime=1.5)
+
+        policy = ResourcePolicy(address_space=2**30, cpu_time=100)
+        with policy.limits():
+            mock_resource.setrlimit.assert_has_calls(
+                [
+                    call(resource.RLIMIT_AS, (2**30, resource.RLIM_INFINITY)),
+                    call(resource.RLIMIT_CPU, (112, 500)),
+                ]
+            )
+            mock_signal.assert_called_once_with(signal.SIGXCPU, policy._handle_cpu_time)
+
+        mock_resource.setrlimit.assert_has_calls(
+            [
+                call(
+                    resource.RLIMIT_AS,
+                    (resource.RLIM_INFINITY, resource.RLIM_INFINITY),
+                ),
+                call(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, 500)),
+            ]
+        )
+        mock_signal.assert_called_with(signal.SIGXCPU, mock_signal.return_value)
+
+        # Bounded by the hard limit
+        policy = ResourcePolicy(cpu_time=1000)
+        with policy.limits():
+            mock_resource.setrlimit.assert_called_with(resource.RLIMIT_CPU, (500, 500))
+
+    def test_handle_cpu_time(self):
+        with self.assertRaisesRegex(TimeoutError, "Hit CPU time limit 5 for task"):
+            ResourcePolicy(cpu_time=5)._handle_cpu_time(signal.SIGXCPU, None)
+
+    def test_limits_applied(self):
+        # Apply real limits in the test process and check they are restored
+        before = resource.getrlimit(resource.RLIMIT_CPU)
+        with ResourcePolicy(cpu_time=3600).limits():
+            self.assertNotEqual(before, resource.getrlimit(resource.RLIMIT_CPU))
+        self.assertEqual(before, resource.getrlimit(resource.RLIMIT_CPU))
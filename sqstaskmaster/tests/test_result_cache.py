@@ -0,0 +1,167 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from sqstaskmaster.dedupe import task_hash
+from sqstaskmaster.result_cache import (
+    FileResultStore,
+    KeyValueResultStore,
+    MemoryResultStore,
+    ResultCache,
+    SQLiteResultStore,
+)
+from sqstaskmaster.sqlite import transaction
+from sqstaskmaster.tests.test_dedupe import FakeKeyValueClient
+
+
+class ResultStoreTests:
+    def test_get_put_delete(self):
+        self.assertIsNone(self.store.get("key"))
+        self.store.put("key", '{"result": 1}')
+        self.store.put("key", '{"result": 2}')
+        self.store.put("other", '{"result": 3}')
+        self.assertEqual('{"result": 2}', self.store.get("key"))
+        self.store.delete("key")
+        self.assertIsNone(self.store.get("key"))
+        self.assertEqual('{"result": 3}', self.store.get("other"))
+        # Does not raise when missing
+        self.store.delete("key")
+
+    def test_contains(self):
+        self.assertFalse(self.store.contains("key"))
+        self.store.put("key", '{"result": null}')
+        self.assertTrue(self.store.contains("key"))
+
+
+class TestMemoryResultStore(ResultStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryResultStore()
+
+    def test_lru_eviction(self):
+        store = MemoryResultStore(max_size=2)
+        store.put("a", "1")
+        store.put("b", "2")
+        store.get("a")  # touch
+        store.put("c", "3")
+        self.assertEqual("1", store.get("a"))
+        self.assertIsNone(store.get("b"))
+
+    def test_ttl(self):
+        store = MemoryResultStore(ttl=10)
+        with patch("sqstaskmaster.result_cache.time.time", return_value=1000.0):
+            store.put("key", "1")
+        with patch("sqstaskmaster.result_cache.time.time", return_value=1009.0):
+            self.assertEqual("1", store.get("key"))
+        with patch("sqstaskmaster.result_cache.time.time", return_value=1010.0):
+            self.assertIsNone(store.get("key"))
+
+
+class TestFileResultStore(ResultStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = FileResultStore(os.path.join(self.directory.name, "nested"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _age(self, key, seconds):
+        mtime = time.time() - seconds
+        os.utime(self.store._path(key), (mtime, mtime))
+
+    def test_ttl(self):
+        self.store.ttl = 60
+        self.store.put("key", "1")
+        self.assertEqual("1", self.store.get("key"))
+        self._age("key", 61)
+        self.assertIsNone(self.store.get("key"))
+        self.assertEqual([], os.listdir(self.store.directory))
+
+    def test_size_eviction(self):
+        self.store.max_size = 2
+        for age, key in enumerate(("c", "b", "a")):
+            self.store.put(key, key)
+            self._age(key, 10 - age)
+        self.store.put("d", "d")
+        self.assertEqual(["a.json", "d.json"], sorted(os.listdir(self.store.directory)))
+
+
+class TestSQLiteResultStore(ResultStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SQLiteResultStore(os.path.join(self.directory.name, "results.db"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shared_between_instances(self):
+        self.store.put("key", "1")
+        self.assertEqual("1", SQLiteResultStore(self.store.path).get("key"))
+
+    def test_ttl(self):
+        store = SQLiteResultStore(self.store.path, ttl=10)
+        with patch("sqstaskmaster.result_cache.time.time", return_value=1000.0):
+            store.put("key", "1")
+            self.assertEqual("1", store.get("key"))
+        with patch("sqstaskmaster.result_cache.time.time", return_value=1010.0):
+            self.assertIsNone(store.get("key"))
+            store.purge_expired()
+        self.assertIsNone(self.store.get("key"))
+
+    def test_contains_read_only(self):
+        store = SQLiteResultStore(self.store.path, ttl=10)
+        with patch("sqstaskmaster.result_cache.time.time", return_value=1000.0):
+            store.put("key", "1")
+        # Another connection holding the write lock does not block lookups
+        with transaction(self.store.path):
+            with patch("sqstaskmaster.result_cache.time.time", return_value=1009.0):
+                self.assertTrue(store.contains("key"))
+            with patch("sqstaskmaster.result_cache.time.time", return_value=1010.0):
+                self.assertFalse(store.contains("key"))
+                self.assertIsNone(store.get("key"))
+
+    def test_lru_eviction(self):
+        store = SQLiteResultStore(self.store.path, max_size=2)
+        for now, key in enumerate(("a", "b")):
+            with patch("sqstaskmaster.result_cache.time.time", return_value=now):
+                store.put(key, key)
+        with patch("sqstaskmaster.result_cache.time.time", return_value=2):
+            store.get("a")  # touch
+        with patch("sqstaskmaster.result_cache.time.time", return_value=3):
+            store.put("c", "c")
+        self.assertEqual("a", store.get("a"))
+        self.assertIsNone(store.get("b"))
+
+
+class TestKeyValueResultStore(ResultStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = KeyValueResultStore(FakeKeyValueClient(), ttl=60)
+
+    def test_prefix(self):
+        self.store.put("key", "1")
+        self.assertListEqual(
+            ["sqstaskmaster:results:key"], list(self.store.client.data)
+        )
+
+
+class TestResultCache(unittest.TestCase):
+    def test_lookup(self):
+        cache = ResultCache(MemoryResultStore())
+        self.assertEqual((False, None), cache.lookup("t", {"a": 1}))
+        cache.put("t", {"a": 1, "b": [1, 2]}, None)
+        self.assertEqual((True, None), cache.lookup("t", {"b": [1, 2], "a": 1}))
+        self.assertTrue(cache.contains("t", {"b": [1, 2], "a": 1}))
+        self.assertFalse(cache.contains("t", {"a": 1}))
+        self.assertIsNotNone(cache.store.get(task_hash("t", {"a": 1, "b": [1, 2]})))
+
+        cache.invalidate("t", {"a": 1, "b": [1, 2]})
+        self.assertFalse(cache.contains("t", {"a": 1, "b": [1, 2]}))
+
+    def test_tasks(self):
+        cache = ResultCache(MemoryResultStore(), tasks=["cached"])
+        cache.put("cached", {}, {"x": 1})
+        cache.put("other", {}, {"x": 1})
+        self.assertEqual((True, {"x": 1}), cache.lookup("cached", {}))
+        self.assertFalse(cache.contains("other", {}))
+        self.assertEqual(1, len(cache.store._entries))
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, Mock
+
+from sqstaskmaster.results import (
+    FileResultBackend,
+    Job,
+    SQLiteResultBackend,
+)
+
+
+class BackendTests:
+    def test_put_and_results(self):
+        self.assertDictEqual(self.backend.results("job1"), {})
+        self.assertEqual(self.backend.count("job1"), 0)
+
+        self.backend.put("job1", 0, {"score": 1.5})
+        self.backend.put("job1", 3, [1, 2])
+        self.backend.put("job2", 0, "other job")
+        self.backend.put("job1", 0, {"score": 2.5})
+
+        self.assertDictEqual(
+            self.backend.results("job1"), {0: {"score": 2.5}, 3: [1, 2]}
+        )
+        self.assertEqual(self.backend.count("job1"), 2)
+        self.assertEqual(self.backend.count("job2"), 1)
+
+    def test_report(self):
+        self.backend.report({"job_id": "job1", "shard": 2, "items": [1]}, "result")
+        self.assertDictEqual(self.backend.results("job1"), {2: "result"})
+
+
+class TestFileResultBackend(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = FileResultBackend(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_no_partial_files(self):
+        self.backend.put("job1", 0, "result")
+        self.assertListEqual(
+            os.listdir(os.path.join(self.directory.name, "job1")), ["0.json"]
+        )
+
+
+class TestSQLiteResultBackend(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = SQLiteResultBackend(
+            os.path.join(self.directory.name, "results.db")
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shared_file(self):
+        self.backend.put("job1", 0, "result")
+        other = SQLiteResultBackend(self.backend.path)
+        self.assertDictEqual(other.results("job1"), {0: "result"})
+
+
+class TestJob(unittest.TestCase):
+    def test_progress(self):
+        backend = Mock()
+        backend.count.return_value = 2
+        job = Job("job1", 3, backend)
+        self.assertEqual(job.progress(), (2, 3))
+        self.assertFalse(job.done())
+        backend.count.assert_called_with("job1")
+
+        backend.count.return_value = 3
+        self.assertTrue(job.done())
+
+    @patch("sqstaskmaster.results.time.sleep")
+    def test_results_streams_completed_shards(self, mock_sleep):
+        backend = Mock()
+        backend.results.side_effect = [
+            {1: "b"},
+            {1: "b"},
+            {0: "a", 1: "b", 2: "c"},
+        ]
+        job = Job("job1", 3, backend)
+
+        self.assertListEqual(
+            list(job.results(poll_interval=7)), [(1, "b"), (0, "a"), (2, "c")]
+        )
+        self.assertEqual(mock_sleep.call_count, 2)
+        mock_sleep.assert_called_with(7)
+
+    @patch("sqstaskmaster.results.time.sleep")
+    def test_results_timeout(self, mock_sleep):
+        backend = Mock()
+        backend.results.return_value = {0: "a"}
+        job = Job("job1", 2, backend)
+
+        results = job.results(timeout=0)
+        self.assertEqual(next(results), (0, "a"))
+        with self.assertRaisesRegex(TimeoutError, "Job job1 completed 1 of 2 shards"):
+            next(results)
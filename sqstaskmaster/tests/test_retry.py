@@ -0,0 +1,112 @@
+import unittest
+from unittest.mock import patch, Mock
+
+from sqstaskmaster.retry import (
+    ERROR_MESSAGE,
+    ERROR_TYPE,
+    MAX_VISIBILITY_TIMEOUT,
+    RetryPolicy,
+    error_attributes,
+)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test___init__(self):
+        instance = RetryPolicy()
+        self.assertEqual(instance.base, 30)
+        self.assertEqual(instance.cap, MAX_VISIBILITY_TIMEOUT)
+        self.assertTrue(instance.jitter)
+        self.assertIsNone(instance.max_receives)
+        self.assertIsNone(instance.dead_letter_queue)
+
+        with self.assertRaisesRegex(
+            ValueError, "Base backoff -1 must be greater than or equal to zero"
+        ):
+            RetryPolicy(base=-1)
+
+        with self.assertRaisesRegex(
+            ValueError, "Backoff cap 10 must be between base 30 and 12 hours"
+        ):
+            RetryPolicy(base=30, cap=10)
+
+        with self.assertRaisesRegex(
+            ValueError, "Max receives 0 must be greater than zero"
+        ):
+            RetryPolicy(max_receives=0, dead_letter_queue=Mock())
+
+        with self.assertRaisesRegex(
+            ValueError, "Max receives and dead letter queue must be specified together"
+        ):
+            RetryPolicy(max_receives=3)
+
+    def test_receive_count(self):
+        instance = RetryPolicy()
+        self.assertEqual(
+            instance.receive_count(Mock(attributes={"ApproximateReceiveCount": "4"})),
+            4,
+        )
+        self.assertEqual(instance.receive_count(Mock(attributes={})), 1)
+        self.assertEqual(instance.receive_count(Mock(attributes=None)), 1)
+
+    def test_backoff(self):
+        instance = RetryPolicy(base=10, cap=100, jitter=False)
+        self.assertListEqual(
+            [instance.backoff(count) for count in range(1, 7)],
+            [10, 20, 40, 80, 100, 100],
+        )
+
+    @patch("sqstaskmaster.retry.random.uniform", return_value=33.7)
+    def test_backoff_jitter(self, mock_uniform):
+        instance = RetryPolicy(base=10, cap=100)
+        self.assertEqual(instance.backoff(3), 33)
+        mock_uniform.assert_called_once_with(20, 40)
+
+    def test_handle_failure_backoff(self):
+        instance = RetryPolicy(base=10, jitter=False)
+        mock_message = Mock(attributes={"ApproximateReceiveCount": "2"})
+        instance.handle_failure(mock_message)
+        mock_message.change_visibility.assert_called_once_with(VisibilityTimeout=20)
+        mock_message.delete.assert_not_called()
+
+    def test_handle_failure_dead_letter(self):
+        mock_dlq = Mock()
+        instance = RetryPolicy(
+            base=10, jitter=False, max_receives=3, dead_letter_queue=mock_dlq
+        )
+
+        mock_message = Mock(attributes={"ApproximateReceiveCount": "2"})
+        instance.handle_failure(mock_message)
+        mock_dlq.send_message.assert_not_called()
+
+        mock_message = Mock(
+            body="the body",
+            attributes={"ApproximateReceiveCount": "3"},
+            message_attributes={"service_name": {"StringValue": "foo"}},
+        )
+        instance.handle_failure(mock_message)
+        mock_dlq.send_message.assert_called_once_with(
+            MessageBody="the body",
+            MessageAttributes={"service_name": {"StringValue": "foo"}},
+        )
+        mock_message.delete.assert_called_once_with()
+        mock_message.change_visibility.assert_not_called()
+
+    def test_handle_failure_error_attributes(self):
+        mock_dlq = Mock()
+        instance = RetryPolicy(max_receives=1, dead_letter_queue=mock_dlq)
+        mock_message = Mock(
+            body="the body",
+            attributes={},
+            message_attributes={"service_name": {"StringValue": "foo"}},
+        )
+        instance.handle_failure(mock_message, KeyError("x" * 2000))
+
+        attributes = mock_dlq.send_message.call_args[1]["MessageAttributes"]
+        self.assertEqual({"StringValue": "foo"}, attributes["service_name"])
+        self.assertEqual(
+            {"StringValue": "KeyError", "DataType": "String"}, attributes[ERROR_TYPE]
+        )
+        self.assertEqual(1024, len(attributes[ERROR_MESSAGE]["StringValue"]))
+
+        self.assertEqual({}, error_attributes(None))
+        self.assertNotIn(ERROR_MESSAGE, error_attributes(ValueError()))
@@ -0,0 +1,118 @@
+import unittest
+
+from sqstaskmaster.scaling import AllOrNothingPolicy, ProportionalPolicy
+
+
+class TestAllOrNothingPolicy(unittest.TestCase):
+    def test_desired_count(self):
+        policy = AllOrNothingPolicy()
+        self.assertEqual(policy.desired_count("key", 5, None, 8, 0), 8)
+        self.assertEqual(policy.desired_count("key", 0, 8, 8, 0), 0)
+
+
+class TestProportionalPolicy(unittest.TestCase):
+    def test___init__(self):
+        with self.assertRaisesRegex(
+            ValueError, "Throughput 0 must be greater than zero"
+        ):
+            ProportionalPolicy(throughput=0, target_drain_time=10)
+        with self.assertRaisesRegex(
+            ValueError, "Target drain time 0 must be greater than zero"
+        ):
+            ProportionalPolicy(throughput=1, target_drain_time=0)
+        with self.assertRaisesRegex(ValueError, "Invalid size bounds min 5 max 2"):
+            ProportionalPolicy(
+                throughput=1, target_drain_time=10, min_size=5, max_size=2
+            )
+        with self.assertRaisesRegex(ValueError, r"Smoothing 0 must be in \(0, 1\]"):
+            ProportionalPolicy(throughput=1, target_drain_time=10, smoothing=0)
+        with self.assertRaisesRegex(ValueError, "Min completions 0"):
+            ProportionalPolicy(throughput=1, target_drain_time=10, min_completions=0)
+
+    def test_target(self):
+        policy = ProportionalPolicy(throughput=0.1, target_drain_time=100, max_size=50)
+        # Each worker drains 10 messages in the target time
+        self.assertEqual(policy.target("key", 0, 8), 0)
+        self.assertEqual(policy.target("key", 1, 8), 1)
+        self.assertEqual(policy.target("key", 35, 8), 4)
+        # Bursts past the active size up to max size
+        self.assertEqual(policy.target("key", 10000, 8), 50)
+
+        # Max size defaults to the active size
+        policy = ProportionalPolicy(throughput=0.1, target_drain_time=100, min_size=2)
+        self.assertEqual(policy.target("key", 10000, 8), 8)
+        self.assertEqual(policy.target("key", 1, 8), 2)
+        self.assertEqual(policy.target("key", 0, 8), 2)
+
+    def test_desired_count_unknown_current(self):
+        policy = ProportionalPolicy(throughput=0.1, target_drain_time=100)
+        self.assertEqual(policy.desired_count("key", 35, None, 8, 1000), 4)
+
+    def test_hysteresis(self):
+        policy = ProportionalPolicy(
+            throughput=0.1,
+            target_drain_time=100,
+            max_size=100,
+            scale_up_cooldown=0,
+            scale_down_cooldown=0,
+            hysteresis=0.1,
+        )
+        self.assertEqual(policy.desired_count("key", 200, 20, 8, 1000), 20)
+        # 21 is within 10% of 20
+        self.assertEqual(policy.desired_count("key", 210, 20, 8, 1001), 20)
+        self.assertEqual(policy.desired_count("key", 250, 20, 8, 1002), 25)
+        # Scaling to zero ignores the hysteresis band
+        self.assertEqual(policy.desired_count("key", 0, 1, 8, 1003), 0)
+
+    def test_cooldowns(self):
+        policy = ProportionalPolicy(
+            throughput=0.1,
+            target_drain_time=100,
+            max_size=100,
+            scale_up_cooldown=60,
+            scale_down_cooldown=300,
+            hysteresis=0,
+        )
+        self.assertEqual(policy.desired_count("key", 100, 0, 8, 1000), 10)
+        # Within the scale up cooldown
+        self.assertEqual(policy.desired_count("key", 200, 10, 8, 1030), 10)
+        self.assertEqual(policy.desired_count("key", 200, 10, 8, 1061), 20)
+        # Within the scale down cooldown
+        self.assertEqual(policy.desired_count("key", 0, 20, 8, 1200), 20)
+        self.assertEqual(policy.desired_count("key", 0, 20, 8, 1362), 0)
+        # State is kept per key
+        self.assertEqual(policy.desired_count("other", 100, 0, 8, 1362), 10)
+
+    def test_measured_throughput(self):
+        policy = ProportionalPolicy(
+            throughput=0.1,
+            target_drain_time=100,
+            max_size=100,
+            scale_up_cooldown=0,
+            scale_down_cooldown=0,
+            hysteresis=0,
+            smoothing=0.5,
+        )
+        self.assertEqual(policy.desired_count("key", 1000, None, 8, 1000), 100)
+        # 100 workers drained 900 messages in 10 seconds: 0.9 per worker per second
+        policy.desired_count("key", 100, 100, 8, 1010)
+        self.assertAlmostEqual(policy.throughput_for("key"), 0.5)
+        # No drain observed when the backlog grows
+        policy.desired_count("key", 200, 2, 8, 1020)
+        self.assertAlmostEqual(policy.throughput_for("key"), 0.5)
+        self.assertEqual(policy.throughput_for("unknown"), 0.1)
+
+    def test_measured_throughput_slow_tasks(self):
+        policy = ProportionalPolicy(
+            throughput=0.1,
+            target_drain_time=600,
+            max_size=1,
+            scale_up_cooldown=0,
+            scale_down_cooldown=0,
+            hysteresis=0,
+        )
+        # One worker finishes a 300 second task while the queue is polled every 10 seconds
+        count = None
+        for now in range(0, 30000, 10):
+            count = policy.desired_count("key", 1000 - now // 300, count, 1, now)
+        self.assertAlmostEqual(1 / 300, policy.throughput_for("key"), delta=0.0002)
@@ -0,0 +1,84 @@
+import signal
+import unittest
+from unittest.mock import patch, Mock
+
+from botocore.exceptions import ClientError
+
+from sqstaskmaster.shutdown import ShutdownCoordinator
+
+
+class TestShutdownCoordinator(unittest.TestCase):
+    def test___init__(self):
+        instance = ShutdownCoordinator()
+        self.assertEqual(instance.grace_period, 20)
+        self.assertEqual(instance.signals, (signal.SIGTERM,))
+        self.assertFalse(instance.requested)
+        self.assertIsNone(instance.time_remaining())
+        self.assertFalse(instance.expired())
+
+        with self.assertRaisesRegex(
+            ValueError, "Grace period -1 must be greater than or equal to zero"
+        ):
+            ShutdownCoordinator(grace_period=-1)
+
+    @patch("signal.signal")
+    def test_install(self, mock_signal):
+        instance = ShutdownCoordinator(signals=(signal.SIGTERM, signal.SIGINT))
+        self.assertIs(instance, instance.install())
+        mock_signal.assert_any_call(signal.SIGTERM, instance._handle_signal)
+        mock_signal.assert_any_call(signal.SIGINT, instance._handle_signal)
+
+    @patch("signal.alarm", return_value=0)
+    def test_request_without_pending_alarm(self, mock_alarm):
+        instance = ShutdownCoordinator(grace_period=5)
+        instance._handle_signal(signal.SIGTERM, Mock())
+
+        self.assertTrue(instance.requested)
+        self.assertFalse(instance.expired())
+        self.assertAlmostEqual(instance.time_remaining(), 5, places=1)
+        mock_alarm.assert_called_once_with(0)
+
+    @patch("signal.alarm", return_value=25)
+    def test_request_shortens_pending_alarm(self, mock_alarm):
+        instance = ShutdownCoordinator(grace_period=5)
+        instance.request()
+        mock_alarm.assert_called_with(5)
+
+        # Only the first request starts the grace period
+        mock_alarm.reset_mock()
+        instance.request()
+        mock_alarm.assert_not_called()
+
+    @patch("signal.alarm", return_value=2)
+    def test_request_keeps_earlier_alarm(self, mock_alarm):
+        ShutdownCoordinator(grace_period=5).request()
+        mock_alarm.assert_called_with(2)
+
+    @patch("time.time")
+    @patch("signal.alarm", return_value=0)
+    def test_expired(self, mock_alarm, mock_time):
+        instance = ShutdownCoordinator(grace_period=5)
+        mock_time.return_value = 100.0
+        instance.request()
+
+        mock_time.return_value = 104.0
+        self.assertEqual(instance.time_remaining(), 1.0)
+        self.assertFalse(instance.expired())
+
+        mock_time.return_value = 106.0
+        self.assertEqual(instance.time_remaining(), 0.0)
+        self.assertTrue(instance.expired())
+
+    def test_release(self):
+        mock_message = Mock()
+        ShutdownCoordinator().release(mock_message)
+        mock_message.change_visibility.assert_called_once_with(VisibilityTimeout=0)
+
+    @patch("sqstaskmaster.shutdown.logger")
+    def test_release_fails(self, mock_logger):
+        mock_message = Mock()
+        mock_message.change_visibility.side_effect = ClientError({}, "operation")
+        ShutdownCoordinator().release(mock_message)
+        mock_logger.exception.assert_called_once_with(
+            "Failed to release message %s", mock_message
+        )
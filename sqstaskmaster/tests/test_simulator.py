@@ -0,0 +1,122 @@
+import time
+import unittest
+
+from sqstaskmaster.forecast import DepthHistory
+from sqstaskmaster.scaling import AllOrNothingPolicy, ProportionalPolicy
+from sqstaskmaster.simulator import (
+    Simulator,
+    arrivals_from_history,
+    percentile,
+    poisson_arrivals,
+)
+
+
+class TestSimulator(unittest.TestCase):
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "Interval 0 must be greater than zero"):
+            Simulator(active_size=1, interval=0)
+
+    def test_empty(self):
+        result = Simulator(active_size=1).run(AllOrNothingPolicy(), [])
+        self.assertEqual(0, result.worker_hours)
+        self.assertEqual(0, result.completed)
+
+    def test_all_or_nothing(self):
+        simulator = Simulator(
+            active_size=2, startup_delay=60, duration=100, interval=10
+        )
+        result = simulator.run(AllOrNothingPolicy(), [(0, 4)])
+
+        # Two workers start at 60 and each run two tasks of 100 seconds
+        self.assertEqual(4, result.completed)
+        self.assertEqual(0, result.remaining)
+        self.assertEqual(260, result.drain_time)
+        self.assertEqual(4, result.max_backlog)
+        self.assertEqual({50: 60, 90: 160, 99: 160}, result.wait_percentiles)
+        self.assertEqual(2, result.scale_events)
+        # Both workers are stopped at the tick after the queue drains
+        self.assertAlmostEqual(2 * 260 / 3600, result.worker_hours)
+
+    def test_scale_in_drains_busy_workers(self):
+        simulator = Simulator(active_size=4, startup_delay=0, duration=35, interval=10)
+        policy = ProportionalPolicy(
+            throughput=0.1,
+            target_drain_time=10,
+            scale_up_cooldown=0,
+            scale_down_cooldown=0,
+            hysteresis=0,
+            smoothing=1,
+        )
+        result = simulator.run(policy, [(0, 4)])
+        self.assertEqual(4, result.completed)
+        self.assertEqual(0, result.remaining)
+
+    def test_timeout(self):
+        simulator = Simulator(active_size=1, duration=10, timeout=100)
+        policy = ProportionalPolicy(throughput=1, target_drain_time=10, min_size=1)
+        result = simulator.run(policy, [(0, 1)])
+        self.assertEqual(1, result.completed)
+        # min_size keeps a worker until the timeout
+        self.assertAlmostEqual(100 / 3600, result.worker_hours)
+
+    def test_not_drained(self):
+        simulator = Simulator(active_size=1, startup_delay=0, duration=100, timeout=50)
+        result = simulator.run(AllOrNothingPolicy(), [(0, 3)])
+        self.assertIsNone(result.drain_time)
+        self.assertEqual(3, result.remaining)
+
+    def test_compare(self):
+        simulator = Simulator(
+            active_size=50,
+            startup_delay=90,
+            duration=lambda rng: rng.uniform(30, 90),
+            seed=1,
+        )
+        arrivals = poisson_arrivals(2, 3600, seed=1)
+        results = simulator.compare(
+            {
+                "all": AllOrNothingPolicy,
+                "proportional": lambda: ProportionalPolicy(0.016, 600),
+            },
+            arrivals,
+        )
+        total = sum(count for _, count in arrivals)
+        for result in results.values():
+            self.assertEqual(total, result.completed)
+        self.assertLess(
+            results["proportional"].worker_hours, results["all"].worker_hours
+        )
+
+    def test_speed(self):
+        simulator = Simulator(active_size=10, duration=30, seed=1)
+        arrivals = poisson_arrivals(0.5, 24 * 3600, interval=60, seed=1)
+        start = time.perf_counter()
+        for _ in range(10):
+            simulator.run(AllOrNothingPolicy(), arrivals)
+        self.assertLess(time.perf_counter() - start, 10)
+
+
+class TestTraces(unittest.TestCase):
+    def test_poisson_arrivals(self):
+        arrivals = poisson_arrivals(10, 100, start=1000, interval=10, seed=3)
+        self.assertEqual(
+            arrivals, poisson_arrivals(10, 100, start=1000, interval=10, seed=3)
+        )
+        self.assertTrue(all(1000 <= t < 1100 and t % 10 == 0 for t, _ in arrivals))
+        self.assertAlmostEqual(1000, sum(count for _, count in arrivals), delta=150)
+
+    def test_arrivals_from_history(self):
+        history = DepthHistory(min_interval=60)
+        history.append(0, 5)
+        history.append(60, 65)
+        history.append(120, 10)
+        history.append(180, 40)
+        self.assertEqual([(0, 5), (60, 60), (180, 30)], arrivals_from_history(history))
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(100, percentile(values, 100))
+        self.assertEqual(1, percentile(values, 0))
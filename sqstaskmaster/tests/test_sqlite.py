@@ -0,0 +1,32 @@
+import os
+import tempfile
+import unittest
+
+from sqstaskmaster.sqlite import transaction
+
+
+class TestTransaction(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.db")
+        with transaction(self.path) as connection:
+            connection.execute("CREATE TABLE entries (key TEXT PRIMARY KEY)")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_commit(self):
+        with transaction(self.path) as connection:
+            connection.execute("INSERT INTO entries VALUES ('a')")
+        with transaction(self.path, immediate=False) as connection:
+            rows = connection.execute("SELECT key FROM entries").fetchall()
+        self.assertEqual([("a",)], rows)
+
+    def test_rollback(self):
+        with self.assertRaises(KeyError):
+            with transaction(self.path) as connection:
+                connection.execute("INSERT INTO entries VALUES ('a')")
+                raise KeyError("a")
+        with transaction(self.path) as connection:
+            rows = connection.execute("SELECT key FROM entries").fetchall()
+        self.assertEqual([], rows)
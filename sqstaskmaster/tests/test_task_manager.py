@@ -1,11 +1,19 @@
+import json
 import unittest
-from datetime import date
+from datetime import date, datetime, timezone
+from itertools import islice
 from json import JSONDecodeError
 
-from unittest.mock import patch, Mock
+from unittest.mock import ANY, patch, Mock
 from callee import InstanceOf
 
+from sqstaskmaster.fifo import content_deduplication_id
+from sqstaskmaster.dedupe import Deduplicator, LeasedMessage, MemoryDedupeStore
 from sqstaskmaster.local import LocalQueue
+from sqstaskmaster.logs import Preview
+from sqstaskmaster.metrics import DEPTH_ATTRIBUTES
+from sqstaskmaster.rate_limit import RateLimiter
+from sqstaskmaster.result_cache import MemoryResultStore, ResultCache
 from sqstaskmaster.task_manager import TaskManager
 
 
@@ -41,6 +49,150 @@ class TestBatchJobQueue(unittest.TestCase):
         )
         mock_resource.return_value.Queue.return_value.load.assert_called_once_with()
 
+    def test_attributes_names(self, mock_resource):
+        client = mock_resource.return_value.meta.client
+        client.get_queue_attributes.return_value = {
+            "Attributes": {"ApproximateNumberOfMessages": "4"}
+        }
+        instance = TaskManager(self.SQS_URL)
+        self.assertEqual(
+            {"ApproximateNumberOfMessages": "4"},
+            instance.attributes(["ApproximateNumberOfMessages"]),
+        )
+        client.get_queue_attributes.assert_called_once_with(
+            QueueUrl=self.SQS_URL, AttributeNames=["ApproximateNumberOfMessages"]
+        )
+        mock_resource.return_value.Queue.return_value.load.assert_not_called()
+
+    def test_depth(self, mock_resource):
+        metrics_cache = Mock()
+        metrics_cache.get.return_value = {
+            "ApproximateNumberOfMessages": "4",
+            "ApproximateNumberOfMessagesNotVisible": "2",
+            "ApproximateNumberOfMessagesDelayed": "1",
+        }
+        instance = TaskManager(self.SQS_URL, metrics_cache=metrics_cache)
+        self.assertIs(metrics_cache, instance.metrics_cache)
+        self.assertEqual(7, instance.depth(max_age=30))
+        metrics_cache.get.assert_called_once_with(
+            self.SQS_URL, DEPTH_ATTRIBUTES, max_age=30
+        )
+
+    def test_depth_local(self, mock_resource):
+        instance = TaskManager(self.SQS_URL, queue_constructor=LocalQueue)
+        instance.purge()
+        instance.submit("task")
+        self.assertEqual(1, instance.depth())
+        instance.purge()
+
+    def test_submit_fifo(self, mock_resource):
+        send_message = mock_resource.return_value.Queue.return_value.send_message
+        url = self.SQS_URL + ".fifo"
+
+        instance = TaskManager(url, group_id="store")
+        instance.submit("task", store=7)
+        self.assertEqual("7", send_message.call_args[1]["MessageGroupId"])
+        self.assertNotIn("MessageDeduplicationId", send_message.call_args[1])
+
+        instance = TaskManager(
+            url,
+            group_id=lambda task, kwargs: task,
+            deduplication_id=content_deduplication_id,
+        )
+        instance.submit("task", store=7)
+        body = send_message.call_args[1]["MessageBody"]
+        self.assertEqual("task", send_message.call_args[1]["MessageGroupId"])
+        self.assertEqual(
+            content_deduplication_id("task", {"store": 7}, body),
+            send_message.call_args[1]["MessageDeduplicationId"],
+        )
+
+        with self.assertRaisesRegex(ValueError, "requires a group_id"):
+            TaskManager(url).submit("task")
+
+        with self.assertRaisesRegex(
+            ValueError, "Group and deduplication ids require a FIFO queue"
+        ):
+            TaskManager(self.SQS_URL, group_id="store")
+
+        with self.assertRaisesRegex(RuntimeError, "Coalescing is not supported"):
+            with TaskManager(url, group_id="store").coalesce():
+                pass
+
+    def test_map_fifo(self, mock_resource):
+        mock_queue = mock_resource.return_value.Queue.return_value
+        mock_queue.send_messages.return_value = {
+            "Successful": [],
+            "Failed": [{"Id": "1"}],
+        }
+        instance = TaskManager(
+            self.SQS_URL + ".fifo", group_id=lambda task, kwargs: kwargs["shard"]
+        )
+        instance.map("task", range(4), chunk_size=2)
+
+        entries = mock_queue.send_messages.call_args[1]["Entries"]
+        self.assertEqual(["0", "1"], [entry["MessageGroupId"] for entry in entries])
+        # The failed entry is resent with its group
+        self.assertEqual("1", mock_queue.send_message.call_args[1]["MessageGroupId"])
+
+    def test_task_generator_max_messages(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        with self.assertRaisesRegex(ValueError, "Invalid max messages 11"):
+            next(instance.task_generator(max_messages=11))
+
+        messages = []
+        for i in range(3):
+            message = Mock()
+            message.body = json.dumps({"task": "task", "kwargs": {"i": i}})
+            messages.append(message)
+        mock_queue = mock_resource.return_value.Queue.return_value
+        mock_queue.receive_messages.return_value = messages
+
+        generator = instance.task_generator(sqs_timeout=30, max_messages=3)
+        self.assertEqual([0, 1, 2], [next(generator)[1]["i"] for _ in range(3)])
+        mock_queue.receive_messages.assert_called_once_with(
+            AttributeNames=["All"],
+            MessageAttributeNames=["All"],
+            MaxNumberOfMessages=3,
+            WaitTimeSeconds=20,
+            VisibilityTimeout=30,
+        )
+        messages[0].change_visibility.assert_not_called()
+        messages[1].change_visibility.assert_called_once_with(VisibilityTimeout=30)
+        messages[2].change_visibility.assert_called_once_with(VisibilityTimeout=30)
+
+    def test_task_generator_fifo_groups(self, mock_resource):
+        messages = []
+        for group, i in [("a", 0), ("a", 1), ("a", 2), ("b", 3), ("b", 4)]:
+            message = Mock()
+            message.body = json.dumps({"task": "task", "kwargs": {"i": i}})
+            message.attributes = {"MessageGroupId": group}
+            messages.append(message)
+        mock_queue = mock_resource.return_value.Queue.return_value
+        # Stop the generator on the second receive
+        mock_queue.receive_messages.side_effect = [messages, InterruptedError()]
+
+        generator = TaskManager(self.SQS_URL + ".fifo", group_id="g").task_generator(
+            sqs_timeout=30, max_messages=5
+        )
+
+        task, kwargs, message = next(generator)
+        self.assertEqual(0, kwargs["i"])
+        # Group a fails
+        task, kwargs, message = next(generator)
+        self.assertEqual(3, kwargs["i"])
+        message.delete()
+        task, kwargs, message = next(generator)
+        self.assertEqual(4, kwargs["i"])
+        message.delete()
+
+        # The rest of group a is released for an in order retry
+        with self.assertRaises(InterruptedError):
+            next(generator)
+        messages[1].change_visibility.assert_called_once_with(VisibilityTimeout=0)
+        messages[2].change_visibility.assert_called_once_with(VisibilityTimeout=0)
+        messages[4].change_visibility.assert_called_once_with(VisibilityTimeout=30)
+
     def test_purge(self, mock_resource):
         self.assertIsNone(TaskManager(self.SQS_URL).purge())
         mock_resource.return_value.Queue.return_value.purge.assert_called_once_with()
@@ -61,6 +213,414 @@ class TestBatchJobQueue(unittest.TestCase):
             },
         )
 
+    @patch("sqstaskmaster.task_manager.time.time", return_value=1000.0)
+    def test_submit_after(self, mock_time, mock_resource):
+        send_message = mock_resource.return_value.Queue.return_value.send_message
+        instance = TaskManager(self.SQS_URL)
+
+        instance.submit_after(90.5, "task_name", foo="bar")
+        self.assertEqual(91, send_message.call_args[1]["DelaySeconds"])
+        self.assertEqual(
+            {"task": "task_name", "kwargs": {"foo": "bar"}},
+            json.loads(send_message.call_args[1]["MessageBody"]),
+        )
+
+        instance.submit_after(3600, "task_name", foo="bar")
+        self.assertEqual(900, send_message.call_args[1]["DelaySeconds"])
+        self.assertEqual(
+            {"task": "task_name", "kwargs": {"foo": "bar"}, "not_before": 4600.0},
+            json.loads(send_message.call_args[1]["MessageBody"]),
+        )
+
+        instance.submit_at(datetime.fromtimestamp(1600, timezone.utc), "task_name")
+        self.assertEqual(600, send_message.call_args[1]["DelaySeconds"])
+
+        instance.submit_at(10, "task_name")
+        self.assertEqual(0, send_message.call_args[1]["DelaySeconds"])
+
+        with self.assertRaisesRegex(ValueError, "Invalid delay -1 seconds"):
+            instance.submit_after(-1, "task_name")
+
+        with self.assertRaisesRegex(ValueError, "Per message delays are not supported"):
+            TaskManager(self.SQS_URL + ".fifo", group_id="foo").submit_after(
+                10, "task_name", foo="bar"
+            )
+
+    @patch("sqstaskmaster.task_manager.time.time", return_value=1000.0)
+    def test_task_generator_delayed(self, mock_time, mock_resource):
+        mock_queue = mock_resource.return_value.Queue.return_value
+        early = Mock(
+            body=json.dumps({"task": "early", "kwargs": {}, "not_before": 2000.5}),
+            message_attributes={"service_name": {}},
+            attributes={},
+        )
+        due = Mock(
+            body=json.dumps({"task": "due", "kwargs": {"a": 1}, "not_before": 900}),
+            attributes={},
+        )
+        mock_queue.receive_messages.side_effect = [[early, due], InterruptedError()]
+
+        generator = TaskManager(self.SQS_URL).task_generator(max_messages=2)
+        self.assertEqual(("due", {"a": 1}, due), next(generator))
+
+        mock_queue.send_message.assert_called_once_with(
+            MessageBody=early.body,
+            MessageAttributes={"service_name": {}},
+            DelaySeconds=900,
+        )
+        early.delete.assert_called_once_with()
+        due.delete.assert_not_called()
+
+    @patch("sqstaskmaster.task_manager.time.time", return_value=1000.0)
+    def test_task_generator_delayed_attributes(self, mock_time, mock_resource):
+        mock_queue = mock_resource.return_value.Queue.return_value
+        early = Mock(
+            body=json.dumps({"task": "early", "kwargs": {}, "not_before": 2000.5}),
+            message_attributes=None,
+            attributes={},
+        )
+        mock_queue.receive_messages.side_effect = [[early], InterruptedError()]
+
+        with self.assertRaises(InterruptedError):
+            next(TaskManager(self.SQS_URL, sender_name="Foo").task_generator())
+
+        self.assertEqual(
+            {"service_name": {"StringValue": "Foo", "DataType": "String"}},
+            mock_queue.send_message.call_args[1]["MessageAttributes"],
+        )
+
+    def test_task_generator_rate_limiter(self, mock_resource):
+        mock_queue = mock_resource.return_value.Queue.return_value
+        messages = [
+            Mock(
+                body=json.dumps({"task": task, "kwargs": {}}),
+                attributes={},
+                message_attributes=None,
+            )
+            for task in ("limited", "limited", "other")
+        ]
+        envelope = Mock(
+            body=json.dumps({"tasks": [{"task": "limited", "kwargs": {"a": 1}}]}),
+            attributes={},
+        )
+        mock_queue.receive_messages.side_effect = [
+            messages,
+            [envelope],
+            InterruptedError(),
+        ]
+        limiter = RateLimiter({"limited": 0.01}, max_defer=10, jitter=0)
+
+        generator = TaskManager(self.SQS_URL).task_generator(
+            max_messages=3, rate_limiter=limiter
+        )
+        self.assertEqual(("limited", {}, messages[0]), next(generator))
+        self.assertEqual(("other", {}, messages[2]), next(generator))
+        # Only the sqs timeout of the batch; throttling re-enqueues rather than deferring the visibility
+        messages[1].change_visibility.assert_called_once_with(VisibilityTimeout=20)
+        mock_queue.send_message.assert_called_once_with(
+            MessageBody=messages[1].body,
+            MessageAttributes=InstanceOf(dict),
+            DelaySeconds=10,
+        )
+        messages[1].delete.assert_called_once_with()
+
+        # Throttled tasks from an envelope are re-enqueued with the delay
+        with self.assertRaises(InterruptedError):
+            next(generator)
+        self.assertIn('"a": 1', mock_queue.send_message.call_args[1]["MessageBody"])
+        self.assertEqual(10, mock_queue.send_message.call_args[1]["DelaySeconds"])
+        envelope.delete.assert_called_once_with()
+
+    def test_task_generator_rate_limiter_fifo(self, mock_resource):
+        mock_queue = mock_resource.return_value.Queue.return_value
+        messages = [
+            Mock(
+                body=json.dumps({"task": "limited", "kwargs": {}}),
+                attributes={"MessageGroupId": group},
+            )
+            for group in ("a", "b")
+        ]
+        mock_queue.receive_messages.side_effect = [messages, InterruptedError()]
+        limiter = RateLimiter({"limited": 0.01}, max_defer=10, jitter=0)
+
+        generator = TaskManager(self.SQS_URL + ".fifo", group_id="g").task_generator(
+            max_messages=2, rate_limiter=limiter
+        )
+        self.assertEqual(("limited", {}), next(generator)[:2])
+        with self.assertRaises(InterruptedError):
+            next(generator)
+        # No per message delay on a FIFO queue
+        messages[1].change_visibility.assert_called_with(VisibilityTimeout=10)
+        mock_queue.send_message.assert_not_called()
+
+    def test_result_cache(self, mock_resource):
+        mock_queue = mock_resource.return_value.Queue.return_value
+        cache = ResultCache(MemoryResultStore())
+        cache.put("cached", {"a": 1}, "result")
+        instance = TaskManager(self.SQS_URL, result_cache=cache)
+
+        self.assertIsNone(instance.submit("cached", a=1))
+        mock_queue.send_message.assert_not_called()
+        instance.submit("cached", a=2)
+        mock_queue.send_message.assert_called_once()
+
+        messages = [
+            Mock(body=json.dumps({"task": "cached", "kwargs": kwargs}), attributes={})
+            for kwargs in ({"a": 1}, {"a": 2})
+        ]
+        mock_queue.receive_messages.side_effect = [messages, InterruptedError()]
+        generator = instance.task_generator(max_messages=2)
+        self.assertEqual(("cached", {"a": 2}, messages[1]), next(generator))
+        messages[0].delete.assert_called_once_with()
+        messages[1].delete.assert_not_called()
+
+    def test_notify_lazy_context(self, mock_resource):
+        context = Mock(return_value={"body": "body"})
+        TaskManager(self.SQS_URL).notify(ValueError(), context=context)
+        context.assert_not_called()
+
+        mock_notify = Mock()
+        error = ValueError()
+        TaskManager(self.SQS_URL, notify=mock_notify).notify(error, context=context)
+        mock_notify.assert_called_once_with(error, context={"body": "body"})
+
+    def test_coalesce(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        send_message = mock_resource.return_value.Queue.return_value.send_message
+
+        with instance.coalesce() as tm:
+            self.assertIs(tm, instance)
+            self.assertIsNone(instance.submit("task_name", foo="bar"))
+            self.assertIsNone(instance.submit("task_name", foo="baz"))
+            send_message.assert_not_called()
+
+            with self.assertRaisesRegex(
+                RuntimeError, "TaskManager is already coalescing tasks"
+            ):
+                with instance.coalesce():
+                    pass
+
+        send_message.assert_called_once_with(
+            MessageBody='{"tasks": [{"task": "task_name", "kwargs": {"foo": "bar"}}, '
+            '{"task": "task_name", "kwargs": {"foo": "baz"}}]}',
+            MessageAttributes={
+                "service_name": {
+                    "StringValue": "Unknown sender to: https://sqs.us-east-1.amazonaws.com/{account_id}/queue_name",
+                    "DataType": "String",
+                }
+            },
+        )
+
+        # Not coalescing after the block
+        instance.submit("task_name", foo="bar")
+        send_message.assert_called_with(
+            MessageBody='{"task": "task_name", "kwargs": {"foo": "bar"}}',
+            MessageAttributes=InstanceOf(dict),
+        )
+
+    def test_coalesce_max_size(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        send_message = mock_resource.return_value.Queue.return_value.send_message
+
+        with instance.coalesce(max_size=110):
+            for value in range(10):
+                instance.submit("task_name", value=value)
+
+        self.assertEqual(send_message.call_count, 5)
+        for sent in send_message.call_args_list:
+            self.assertLessEqual(len(sent[1]["MessageBody"]), 110)
+
+    def test_coalesce_error(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        send_message = mock_resource.return_value.Queue.return_value.send_message
+
+        with self.assertRaises(KeyError):
+            with instance.coalesce():
+                instance.submit("task_name", foo="bar")
+                raise KeyError("foo")
+
+        send_message.assert_called_once_with(
+            MessageBody='{"tasks": [{"task": "task_name", "kwargs": {"foo": "bar"}}]}',
+            MessageAttributes=InstanceOf(dict),
+        )
+        self.assertIsNone(instance._coalescer)
+
+    def test_task_generator_dedupe(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        dedupe = Deduplicator(MemoryDedupeStore())
+
+        bodies = [
+            '{"task": "task_name", "kwargs": {"foo": "bar"}}',
+            '{"task": "task_name", "kwargs": {"foo": "bar"}}',
+            '{"task": "task_name", "kwargs": {"foo": "baz"}}',
+            '{"task": "task_name", "kwargs": {"foo": "bar"}}',
+            '{"task": "task_name", "kwargs": {"foo": "qux"}}',
+        ]
+        messages = [Mock(body=body) for body in bodies]
+        mock_resource.return_value.Queue.return_value.receive_messages.side_effect = [
+            [message] for message in messages
+        ]
+
+        gen = instance.task_generator(wait_time=15, sqs_timeout=10, dedupe=dedupe)
+        _, kwargs, first = next(gen)
+        self.assertIsInstance(first, LeasedMessage)
+        self.assertEqual(first.body, messages[0].body)
+
+        # The duplicate in progress is skipped
+        _, kwargs, _ = next(gen)
+        self.assertEqual(kwargs, {"foo": "baz"})
+        messages[1].delete.assert_not_called()
+
+        # The duplicate of the completed task is acked without running
+        first.delete()
+        _, kwargs, _ = next(gen)
+        self.assertEqual(kwargs, {"foo": "qux"})
+        messages[3].delete.assert_called_once_with()
+
+    def test_task_generator_envelope(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        mock_queue = mock_resource.return_value.Queue.return_value
+
+        mock_message = Mock()
+        mock_message.attributes = {}
+        mock_message.body = (
+            '{"tasks": [{"task": "task_name", "kwargs": {"foo": "bar"}}, '
+            '{"task": "task_name", "kwargs": {"foo": "baz"}}, {"kwargs": {}}]}'
+        )
+        second_mock_message = Mock()
+        second_mock_message.body = '{"task": "other", "kwargs": {}}'
+        mock_queue.receive_messages.side_effect = [
+            [mock_message],
+            [second_mock_message],
+        ]
+
+        gen = instance.task_generator(wait_time=15, sqs_timeout=10)
+
+        task, kwargs, first = next(gen)
+        self.assertEqual((task, kwargs), ("task_name", {"foo": "bar"}))
+        first.delete()
+
+        task, kwargs, second = next(gen)
+        self.assertEqual((task, kwargs), ("task_name", {"foo": "baz"}))
+        # Not acked
+
+        mock_message.delete.assert_not_called()
+        with patch("sqstaskmaster.task_manager.logger"):
+            self.assertEqual(("other", {}, second_mock_message), next(gen))
+
+        # The failed task is re-enqueued and the envelope is acked, the malformed task is dropped
+        mock_queue.send_message.assert_called_once_with(
+            MessageBody='{"tasks": [{"task": "task_name", "kwargs": {"foo": "baz"}, "receives": 1}]}',
+            MessageAttributes=InstanceOf(dict),
+        )
+        mock_message.delete.assert_called_once_with()
+
+    def test_task_generator_envelope_malformed_task(self, mock_resource):
+        mock_notify = Mock()
+        instance = TaskManager(
+            "malformed", queue_constructor=LocalQueue, notify=mock_notify
+        )
+        instance.purge()
+        instance.queue.send_message(
+            MessageBody=json.dumps(
+                {"tasks": [{"task": "broken"}, {"task": "ok", "kwargs": {}}]}
+            )
+        )
+
+        with patch("sqstaskmaster.task_manager.logger"):
+            task, kwargs, message = next(instance.task_generator(wait_time=0))
+        self.assertEqual(("ok", {}), (task, kwargs))
+        mock_notify.assert_called_once_with(
+            InstanceOf(KeyError), context={"body": '{"task": "broken"}'}
+        )
+        instance.purge()
+
+    def test_map(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        mock_queue = mock_resource.return_value.Queue.return_value
+        mock_queue.send_messages.return_value = {"Successful": [], "Failed": []}
+        backend = Mock()
+
+        job = instance.map(
+            "train", range(25), chunk_size=2, backend=backend, job_id="j1", model="x"
+        )
+
+        self.assertEqual((job.job_id, job.total, job.backend), ("j1", 13, backend))
+        # 13 shards in batches of 10
+        self.assertEqual(mock_queue.send_messages.call_count, 2)
+        first, second = mock_queue.send_messages.call_args_list
+        self.assertEqual(len(first[1]["Entries"]), 10)
+        self.assertEqual(len(second[1]["Entries"]), 3)
+        self.assertDictEqual(
+            json.loads(second[1]["Entries"][2]["MessageBody"]),
+            {
+                "task": "train",
+                "kwargs": {"model": "x", "items": [24], "job_id": "j1", "shard": 12},
+            },
+        )
+        self.assertEqual(second[1]["Entries"][2]["Id"], "2")
+        mock_queue.send_message.assert_not_called()
+
+    def test_result_cache_submit_paths(self, mock_resource):
+        mock_queue = mock_resource.return_value.Queue.return_value
+        mock_queue.send_messages.return_value = {"Successful": [], "Failed": []}
+        cache = ResultCache(MemoryResultStore())
+        cache.put("cached", {"a": 1}, "result")
+        cache.put("train", {"items": [0], "job_id": "j1", "shard": 0}, "shard result")
+        instance = TaskManager(self.SQS_URL, result_cache=cache)
+
+        self.assertIsNone(instance.submit_after(0, "cached", a=1))
+        self.assertIsNone(instance.submit_after(3600, "cached", a=1))
+        self.assertIsNone(instance.submit_at(0, "cached", a=1))
+        mock_queue.send_message.assert_not_called()
+
+        backend = Mock()
+        job = instance.map("train", range(2), backend=backend, job_id="j1")
+        self.assertEqual(2, job.total)
+        entries = mock_queue.send_messages.call_args[1]["Entries"]
+        self.assertEqual(
+            [1], [json.loads(e["MessageBody"])["kwargs"]["shard"] for e in entries]
+        )
+        backend.report.assert_called_once_with(
+            {"items": [0], "job_id": "j1", "shard": 0}, "shard result"
+        )
+
+    def test_map_retries_failed_entries(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        mock_queue = mock_resource.return_value.Queue.return_value
+        mock_queue.send_messages.return_value = {
+            "Successful": [{"Id": "0"}],
+            "Failed": [{"Id": "1", "SenderFault": False, "Code": "InternalError"}],
+        }
+
+        job = instance.map("train", ["a", "b"], job_id="j1")
+        self.assertEqual(job.total, 2)
+        mock_queue.send_message.assert_called_once_with(
+            MessageBody='{"task": "train", "kwargs": {"items": ["b"], "job_id": "j1", "shard": 1}}',
+            MessageAttributes=InstanceOf(dict),
+        )
+
+    def test_map_invalid_arguments(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        with self.assertRaisesRegex(ValueError, "Invalid chunk size 0"):
+            instance.map("train", [1], chunk_size=0)
+        with self.assertRaisesRegex(ValueError, "The items kwarg is reserved by map"):
+            instance.map("train", [1], items=[2])
+
+    def test_map_local_integration(self, mock_resource):
+        LocalQueue.local_queues.clear()
+        instance = TaskManager(self.SQS_URL, queue_constructor=LocalQueue)
+        job = instance.map("train", range(5), chunk_size=2, backend=Mock())
+
+        self.assertEqual(job.total, 3)
+        shards = [
+            kwargs for _, kwargs, _ in islice(instance.task_generator(wait_time=0), 3)
+        ]
+        self.assertListEqual(
+            [kwargs["items"] for kwargs in shards], [[0, 1], [2, 3], [4]]
+        )
+        LocalQueue.local_queues.clear()
+
     def test_task_generator(self, mock_resource):
         instance = TaskManager(self.SQS_URL)
 
@@ -77,11 +637,48 @@ class TestBatchJobQueue(unittest.TestCase):
 
         mock_resource.return_value.Queue.return_value.receive_messages.assert_called_with(
             AttributeNames=["All"],
+            MessageAttributeNames=["All"],
             MaxNumberOfMessages=1,
             WaitTimeSeconds=15,
             VisibilityTimeout=10,
         )
 
+    def test_task_generator_shutdown(self, mock_resource):
+        instance = TaskManager(self.SQS_URL)
+        mock_shutdown = Mock()
+        mock_shutdown.requested = False
+
+        first_mock_message = Mock()
+        first_mock_message.body = '{"task": "task_name", "kwargs": {"foo": "bar"}}'
+        second_mock_message = Mock()
+        second_mock_message.body = '{"task": "task_name", "kwargs": {"foo": "baz"}}'
+
+        results = [[first_mock_message], [second_mock_message]]
+
+        def receive(**kwargs):
+            if len(results) == 1:
+                # Signal arrives during the long poll
+                mock_shutdown.requested = True
+            return results.pop(0)
+
+        mock_resource.return_value.Queue.return_value.receive_messages.side_effect = (
+            receive
+        )
+
+        gen = instance.task_generator(
+            wait_time=15, sqs_timeout=10, shutdown=mock_shutdown
+        )
+        self.assertEqual(("task_name", {"foo": "bar"}, first_mock_message), next(gen))
+
+        with self.assertRaises(StopIteration):
+            next(gen)
+
+        mock_shutdown.release.assert_called_once_with(second_mock_message)
+        self.assertEqual(
+            mock_resource.return_value.Queue.return_value.receive_messages.call_count,
+            2,
+        )
+
     @patch("sqstaskmaster.task_manager.logger")
     def test_task_generator_decode_error(self, mock_log, mock_resource):
         mock_notify = Mock()
@@ -109,12 +706,18 @@ class TestBatchJobQueue(unittest.TestCase):
         )
         mock_log.exception.assert_called_once_with(
             "failed to decode message %s with %s",
-            '{"task": "task_name", "kwargs": {"foo": "b',
+            InstanceOf(Preview),
             {},
+            extra=ANY,
+        )
+        self.assertEqual(
+            '{"task": "task_name", "kwargs": {"foo": "b',
+            str(mock_log.exception.call_args[0][1]),
         )
 
         mock_resource.return_value.Queue.return_value.receive_messages.assert_called_with(
             AttributeNames=["All"],
+            MessageAttributeNames=["All"],
             MaxNumberOfMessages=1,
             WaitTimeSeconds=15,
             VisibilityTimeout=10,
@@ -149,12 +752,18 @@ class TestBatchJobQueue(unittest.TestCase):
         mock_log.exception.assert_called_once_with(
             "failed to get required field %s from content %s with %s",
             InstanceOf(KeyError),
-            '{"wrong_key": "task_name", "kwargs": {"foo": "bar"}}',
+            InstanceOf(Preview),
             {},
+            extra=ANY,
+        )
+        self.assertEqual(
+            '{"wrong_key": "task_name", "kwargs": {"foo": "bar"}}',
+            str(mock_log.exception.call_args[0][2]),
         )
 
         mock_resource.return_value.Queue.return_value.receive_messages.assert_called_with(
             AttributeNames=["All"],
+            MessageAttributeNames=["All"],
             MaxNumberOfMessages=1,
             WaitTimeSeconds=15,
             VisibilityTimeout=10,
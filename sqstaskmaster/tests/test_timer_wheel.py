@@ -0,0 +1,123 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from sqstaskmaster.timer_wheel import LocalScheduler, TimerWheel
+
+
+class Clock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock(100.0)
+        self.wheel = TimerWheel(tick=1, slots=8, clock=self.clock)
+        self.fired = []
+
+    def schedule(self, delay, name):
+        return self.wheel.schedule(delay, self.fired.append, name)
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(ValueError, "Tick 0 must be greater than zero"):
+            TimerWheel(tick=0)
+        with self.assertRaisesRegex(ValueError, "Slots 0 must be greater than zero"):
+            TimerWheel(slots=0)
+
+    def test_advance(self):
+        self.schedule(3, "three")
+        self.schedule(0, "now")
+        self.schedule(1, "one")
+        self.assertEqual(3, len(self.wheel))
+
+        self.assertEqual(0, self.wheel.advance(100.5))
+        self.assertEqual(2, self.wheel.advance(101))
+        self.assertEqual(["now", "one"], self.fired)
+        self.assertEqual(1, self.wheel.advance(103))
+        self.assertEqual(["now", "one", "three"], self.fired)
+        self.assertEqual(0, len(self.wheel))
+
+    def test_beyond_rotation(self):
+        # More than one rotation of the 8 slots
+        self.schedule(20, "twenty")
+        self.schedule(4, "four")
+        self.clock.now = 110
+        self.assertEqual(1, self.wheel.advance())
+        self.assertEqual(["four"], self.fired)
+        self.assertEqual(0, self.wheel.advance(119))
+        self.assertEqual(["four"], self.fired)
+        self.assertEqual(1, self.wheel.advance(120))
+        self.assertEqual(["four", "twenty"], self.fired)
+
+    def test_jump(self):
+        for delay in (30, 5, 17, 2):
+            self.schedule(delay, delay)
+        self.assertEqual(4, self.wheel.advance(1000))
+        self.assertEqual([2, 5, 17, 30], self.fired)
+
+    def test_cancel(self):
+        timer = self.schedule(2, "cancelled")
+        self.schedule(2, "kept")
+        self.assertTrue(self.wheel.cancel(timer))
+        self.assertFalse(self.wheel.cancel(timer))
+        self.assertEqual(1, len(self.wheel))
+        self.wheel.advance(102)
+        self.assertEqual(["kept"], self.fired)
+        self.assertFalse(self.wheel.cancel(timer))
+
+    @patch("sqstaskmaster.timer_wheel.logger")
+    def test_callback_error(self, mock_logger):
+        self.wheel.schedule(1, Mock(side_effect=KeyError("boom")))
+        self.schedule(1, "after")
+        self.assertEqual(2, self.wheel.advance(101))
+        self.assertEqual(["after"], self.fired)
+        mock_logger.exception.assert_called_once()
+
+    def test_many_timers(self):
+        wheel = TimerWheel(tick=1, slots=64, clock=self.clock)
+        fired = []
+        timers = [wheel.schedule(i % 500, fired.append, i) for i in range(10000)]
+        for timer in timers[::2]:
+            wheel.cancel(timer)
+        self.assertEqual(5000, len(wheel))
+        wheel.advance(350)
+        self.assertEqual(2500, len(fired))
+        wheel.advance(600)
+        self.assertEqual(5000, len(fired))
+        self.assertEqual(0, len(wheel))
+
+
+class TestLocalScheduler(unittest.TestCase):
+    @patch("sqstaskmaster.timer_wheel.time.time", return_value=1000.0)
+    def test_submit(self, mock_time):
+        task_manager = Mock()
+        scheduler = LocalScheduler(task_manager, tick=1, slots=60)
+        scheduler.submit_after(5, "task", a=1)
+        timer = scheduler.submit_at(1010, "other")
+        scheduler.submit_at(1002, "cancelled")
+        self.assertTrue(scheduler.cancel(scheduler.submit_at(1002, "cancelled")))
+
+        scheduler.wheel.advance(1005)
+        task_manager.submit.assert_any_call("task", a=1)
+        task_manager.submit.assert_any_call("cancelled")
+        self.assertEqual(2, task_manager.submit.call_count)
+
+        self.assertTrue(scheduler.cancel(timer))
+        scheduler.wheel.advance(1100)
+        self.assertEqual(2, task_manager.submit.call_count)
+
+    def test_start_stop(self):
+        task_manager = Mock()
+        scheduler = LocalScheduler(task_manager, tick=0.01).start()
+        with self.assertRaisesRegex(RuntimeError, "already running"):
+            scheduler.start()
+        scheduler.submit_after(0, "task")
+        for _ in range(200):
+            if task_manager.submit.called:
+                break
+            scheduler._stop.wait(0.01)
+        scheduler.stop()
+        task_manager.submit.assert_called_once_with("task")
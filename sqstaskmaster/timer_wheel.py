@@ -0,0 +1,171 @@
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Fields of a timer
+_EXPIRY, _CALLBACK, _ARGS, _CANCELLED = range(4)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: timers are hashed by their expiry tick into a fixed ring of slots, so scheduling and
+    cancelling are O(1) and advancing the wheel only visits the slots of the elapsed ticks. Each timer is a small
+    list, so many thousands of pending timers are cheap. Timers further away than one rotation stay in their slot until
+    the rotation of their expiry.
+
+    Thread safe. Callbacks run on the thread calling advance, outside the lock.
+    """
+
+    def __init__(self, tick=1.0, slots=512, clock=time.monotonic):
+        """
+        :param tick: seconds per slot, the resolution of the timers
+        :param slots: number of slots in the ring
+        :param clock: the time source for delays and advance
+        """
+        if tick <= 0:
+            raise ValueError("Tick {} must be greater than zero".format(tick))
+
+        if slots < 1:
+            raise ValueError("Slots {} must be greater than zero".format(slots))
+
+        self.tick = tick
+        self.clock = clock
+        self._slots = [[] for _ in range(slots)]
+        self._current = self._tick_of(clock())
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _tick_of(self, when):
+        return math.floor(when / self.tick)
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call callback(*args) once delay seconds have passed
+        :return: the timer, which can be cancelled
+        """
+        with self._lock:
+            expiry = max(
+                self._current + 1, math.ceil((self.clock() + delay) / self.tick)
+            )
+            timer = [expiry, callback, args, False]
+            self._slots[expiry % len(self._slots)].append(timer)
+            self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """
+        :return: True if the timer was pending
+        """
+        with self._lock:
+            if timer[_CANCELLED] or timer[_EXPIRY] is None:
+                return False
+            # Removed from its slot lazily when the slot is next visited
+            timer[_CANCELLED] = True
+            self._count -= 1
+            return True
+
+    def advance(self, now=None):
+        """
+        Fire the timers that expired by now
+        :return: the number of callbacks called
+        """
+        with self._lock:
+            target = self._tick_of(self.clock() if now is None else now)
+            steps = min(target - self._current, len(self._slots))
+            due = []
+            for tick in range(self._current + 1, self._current + 1 + steps):
+                index = tick % len(self._slots)
+                slot = self._slots[index]
+                if not slot:
+                    continue
+                remaining = []
+                for timer in slot:
+                    if timer[_CANCELLED]:
+                        continue
+                    if timer[_EXPIRY] <= target:
+                        due.append(timer)
+                    else:
+                        remaining.append(timer)
+                self._slots[index] = remaining
+            self._current = max(self._current, target)
+
+            due.sort(key=lambda timer: timer[_EXPIRY])
+            for timer in due:
+                timer[_EXPIRY] = None
+            self._count -= len(due)
+
+        for timer in due:
+            try:
+                timer[_CALLBACK](*timer[_ARGS])
+            except Exception:
+                logger.exception("Timer callback %s failed", timer[_CALLBACK])
+        return len(due)
+
+
+class LocalScheduler:
+    """
+    In process scheduling of task submission with a TimerWheel. Pending tasks are lost if the process exits, so use
+    TaskManager.submit_after for tasks that must survive a restart.
+
+    scheduler = LocalScheduler(tm).start()
+    scheduler.submit_after(90 * 60, 'Recompute', merchant=merchant)
+    ...
+    scheduler.stop()
+    """
+
+    def __init__(self, task_manager, tick=1.0, slots=3600):
+        self.task_manager = task_manager
+        self.wheel = TimerWheel(tick=tick, slots=slots, clock=time.time)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit_after(self, delay, task, **kwargs):
+        """
+        Submit the task in delay seconds
+        :return: the timer, which can be cancelled with cancel
+        """
+        return self.wheel.schedule(delay, self._submit, task, kwargs)
+
+    def submit_at(self, when, task, **kwargs):
+        """
+        Submit the task at when, a datetime or epoch seconds
+        :return: the timer, which can be cancelled with cancel
+        """
+        if hasattr(when, "timestamp"):
+            when = when.timestamp()
+        return self.submit_after(when - time.time(), task, **kwargs)
+
+    def cancel(self, timer):
+        return self.wheel.cancel(timer)
+
+    def _submit(self, task, kwargs):
+        self.task_manager.submit(task, **kwargs)
+
+    def _run(self):
+        while not self._stop.wait(self.wheel.tick):
+            self.wheel.advance()
+
+    def start(self):
+        if self._thread is not None:
+            raise RuntimeError("LocalScheduler is already running")
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="LocalScheduler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the scheduler thread. Pending tasks remain in the wheel.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None